@@ -0,0 +1,714 @@
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import sqlite3
+import time
+import uuid
+import os
+
+import httpx
+import requests
+from starlette.applications import Starlette
+from starlette.datastructures import Headers
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse, Response
+from starlette.routing import Route
+
+import backend
+from backend import (app as flask_app, PROXMOX_URL, PASSWORD, VERIFY_SSL, REQUESTS_PER_MINUTE,
+                     CREATE_VM_REQUESTS_PER_MINUTE, PROXMOX_POOL_SIZE, PROXMOX_CONNECT_TIMEOUT, PROXMOX_READ_TIMEOUT,
+                     CACHE_MAX_ENTRIES, CACHE_TTL_NODES, CACHE_TTL_VMS, CACHE_TTL_VM_STATUS,
+                     CLUSTER_FANOUT_WORKERS, CLUSTER_INVENTORY_SOURCE,
+                     BULK_ACTIONS, BULK_CONCURRENCY, BULK_NODE_CONCURRENCY, BULK_MAX_VMS,
+                     STREAM_KEEPALIVE, STREAM_QUEUE_SIZE, METRICS_ENABLED, CACHE_STALE_MAX_AGE)
+
+# Async serving mode: the same API routes as backend.py, run as coroutines so one process can hold
+# thousands of in-flight requests while waiting on Proxmox. Start it with:
+#
+#     uvicorn asgi:app --host 0.0.0.0 --port 8080
+#
+# The Proxmox ticket, rate limiter and configuration are shared with the Flask app in backend.py.
+
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', max(PROXMOX_POOL_SIZE, 100)))
+
+logger = flask_app.logger
+
+# httpx counterpart of backend.CircuitOpenError, so routes handle it together with the other Proxmox errors
+class CircuitOpenError(httpx.HTTPError):
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.retry_after = error.retry_after
+
+# Function to tell whether an error means Proxmox is unreachable, rather than that it refused the request
+def is_upstream_failure(e):
+    if isinstance(e, (CircuitOpenError, httpx.TransportError)):
+        return True
+    return isinstance(e, httpx.HTTPStatusError) and e.response.status_code >= 502
+
+# Function to build the error response of a route whose Proxmox call failed, 503 while its circuit is open
+def upstream_error(message, e):
+    if isinstance(e, CircuitOpenError):
+        return JSONResponse({'error': f"{message}: {e}"}, status_code=503,
+                            headers={'Retry-After': str(int(e.retry_after) + 1)})
+    return JSONResponse({'error': message}, status_code=500)
+
+# Set when a response contains cached data served because Proxmox is unreachable
+served_stale = contextvars.ContextVar('served_stale', default=False)
+# Versions of the cached data a response is built from, see cache_versioned. The list is shared with
+# the tasks a route gathers, as they run in copies of its context.
+cache_versions = contextvars.ContextVar('cache_versions', default=None)
+
+# Async client for the Proxmox API with a shared keep-alive connection pool
+class AsyncProxmoxClient:
+    def __init__(self, base_url, credentials, max_connections, timeout):
+        self.base_url = base_url
+        self.credentials = credentials
+        self.client = httpx.AsyncClient(
+            verify=VERIFY_SSL,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    # Return the shared ticket, logging in on a worker thread so the event loop never blocks on it
+    async def ticket(self):
+        return self.credentials.cached() or await asyncio.to_thread(self.credentials.get)
+
+    # Send a request to Proxmox, logging in again once if the ticket was rejected
+    async def request(self, method, path, **kwargs):
+        try:
+            backend.circuit_breaker.check(backend.circuit_key(path))
+        except backend.CircuitOpenError as e:
+            raise CircuitOpenError(e)
+        url = f"{self.base_url}{path}"
+        for attempt in range(2):
+            ticket, csrf_token = await self.ticket()
+            headers = {
+                'CSRFPreventionToken': csrf_token,
+                'Cookie': f'PVEAuthCookie={ticket}'
+            }
+            response = await self._send(method, path, url, headers=headers, **kwargs)
+            if response.status_code != 401 or attempt:
+                return response
+            logger.info("Proxmox ticket was rejected, logging in again")
+            await asyncio.to_thread(self.credentials.invalidate, ticket)
+
+    # Send one request and record its latency
+    async def _send(self, method, path, url, **kwargs):
+        start = time.perf_counter()
+        status, error = 'error', None
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        except httpx.HTTPError as e:
+            error = str(e) or type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            backend.upstream_request_duration.observe(elapsed, method, backend.upstream_path_template(path), status)
+            backend.circuit_breaker.record(backend.circuit_key(path), status, elapsed, error)
+            logger.debug("Proxmox %s %s answered %s in %.1f ms", method, path, status, elapsed * 1000)
+
+    # Send a request and return the 'data' field of the response
+    async def data(self, method, path, **kwargs):
+        response = await self.request(method, path, **kwargs)
+        response.raise_for_status()
+        return response.json()['data']
+
+    async def aclose(self):
+        await self.client.aclose()
+
+# Coroutine version of backend.TTLCache, concurrent misses for the same key await a single task
+class AsyncTTLCache(backend.TTLCache):
+    async def get_or_load(self, key, ttl, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() < entry[1]:
+                self._entries.move_to_end(key)
+                return entry[0]
+            task = self._loading.get(key)
+            if task is None:
+                task = self._loading[key] = asyncio.ensure_future(loader())
+                task.add_done_callback(lambda task: self._finish(key, ttl, task))
+        # Shielded so a client disconnecting doesn't cancel the load for everyone else waiting on it
+        return await asyncio.shield(task)
+
+    def _finish(self, key, ttl, task):
+        with self._lock:
+            # Only store the value if the key wasn't invalidated while it was loading
+            if self._loading.get(key) is not task:
+                return
+            del self._loading[key]
+            if not task.cancelled() and task.exception() is None:
+                self._store(key, task.result(), ttl)
+
+proxmox = AsyncProxmoxClient(PROXMOX_URL, backend.proxmox.credentials, ASYNC_MAX_CONNECTIONS,
+                             httpx.Timeout(PROXMOX_READ_TIMEOUT, connect=PROXMOX_CONNECT_TIMEOUT))
+inventory_cache = AsyncTTLCache(CACHE_MAX_ENTRIES)
+backend.inventory_caches.append(inventory_cache)
+
+# Function to fetch the data of a Proxmox GET endpoint through the inventory cache. While Proxmox
+# is unreachable, data that expired less than CACHE_STALE_MAX_AGE seconds ago is returned instead.
+# Entries are stored with a hash of the Proxmox response as their version, like in backend.cached_get.
+async def cached_get(key, ttl, path):
+    async def load():
+        response = await proxmox.request('GET', path)
+        response.raise_for_status()
+        return response.json()['data'], hashlib.sha1(response.content).hexdigest()
+    try:
+        data, version = await inventory_cache.get_or_load(key, ttl, load)
+    except httpx.HTTPError as e:
+        found, value = inventory_cache.get_stale(key, CACHE_STALE_MAX_AGE) if is_upstream_failure(e) else (False, None)
+        if not found:
+            note_cache_version(key, None)
+            raise
+        served_stale.set(True)
+        data, version = value
+    note_cache_version(key, version)
+    return data
+
+# Counterpart of backend.note_cache_version
+def note_cache_version(key, version):
+    versions = cache_versions.get()
+    if versions is not None:
+        versions.append(None if version is None else f"{key}={version}")
+
+# Function to get the path and query string of a request, as Flask's request.full_path
+def full_path(request):
+    return f"{request.url.path}?{request.url.query}"
+
+# Decorator for routes whose response only depends on cached Proxmox data, counterpart of backend.cache_versioned
+def cache_versioned(f):
+    async def decorated_function(request):
+        cache_versions.set([])
+        response = await f(request)
+        etag = backend.versioned_etag(full_path(request), cache_versions.get())
+        if etag and response.status_code == 200:
+            response.headers['ETag'] = f'"{etag}"'
+        return response
+    return decorated_function
+
+# Counterpart of backend.not_modified
+def not_modified(request):
+    etag = backend.versioned_etag(full_path(request), cache_versions.get())
+    etag = etag and backend.matching_etag(etag, request.headers.get('If-None-Match'))
+    if etag is None:
+        return None
+    return Response(status_code=304, headers={'ETag': f'"{etag}"', 'Vary': 'Accept-Encoding'})
+
+# Function to call func(*args) on a worker thread when it goes to the shared state database, whose
+# queries and locks would otherwise block the event loop. In-process state is read directly.
+async def shared_state_call(func, *args):
+    if backend.SHARED_STATE_DB:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+# Decorator for rate limiting, sharing its buckets with the Flask app
+def rate_limited(per_minute=None, scope='default'):
+    def decorator(f):
+        async def decorated_function(request):
+            identity = backend.rate_limit_identity(request.headers.get('Authorization'), request.client.host if request.client else None)
+            allowed, retry_after = await shared_state_call(backend.rate_limiter.acquire, f"{scope}:{identity}",
+                                                           per_minute or REQUESTS_PER_MINUTE)
+            if not allowed:
+                backend.rate_limit_rejections.inc(scope)
+                return JSONResponse({"error": "Too many requests, please try again later."}, status_code=429,
+                                    headers={'Retry-After': str(int(retry_after) + 1)})
+            return await f(request)
+        return decorated_function
+    return decorator
+
+# Middleware recording request metrics, outermost so rejected requests are counted too
+class RequestMetrics:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        backend.metrics_store.start()
+        backend.http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            backend.http_requests_in_flight.dec()
+            # The router stores the matched route in the scope, unmatched and rejected requests have none
+            route = scope.get('route')
+            labels = (route.path if route else 'unmatched', scope['method'], status_code)
+            backend.http_requests.inc(*labels)
+            backend.http_request_duration.observe(time.perf_counter() - started, *labels)
+
+async def metrics(request):
+    if not METRICS_ENABLED:
+        return JSONResponse({'error': 'Metrics are disabled'}, status_code=404)
+    # With shared state, rendering reads every worker's values from the database
+    body = await asyncio.to_thread(backend.render_metrics)
+    return Response(body, media_type='text/plain; version=0.0.4')
+
+# Middleware to authenticate API requests and log request info
+class AuthenticateAndLog:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        request_id = headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex
+        # Set for this request's task only, asyncio.to_thread carries it into worker threads
+        backend.request_id_var.set(request_id)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                headers = [(b'x-request-id', request_id.encode('latin-1'))]
+                if served_stale.get():
+                    headers.append((b'warning', b'110 - "Response is Stale"'))
+                message['headers'] = list(message.get('headers', [])) + headers
+            await send(message)
+
+        path = scope['path']
+        if path.startswith('/api') and path != '/api/status':
+            if headers.get('Authorization') != f'Bearer {PASSWORD}':
+                logger.warning("Unauthorized access attempt on %s", path)
+                await JSONResponse({'error': 'Unauthorized'}, status_code=401)(scope, receive, send_wrapper)
+                return
+        logger.info("Request: %s %s", scope['method'], path)
+        await self.app(scope, receive, send_wrapper)
+
+# Middleware for conditional requests and compression of successful GET responses, the counterpart of
+# backend.encode_get_response. Event streams are passed through as they are.
+class EncodeGetResponse:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET':
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        start = None
+
+        async def send_wrapper(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                if message['status'] == 200 and not Headers(raw=message['headers']).get('content-type', '').startswith('text/event-stream'):
+                    start = message
+                    return
+            elif start is not None and message['type'] == 'http.response.body':
+                if message.get('more_body'):
+                    # Body sent in several parts, passed through unchanged
+                    await send(start)
+                else:
+                    etag = Headers(raw=start['headers']).get('etag')
+                    body, headers = backend.encode_body(message.get('body', b''), request_headers.get('Accept-Encoding'),
+                                                        request_headers.get('If-None-Match'), etag and etag.strip('"'))
+                    raw_headers = [(name, value) for name, value in start['headers'] if name not in (b'content-length', b'etag')]
+                    if body is None:
+                        start['status'], body = 304, b''
+                        raw_headers = [(name, value) for name, value in raw_headers if name != b'content-type']
+                    else:
+                        raw_headers.append((b'content-length', str(len(body)).encode('latin-1')))
+                    raw_headers += [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+                    raw_headers.append((b'vary', b'Accept-Encoding'))
+                    await send(dict(start, headers=raw_headers))
+                    message = dict(message, body=body)
+                start = None
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+# Function to build the JSON response of a list route, with the number of matching items in X-Total-Count
+def list_response(body, total):
+    return JSONResponse(body, headers={'X-Total-Count': str(total)})
+
+@rate_limited()
+async def get_iso_list(request):
+    try:
+        # Answered from the shared catalog in memory, only its first fill waits on Proxmox
+        return list_response(*await asyncio.to_thread(backend.iso_list, dict(request.query_params)))
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except backend.CircuitOpenError as e:
+        return upstream_error('Failed to fetch ISO list', CircuitOpenError(e))
+    except requests.exceptions.RequestException as e:
+        logger.error("Error fetching ISO list: %s", e)
+        return upstream_error('Failed to fetch ISO list', e)
+
+@rate_limited()
+async def status(request):
+    body, status_code = backend.api_status()
+    return JSONResponse(body, status_code=status_code)
+
+@rate_limited(per_minute=CREATE_VM_REQUESTS_PER_MINUTE, scope='create-vm')
+async def handle_create_vm(request):
+    try:
+        vm_data = await request.json()
+    except ValueError:
+        vm_data = None
+    if not isinstance(vm_data, dict):
+        return JSONResponse({'error': 'Expected a JSON object'}, status_code=400)
+    logger.info("Create VM request for %s", vm_data.get('name'))
+    # Provisioning runs on the shared job queue, this only validates and queues the request
+    body, status_code = await asyncio.to_thread(backend.submit_create_vm, vm_data.get('name'), vm_data.get('iso'),
+                                                vm_data.get('tier', 'basic'), vm_data.get('node'),
+                                                vm_data.get('placement'), vm_data.get('anti_affinity'))
+    headers = {'Retry-After': str(backend.RETRY_INTERVAL)} if status_code == 503 else None
+    return JSONResponse(body, status_code=status_code, headers=headers)
+
+@rate_limited()
+async def get_job(request):
+    job_id = request.path_params['job_id']
+    job = await shared_state_call(backend.job_queue.get, job_id)
+    if not job:
+        return JSONResponse({'error': f'Job {job_id} not found'}, status_code=404)
+    return JSONResponse(job)
+
+@rate_limited()
+@cache_versioned
+async def get_nodes(request):
+    try:
+        nodes = await cached_get(('nodes',), CACHE_TTL_NODES, "/nodes")
+        return not_modified(request) or list_response(*backend.select_items(nodes, request.query_params, backend.NODE_FILTERS, 'node'))
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except httpx.HTTPError as e:
+        logger.error("Error fetching nodes: %s", e)
+        return upstream_error('Failed to fetch nodes', e)
+
+@rate_limited()
+@cache_versioned
+async def get_vms(request):
+    node = request.path_params['node']
+    try:
+        vms = await cached_get(('vms', node), CACHE_TTL_VMS, f"/nodes/{node}/qemu")
+        return not_modified(request) or list_response(*backend.select_items(vms, request.query_params, backend.VM_FILTERS, 'vmid'))
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except httpx.HTTPError as e:
+        logger.error("Error fetching VMs on node %s: %s", node, e)
+        return upstream_error(f'Failed to fetch VMs on node {node}', e)
+
+@rate_limited()
+@cache_versioned
+async def get_vm_status(request):
+    node, vmid = request.path_params['node'], request.path_params['vmid']
+    try:
+        path = f"/nodes/{node}/qemu/{vmid}/status/current"
+        status = await cached_get(('vm_status', node, vmid), CACHE_TTL_VM_STATUS, path)
+        return not_modified(request) or JSONResponse(status)
+    except httpx.HTTPError as e:
+        logger.error("Error fetching status for VM %s on node %s: %s", vmid, node, e)
+        return upstream_error(f'Failed to fetch status for VM {vmid} on node {node}', e)
+
+@rate_limited()
+async def update_vm_config(request):
+    node, vmid = request.path_params['node'], request.path_params['vmid']
+    config_data = await request.json()
+    try:
+        response = await proxmox.request('PUT', f"/nodes/{node}/qemu/{vmid}/config", json=config_data)
+        backend.invalidate_vm_cache(node, vmid)
+        backend.resource_ledger.refresh_soon(node)
+        response.raise_for_status()
+        return JSONResponse(response.json())
+    except httpx.HTTPError as e:
+        logger.error("Error updating config for VM %s on node %s: %s", vmid, node, e)
+        return upstream_error(f'Failed to update config for VM {vmid} on node {node}', e)
+
+# Factory for the routes that run a single action against one VM
+def vm_action(method, suffix, action, on_success=None):
+    @rate_limited()
+    async def handler(request):
+        node, vmid = request.path_params['node'], request.path_params['vmid']
+        try:
+            response = await proxmox.request(method, f"/nodes/{node}/qemu/{vmid}{suffix}")
+            backend.invalidate_vm_cache(node, vmid)
+            response.raise_for_status()
+            if on_success:
+                on_success(node, vmid)
+            logger.info("%s VM %s on node %s", action.capitalize(), vmid, node)
+            return JSONResponse(response.json())
+        except httpx.HTTPError as e:
+            logger.error("Error trying to %s VM %s on node %s: %s", action, vmid, node, e)
+            return upstream_error(f'Failed to {action} VM {vmid} on node {node}', e)
+    return handler
+
+# Function to run fetch(node) for every online node concurrently, returns (results, errors) keyed by node
+async def fan_out_nodes(fetch):
+    nodes = await cached_get(('nodes',), CACHE_TTL_NODES, "/nodes")
+    semaphore = asyncio.Semaphore(CLUSTER_FANOUT_WORKERS)
+    results, errors = {}, {}
+
+    async def fetch_node(name):
+        async with semaphore:
+            try:
+                results[name] = await fetch(name)
+            except httpx.HTTPError as e:
+                logger.error("Error fetching data from node %s: %s", name, e)
+                errors[name] = str(e)
+
+    online = []
+    for node in nodes:
+        if node.get('status', 'online') != 'online':
+            errors[node['node']] = f"Node is {node['status']}"
+        else:
+            online.append(node['node'])
+    await asyncio.gather(*(fetch_node(name) for name in online))
+    return results, errors
+
+# Counterpart of backend.cluster_vms_body
+def cluster_vms_body(request, vms, errors):
+    vms, total = backend.select_items(vms, request.query_params, backend.CLUSTER_VM_FILTERS, 'vmid')
+    return {'vms': vms, 'errors': errors}, total
+
+@rate_limited()
+@cache_versioned
+async def get_cluster_vms(request):
+    try:
+        # A single /cluster/resources call replaces the per-node requests when the cluster provides it
+        if request.query_params.get('source', CLUSTER_INVENTORY_SOURCE) == 'resources':
+            resources = await cached_get(('cluster_resources', 'vm'), CACHE_TTL_VMS, "/cluster/resources?type=vm")
+            vms, errors = [vm for vm in resources if vm.get('type') == 'qemu'], {}
+        else:
+            results, errors = await fan_out_nodes(lambda node: cached_get(('vms', node), CACHE_TTL_VMS, f"/nodes/{node}/qemu"))
+            vms = [dict(vm, node=node) for node, node_vms in results.items() for vm in node_vms]
+        return not_modified(request) or list_response(*cluster_vms_body(request, vms, errors))
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except httpx.HTTPError as e:
+        logger.error("Error fetching cluster VMs: %s", e)
+        return upstream_error('Failed to fetch cluster VMs', e)
+
+@rate_limited()
+@cache_versioned
+async def get_cluster_status(request):
+    async def fetch_cluster_status():
+        try:
+            return await cached_get(('cluster_status',), CACHE_TTL_NODES, "/cluster/status"), None
+        except httpx.HTTPError as e:
+            logger.error("Error fetching cluster status: %s", e)
+            return None, str(e)
+
+    try:
+        (cluster_status, cluster_error), (results, errors) = await asyncio.gather(
+            fetch_cluster_status(),
+            fan_out_nodes(lambda node: cached_get(('node_status', node), CACHE_TTL_NODES, f"/nodes/{node}/status")),
+        )
+    except httpx.HTTPError as e:
+        logger.error("Error fetching cluster status: %s", e)
+        return upstream_error('Failed to fetch cluster status', e)
+    if cluster_error:
+        errors['cluster'] = cluster_error
+    return not_modified(request) or JSONResponse({'cluster': cluster_status, 'nodes': results, 'errors': errors})
+
+# Counterpart of backend.cached_rrd
+async def cached_rrd(base_path, key, timeframe, cf):
+    ttl = min(backend.RRD_TIMEFRAMES[timeframe], backend.CACHE_TTL_RRD)
+    return await cached_get(('rrd',) + key + (timeframe, cf), ttl, f"{base_path}/rrddata?timeframe={timeframe}&cf={cf}")
+
+@rate_limited()
+@cache_versioned
+async def get_vm_rrd(request):
+    node, vmid = request.path_params['node'], request.path_params['vmid']
+    try:
+        timeframe, cf, buckets, stats, metrics = backend.parse_rrd_params(request.query_params)
+        if not vmid.isdigit():
+            raise ValueError('vmid must be an integer')
+        rows = await cached_rrd(f"/nodes/{node}/qemu/{vmid}", (node, vmid), timeframe, cf)
+        return not_modified(request) or JSONResponse(dict(node=node, vmid=int(vmid), timeframe=timeframe, cf=cf,
+                                                          **backend.downsample_rrd(rows, buckets, stats, metrics)))
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except httpx.HTTPError as e:
+        logger.error("Error fetching performance history of VM %s on node %s: %s", vmid, node, e)
+        return upstream_error(f'Failed to fetch performance history of VM {vmid} on node {node}', e)
+
+@rate_limited()
+@cache_versioned
+async def get_cluster_rrd(request):
+    try:
+        timeframe, cf, buckets, stats, metrics = backend.parse_rrd_params(request.query_params)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    vmids = [vmid for vmid in request.query_params.get('vmid', '').split(',') if vmid]
+    try:
+        # Series are fetched as (labels, rows), and only downsampled if the client doesn't have them already
+        if not vmids:
+            results, errors = await fan_out_nodes(lambda node: cached_rrd(f"/nodes/{node}", (node,), timeframe, cf))
+            fetched = [({'node': node}, rows) for node, rows in sorted(results.items())]
+            return rrd_series_response(request, timeframe, cf, buckets, stats, metrics, fetched, errors)
+        inventory, errors = await fan_out_nodes(lambda node: cached_get(('vms', node), CACHE_TTL_VMS, f"/nodes/{node}/qemu"))
+    except httpx.HTTPError as e:
+        logger.error("Error fetching cluster performance history: %s", e)
+        return upstream_error('Failed to fetch cluster performance history', e)
+    located = {str(vm['vmid']): node for node, vms in inventory.items() for vm in vms}
+    semaphore = asyncio.Semaphore(CLUSTER_FANOUT_WORKERS)
+
+    async def fetch_vm(vmid):
+        async with semaphore:
+            try:
+                rows = await cached_rrd(f"/nodes/{located[vmid]}/qemu/{vmid}", (located[vmid], vmid), timeframe, cf)
+                return {'node': located[vmid], 'vmid': int(vmid)}, rows
+            except httpx.HTTPError as e:
+                logger.error("Error fetching performance history of VM %s: %s", vmid, e)
+                errors[vmid] = str(e)
+
+    for vmid in vmids:
+        if vmid not in located:
+            errors[vmid] = 'VM not found'
+    fetched = await asyncio.gather(*(fetch_vm(vmid) for vmid in vmids if vmid in located))
+    return rrd_series_response(request, timeframe, cf, buckets, stats, metrics, [entry for entry in fetched if entry], errors)
+
+# Function to build the response of the cluster performance history from the fetched (labels, rows) of each series
+def rrd_series_response(request, timeframe, cf, buckets, stats, metrics, fetched, errors):
+    return not_modified(request) or JSONResponse({'timeframe': timeframe, 'cf': cf, 'errors': errors, 'series': [
+        dict(labels, **backend.downsample_rrd(rows, buckets, stats, metrics)) for labels, rows in fetched]})
+
+# Per-node semaphores shared by all bulk requests, so concurrent bulk calls can't overload one node
+node_semaphores = {}
+
+# Function to run one bulk action against one VM, returns its result entry
+async def run_bulk_action(action, node, vmid, semaphore):
+    method, suffix = BULK_ACTIONS[action]
+    result = {'node': node, 'vmid': int(vmid)}
+    node_semaphore = node_semaphores.setdefault(node, asyncio.Semaphore(BULK_NODE_CONCURRENCY))
+    async with semaphore, node_semaphore:
+        try:
+            response = await proxmox.request(method, f"/nodes/{node}/qemu/{vmid}{suffix}")
+            backend.invalidate_vm_cache(node, vmid)
+            response.raise_for_status()
+            if action == 'delete':
+                backend.resource_ledger.remove_vm(node, vmid)
+            result.update(ok=True, upid=response.json().get('data'))
+        except httpx.HTTPError as e:
+            logger.error("Error running %s on VM %s on node %s: %s", action, vmid, node, e)
+            result.update(ok=False, error=str(e))
+    return result
+
+@rate_limited()
+async def bulk_vm_action(request):
+    action = request.path_params['action']
+    if action not in BULK_ACTIONS:
+        return JSONResponse({'error': f'Unknown action {action}'}, status_code=400)
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    vms = backend.parse_bulk_vms(data.get('vms') if isinstance(data, dict) else None)
+    if vms is None:
+        return JSONResponse({'error': 'Expected a non-empty list of {"node", "vmid"} objects in "vms"'}, status_code=400)
+    if len(vms) > BULK_MAX_VMS:
+        return JSONResponse({'error': f'At most {BULK_MAX_VMS} VMs per request'}, status_code=400)
+    try:
+        concurrency = max(1, min(int(data.get('concurrency', BULK_CONCURRENCY)), BULK_CONCURRENCY))
+    except (TypeError, ValueError):
+        return JSONResponse({'error': 'concurrency must be an integer'}, status_code=400)
+    logger.info("Bulk %s of %s VMs with concurrency %s", action, len(vms), concurrency)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(run_bulk_action(action, node, vmid, semaphore) for node, vmid in vms))
+    succeeded = sum(1 for result in results if result['ok'])
+    return JSONResponse({'action': action, 'succeeded': succeeded, 'failed': len(results) - succeeded, 'results': results})
+
+# Route streaming VM status changes as Server-Sent Events, fed by the same per-node pollers as the Flask app
+@rate_limited()
+async def stream_status(request):
+    nodes, vmids = backend.parse_stream_filters(request.query_params)
+    if not nodes:
+        return JSONResponse({'error': 'No node given'}, status_code=400)
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    def put(item):
+        try:
+            events.put_nowait(item)
+        except asyncio.QueueFull:
+            # The client can't keep up, end the stream so it reconnects and starts from a fresh snapshot
+            while not events.empty():
+                events.get_nowait()
+            events.put_nowait(None)
+
+    # Called on the poller threads, so the event is handed over to the event loop
+    def deliver(event, data):
+        if vmids and data.get('vmid') not in vmids and event != 'error':
+            return
+        loop.call_soon_threadsafe(put, (event, data))
+
+    subscriptions = [(node, *backend.status_streamer.subscribe(node, deliver)) for node in nodes]
+
+    async def generate():
+        try:
+            for node, subscription, snapshot in subscriptions:
+                for fields in snapshot:
+                    if not vmids or fields['vmid'] in vmids:
+                        yield backend.format_sse('status', fields)
+            while True:
+                try:
+                    item = await asyncio.wait_for(events.get(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if item is None:
+                    return
+                yield backend.format_sse(*item)
+        finally:
+            for node, subscription, snapshot in subscriptions:
+                backend.status_streamer.unsubscribe(node, subscription)
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Counterpart of backend.shared_state_unavailable
+async def shared_state_unavailable(request, e):
+    logger.error("Shared state database unavailable: %s", e)
+    return JSONResponse({'error': 'Service is busy, please try again later.'}, status_code=503,
+                        headers={'Retry-After': str(backend.RETRY_INTERVAL)})
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await proxmox.aclose()
+
+app = Starlette(
+    routes=[
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/api/iso', get_iso_list, methods=['GET']),
+        Route('/api/status', status, methods=['GET']),
+        Route('/api/create-vm', handle_create_vm, methods=['POST']),
+        Route('/api/jobs/{job_id}', get_job, methods=['GET']),
+        Route('/api/nodes', get_nodes, methods=['GET']),
+        Route('/api/cluster/vms', get_cluster_vms, methods=['GET']),
+        Route('/api/cluster/status', get_cluster_status, methods=['GET']),
+        Route('/api/cluster/rrd', get_cluster_rrd, methods=['GET']),
+        Route('/api/bulk/qemu/{action}', bulk_vm_action, methods=['POST']),
+        Route('/api/stream/status', stream_status, methods=['GET']),
+        Route('/api/nodes/{node}/qemu', get_vms, methods=['GET']),
+        Route('/api/nodes/{node}/qemu/{vmid}/status', get_vm_status, methods=['GET']),
+        Route('/api/nodes/{node}/qemu/{vmid}/rrd', get_vm_rrd, methods=['GET']),
+        Route('/api/nodes/{node}/qemu/{vmid}/config', update_vm_config, methods=['POST']),
+        Route('/api/nodes/{node}/qemu/{vmid}/status/start', vm_action('POST', '/status/start', 'start'), methods=['POST']),
+        Route('/api/nodes/{node}/qemu/{vmid}/status/stop', vm_action('POST', '/status/stop', 'stop'), methods=['POST']),
+        Route('/api/nodes/{node}/qemu/{vmid}', vm_action('DELETE', '', 'delete', backend.resource_ledger.remove_vm), methods=['DELETE']),
+    ],
+    middleware=[
+        Middleware(RequestMetrics),
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                   expose_headers=['ETag', 'X-Total-Count', 'X-Request-ID']),
+        Middleware(AuthenticateAndLog),
+        Middleware(EncodeGetResponse),
+    ],
+    exception_handlers={sqlite3.OperationalError: shared_state_unavailable},
+    lifespan=lifespan,
+)
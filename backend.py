@@ -1,13 +1,33 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, make_response, Response, g, has_request_context
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
 import urllib3
+import numpy as np
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from dotenv import load_dotenv
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag, unquote_etag
 import threading
+import queue
+import multiprocessing
+import uuid
+import contextvars
+import contextlib
+import atexit
+import argparse
+import sys
 import time
+import bisect
+import hashlib
+import warnings
+import gzip
+import re
+import random
+import sqlite3
 import json
 import os
 
@@ -15,12 +35,23 @@ import os
 load_dotenv()
 
 # Configuration
-REQUESTS_PER_MINUTE = 60
+REQUESTS_PER_MINUTE = int(os.getenv('REQUESTS_PER_MINUTE', 60))
+CREATE_VM_REQUESTS_PER_MINUTE = int(os.getenv('CREATE_VM_REQUESTS_PER_MINUTE', 10))
+RATE_LIMIT_KEY = os.getenv('RATE_LIMIT_KEY', 'ip')  # 'ip' or 'token'
+RATE_LIMIT_MAX_KEYS = 10000
 RETRY_INTERVAL = 5  # in seconds
 
-# Rate limiting setup
-request_timestamps = []
-lock = threading.Lock()
+# SQLite file for state shared between worker processes, kept in memory per process if unset.
+# 'serve' with more than one worker process always shares state, in SHARED_STATE_DEFAULT_DB if this is unset.
+SHARED_STATE_DB = os.getenv('SHARED_STATE_DB')
+SHARED_STATE_DEFAULT_DB = 'shared_state.db'
+
+# Logging
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # 'text' or 'json'
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv('LOG_PAYLOAD_MAX_CHARS', 1000))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 1.0))
 
 # Flag to toggle SSL verification
 VERIFY_SSL = os.getenv('VERIFY_SSL', 'false').lower() == 'true'
@@ -29,23 +60,121 @@ if not VERIFY_SSL:
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['ETag', 'X-Total-Count', 'X-Request-ID'])
 #CORS(app, resources={r"/api/*": {"origins": "http://127.0.0.1:5000"}})
 
+# ID of the API request being handled, attached to every log record written while handling it
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+# Wrapper for logged payloads, serialized and truncated to LOG_PAYLOAD_MAX_CHARS only when the record is written
+class LogPayload:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        try:
+            text = json.dumps(self.payload, default=str)
+        except (TypeError, ValueError):
+            text = str(self.payload)
+        if len(text) > LOG_PAYLOAD_MAX_CHARS:
+            return f"{text[:LOG_PAYLOAD_MAX_CHARS]}... ({len(text)} chars)"
+        return text
+
+# Filter adding the request ID and sampling the payloads of records. Records are always written, those whose
+# payload isn't sampled say so in its place.
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        if LOG_PAYLOAD_SAMPLE_RATE < 1 and isinstance(record.args, tuple) \
+                and any(isinstance(arg, LogPayload) for arg in record.args) and random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+            record.args = tuple('(payload not sampled)' if isinstance(arg, LogPayload) else arg for arg in record.args)
+        return True
+
+# Formatter writing one JSON object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+            'location': f"{record.pathname}:{record.lineno}",
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+# Handler putting records on a bounded queue, a background listener formats and writes them.
+# Records are queued unformatted, so messages and payloads are only rendered off the request thread.
+class BackgroundQueueHandler(QueueHandler):
+    def __init__(self, handlers, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.handlers = handlers
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        # The listener thread doesn't survive a fork, so each worker process starts its own
+        if self._pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+    def start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue.maxsize)
+            self._listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        if self._listener and self._pid == os.getpid():
+            self._listener.stop()
+            self._pid = None
+
+    # Replace the handlers records are written to, they are used from the next record on
+    def set_handlers(self, handlers):
+        self.stop()
+        self.handlers = handlers
+
+# Handler sending records to the log writer of the serve process, so worker processes never write or
+# rotate the log files themselves. The message and exception are rendered before a record is sent.
+class ForwardingHandler(QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
 # Setup logging
+if LOG_FORMAT == 'json':
+    log_formatter = JsonFormatter()
+else:
+    log_formatter = logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s]: %(message)s [in %(pathname)s:%(lineno)d]')
+
 info_handler = RotatingFileHandler('api_info.log', maxBytes=100000, backupCount=3)
-info_handler.setLevel(logging.INFO)
-info_formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
-info_handler.setFormatter(info_formatter)
+info_handler.setLevel(LOG_LEVEL)
+info_handler.setFormatter(log_formatter)
 
 error_handler = RotatingFileHandler('api_error.log', maxBytes=100000, backupCount=3)
 error_handler.setLevel(logging.ERROR)
-error_formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
-error_handler.setFormatter(error_formatter)
+error_handler.setFormatter(log_formatter)
 
-app.logger.addHandler(info_handler)
-app.logger.addHandler(error_handler)
-app.logger.setLevel(logging.INFO)
+# Flask's console handler is written from the listener too
+console_handlers = list(app.logger.handlers)
+log_queue_handler = BackgroundQueueHandler([info_handler, error_handler] + console_handlers, LOG_QUEUE_SIZE)
+log_queue_handler.addFilter(RequestContextFilter())
+app.logger.handlers = [log_queue_handler]
+app.logger.setLevel(LOG_LEVEL)
+atexit.register(log_queue_handler.stop)
 
 # Load environment variables
 PROXMOX_URL = os.getenv('PROXMOX_URL')
@@ -58,378 +187,2664 @@ TOTAL_CPU_THREADS = int(os.getenv('TOTAL_CPU_THREADS', 48))
 TOTAL_MEMORY_GB = int(os.getenv('TOTAL_MEMORY_GB', 48))
 PROXMOX_CPU_OVERHEAD_THREADS = int(os.getenv('PROXMOX_CPU_OVERHEAD_THREADS', 2))
 PROXMOX_MEMORY_OVERHEAD_GB = int(os.getenv('PROXMOX_MEMORY_OVERHEAD_GB', 6))
+VM_STORAGE = os.getenv('VM_STORAGE', 'local-lvm')
+LEDGER_POLL_INTERVAL = float(os.getenv('LEDGER_POLL_INTERVAL', 30))  # in seconds
+LEDGER_RESERVATION_TTL = float(os.getenv('LEDGER_RESERVATION_TTL', 300))  # in seconds
+VMID_RESERVATION_TTL = float(os.getenv('VMID_RESERVATION_TTL', 120))  # in seconds
+VMID_ALLOCATION_ATTEMPTS = 100
+PLACEMENT_POLICY = os.getenv('PLACEMENT_POLICY', 'spread')  # 'spread' or 'best-fit'
+PLACEMENT_POLICIES = ('spread', 'best-fit')
+# Template VM, by name or ID, each tier is cloned from when no ISO is given, e.g. 'basic=debian-12-cloud,standard=9001'
+TIER_TEMPLATES = dict(item.split('=', 1) for item in os.getenv('TIER_TEMPLATES', '').split(',') if '=' in item)
+# Number of stopped clones kept ready per tier, e.g. 'basic=4'
+CLONE_POOL_SIZES = {tier: int(size) for tier, size in
+                    (item.split('=', 1) for item in os.getenv('CLONE_POOL_SIZES', '').split(',') if '=' in item)}
+CLONE_POOL_INTERVAL = float(os.getenv('CLONE_POOL_INTERVAL', 60))  # in seconds
+CLONE_POOL_NAME_PREFIX = 'pool-'
 
-# Function to get Proxmox ticket and CSRF token
-def get_proxmox_ticket():
-    url = f"{PROXMOX_URL}/access/ticket"
-    data = {
-        'username': PROXMOX_USER,
-        'password': PROXMOX_PASS
-    }
-    response = requests.post(url, data=data, verify=VERIFY_SSL)
-    response.raise_for_status()
-    result = response.json()
-    return result['data']['ticket'], result['data']['CSRFPreventionToken']
+PROXMOX_TICKET_TTL = int(os.getenv('PROXMOX_TICKET_TTL', 6600))  # in seconds, Proxmox tickets expire after 2 hours
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 16))
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', 2 * (os.cpu_count() or 1)))
+SERVER_BIND = os.getenv('SERVER_BIND', '0.0.0.0:8080')
+PRECHECK_TIMEOUT = float(os.getenv('PRECHECK_TIMEOUT', 10))  # in seconds
+PRECHECK_POLICY = os.getenv('PRECHECK_POLICY', 'exit')  # 'exit', 'continue' or 'ask'
+PROXMOX_POOL_SIZE = int(os.getenv('PROXMOX_POOL_SIZE', WORKER_THREADS))
+PROXMOX_CONNECT_TIMEOUT = float(os.getenv('PROXMOX_CONNECT_TIMEOUT', 5))  # in seconds
+PROXMOX_READ_TIMEOUT = float(os.getenv('PROXMOX_READ_TIMEOUT', 30))  # in seconds
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 1024))
+CACHE_TTL_NODES = float(os.getenv('CACHE_TTL_NODES', 10))  # in seconds
+CACHE_TTL_VMS = float(os.getenv('CACHE_TTL_VMS', 5))  # in seconds
+CACHE_TTL_VM_STATUS = float(os.getenv('CACHE_TTL_VM_STATUS', 2))  # in seconds
+CACHE_TTL_ISO = float(os.getenv('CACHE_TTL_ISO', 60))  # in seconds between ISO catalog refreshes
+CACHE_TTL_RRD = float(os.getenv('CACHE_TTL_RRD', 300))  # in seconds, at most, shorter for short timeframes
+CACHE_STALE_MAX_AGE = float(os.getenv('CACHE_STALE_MAX_AGE', 300))  # in seconds past expiry
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', 20))  # number of recent calls per circuit
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 5))
+BREAKER_FAILURE_RATIO = float(os.getenv('BREAKER_FAILURE_RATIO', 0.5))
+BREAKER_SLOW_CALL = float(os.getenv('BREAKER_SLOW_CALL', 10))  # in seconds, slower calls count as failures
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', 30))
+HEALTH_PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL', 10))  # in seconds
+CLUSTER_FANOUT_WORKERS = int(os.getenv('CLUSTER_FANOUT_WORKERS', 8))
+CLUSTER_INVENTORY_SOURCE = os.getenv('CLUSTER_INVENTORY_SOURCE', 'nodes')  # 'nodes' or 'resources'
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', 8))
+BULK_NODE_CONCURRENCY = int(os.getenv('BULK_NODE_CONCURRENCY', 4))
+BULK_MAX_VMS = int(os.getenv('BULK_MAX_VMS', 500))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 50))
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', 3600))  # in seconds
+TASK_POLL_INTERVAL = float(os.getenv('TASK_POLL_INTERVAL', 2))  # in seconds
+TASK_TIMEOUT = float(os.getenv('TASK_TIMEOUT', 600))  # in seconds
+STREAM_POLL_INTERVAL = float(os.getenv('STREAM_POLL_INTERVAL', 2))  # in seconds
+STREAM_KEEPALIVE = 15  # in seconds
+# Status streams each worker process serves at once, each holds a request thread for as long as it is open
+STREAM_MAX_CLIENTS = int(os.getenv('STREAM_MAX_CLIENTS', WORKER_THREADS // 2))
+STREAM_QUEUE_SIZE = 1000
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_PUBLISH_INTERVAL = float(os.getenv('METRICS_PUBLISH_INTERVAL', 5))  # in seconds
+GZIP_MIN_SIZE = int(os.getenv('GZIP_MIN_SIZE', 1024))  # in bytes, smaller responses are sent uncompressed
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
 
-# Function to check Proxmox connection
-def check_proxmox_connection():
-    while True:
+# Prometheus metrics. Each worker process keeps its own values, they are summed up at scrape time by metrics_store.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    # Return a copy of the values, label values -> value
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    # Combine the snapshots of several processes into one
+    def merge(self, snapshots):
+        merged = {}
+        for snapshot in snapshots:
+            for label_values, value in snapshot.items():
+                merged[label_values] = merged.get(label_values, 0) + value
+        return merged
+
+    def _format_labels(self, label_values, extra=()):
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, label_values)] + list(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    # Render the values of this process, or the given snapshot
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for label_values, value in (self.snapshot() if values is None else values).items():
+            lines.append(f"{self.name}{self._format_labels(label_values)} {value}")
+        return lines
+
+# Gauges of several processes are summed, or combined with aggregate, e.g. max for flags
+class Gauge(Counter):
+    type = 'gauge'
+
+    def __init__(self, name, description, labels=(), aggregate=sum):
+        super().__init__(name, description, labels)
+        self.aggregate = aggregate
+
+    def merge(self, snapshots):
+        merged = {}
+        for snapshot in snapshots:
+            for label_values, value in snapshot.items():
+                merged.setdefault(label_values, []).append(value)
+        return {label_values: self.aggregate(values) for label_values, values in merged.items()}
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {label_values: [list(counts), total, count] for label_values, (counts, total, count) in self._values.items()}
+
+    def merge(self, snapshots):
+        merged = {}
+        for snapshot in snapshots:
+            for label_values, (counts, total, count) in snapshot.items():
+                series = merged.setdefault(label_values, [[0] * len(counts), 0.0, 0])
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+                series[2] += count
+        return merged
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for label_values, (counts, total, count) in (self.snapshot() if values is None else values).items():
+            cumulative = 0
+            for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(label_values, [le])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(label_values)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(label_values)} {count}")
+        return lines
+
+http_requests = Counter('api_http_requests_total', 'API requests by route, method and status code', ('route', 'method', 'status'))
+http_request_duration = Histogram('api_http_request_duration_seconds', 'API request latency by route, method and status code', ('route', 'method', 'status'))
+http_requests_in_flight = Gauge('api_http_requests_in_flight', 'API requests currently being handled')
+upstream_request_duration = Histogram('api_proxmox_request_duration_seconds', 'Proxmox API call latency by method, path and status code', ('method', 'path', 'status'))
+ticket_logins = Counter('api_proxmox_ticket_logins_total', 'Proxmox ticket logins by result', ('result',))
+rate_limit_rejections = Counter('api_rate_limit_rejections_total', 'Requests rejected by the rate limiter by scope', ('scope',))
+log_records_dropped = Counter('api_log_records_dropped_total', 'Log records dropped because the log queue was full')
+circuit_open = Gauge('api_proxmox_circuit_open', 'Whether calls to Proxmox for a node, or the cluster API, are failing fast', ('circuit',), aggregate=max)
+circuit_rejections = Counter('api_proxmox_circuit_rejections_total', 'Proxmox calls refused because their circuit was open', ('circuit',))
+METRICS = [http_requests, http_request_duration, http_requests_in_flight, upstream_request_duration, ticket_logins,
+           rate_limit_rejections, log_records_dropped, circuit_open, circuit_rejections]
+
+# Patterns replacing node names, VM IDs and similar path segments so upstream metrics have few label values
+UPSTREAM_PATH_PATTERNS = [
+    (re.compile(r'^/nodes/[^/]+'), '/nodes/{node}'),
+    (re.compile(r'/qemu/\d+'), '/qemu/{vmid}'),
+    (re.compile(r'/tasks/[^/]+'), '/tasks/{upid}'),
+    (re.compile(r'/storage/[^/]+'), '/storage/{storage}'),
+]
+
+@lru_cache(maxsize=4096)
+def upstream_path_template(path):
+    path = path.split('?', 1)[0]
+    for pattern, replacement in UPSTREAM_PATH_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return path
+
+# Function to render all metrics in the Prometheus text format, totalled over the worker processes
+def render_metrics():
+    snapshots = metrics_store.collect()
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render(metric.merge(snapshots.get(metric.name, []))))
+    return '\n'.join(lines) + '\n'
+
+# Process-wide cache for the Proxmox ticket and CSRF token, shared by all request threads
+class ProxmoxCredentials:
+    def __init__(self, login, ttl):
+        self.login = login
+        self.ttl = ttl
+        self._state = None  # (ticket, csrf_token, expires_at)
+        self._failed_until = 0
+        self._last_error = None
+        self._lock = threading.Lock()
+
+    # Return the cached ticket without blocking, or None if a login is needed
+    def cached(self):
+        state = self._state
+        if state and time.monotonic() < state[2]:
+            return state[0], state[1]
+        return None
+
+    # Return the cached ticket, logging in again only when it is missing or about to expire
+    def get(self):
+        cached = self.cached()
+        if cached:
+            return cached
+        # Threads arriving during a refresh wait here and reuse the ticket obtained by the first one
+        with self._lock:
+            state = self._state
+            if state and time.monotonic() < state[2]:
+                return state[0], state[1]
+            # Don't retry a failed login for every queued request
+            if time.monotonic() < self._failed_until:
+                raise self._last_error
+            try:
+                ticket, csrf_token = self.login()
+            except requests.exceptions.RequestException as e:
+                ticket_logins.inc('failure')
+                self._last_error = e
+                self._failed_until = time.monotonic() + RETRY_INTERVAL
+                raise
+            ticket_logins.inc('success')
+            self._state = (ticket, csrf_token, time.monotonic() + self.ttl)
+            app.logger.info("Obtained new Proxmox ticket")
+            return ticket, csrf_token
+
+    # Drop a ticket Proxmox rejected, unless another thread has already replaced it
+    def invalidate(self, ticket):
+        with self._lock:
+            if self._state and self._state[0] == ticket:
+                self._state = None
+
+CLUSTER_CIRCUIT = 'cluster'
+NODE_PATH = re.compile(r'^/nodes/([^/?]+)/')
+
+# Function to get the circuit of a Proxmox API path: the node it concerns, or the cluster API itself
+@lru_cache(maxsize=4096)
+def circuit_key(path):
+    match = NODE_PATH.match(path)
+    return match.group(1) if match else CLUSTER_CIRCUIT
+
+# Raised instead of calling Proxmox while the circuit of a node, or of the cluster API, is open
+class CircuitOpenError(requests.exceptions.RequestException):
+    def __init__(self, key, retry_after):
+        target = 'The Proxmox API' if key == CLUSTER_CIRCUIT else f'Proxmox node {key}'
+        super().__init__(f"{target} is unavailable")
+        self.key = key
+        self.retry_after = retry_after
+
+# Per-node circuit breaker for Proxmox calls. A circuit opens when most of its recent calls failed
+# or were too slow, and then refuses calls for BREAKER_OPEN_SECONDS. After that a single trial call
+# is let through (half-open), its outcome closes the circuit or opens it again. Node calls are also
+# refused while the cluster API circuit is open, as they go through the same API.
+class CircuitBreaker:
+    def __init__(self, window, min_calls, failure_ratio, slow_call, open_seconds, trial_timeout):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+        self.trial_timeout = trial_timeout
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    # Must be called with the lock held
+    def _circuit(self, key):
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            circuit = self._circuits[key] = {'state': 'closed', 'outcomes': deque(maxlen=self.window),
+                                             'latencies': deque(maxlen=self.window), 'opened_at': 0,
+                                             'trial_started': 0, 'last_error': None}
+        return circuit
+
+    # Raise CircuitOpenError unless a call for key may be made now
+    def check(self, key):
+        now = time.monotonic()
+        with self._lock:
+            cluster = self._circuits.get(CLUSTER_CIRCUIT)
+            if key != CLUSTER_CIRCUIT and cluster and cluster['state'] == 'open' \
+                    and now < cluster['opened_at'] + self.open_seconds:
+                retry_after = cluster['opened_at'] + self.open_seconds - now
+            else:
+                circuit = self._circuits.get(key)
+                if circuit is None or circuit['state'] == 'closed':
+                    return
+                if circuit['state'] == 'open' and now >= circuit['opened_at'] + self.open_seconds:
+                    circuit['state'] = 'half-open'
+                    circuit['trial_started'] = now
+                    return
+                # A trial that never reported back doesn't keep the circuit half-open forever
+                if circuit['state'] == 'half-open' and now >= circuit['trial_started'] + self.trial_timeout:
+                    circuit['trial_started'] = now
+                    return
+                retry_after = max(circuit['opened_at'] + self.open_seconds - now, 1)
+        circuit_rejections.inc(key)
+        raise CircuitOpenError(key, retry_after)
+
+    # Record the outcome of a call, status is the HTTP status or 'error' if no response arrived
+    def record(self, key, status, elapsed, error=None):
+        # Proxmox answers 500 for many invalid requests, only gateway errors and pveproxy's 59x codes
+        # mean the node is unreachable
+        ok = isinstance(status, int) and status < 502 and elapsed < self.slow_call
+        with self._lock:
+            circuit = self._circuit(key)
+            circuit['outcomes'].append(ok)
+            circuit['latencies'].append(elapsed)
+            if not ok:
+                circuit['last_error'] = error or (f'HTTP {status}' if isinstance(status, int) and status >= 502
+                                                  else f'Slow response ({elapsed:.1f}s)')
+            if circuit['state'] == 'half-open':
+                if ok:
+                    self._close(key, circuit)
+                else:
+                    self._open(key, circuit)
+            elif circuit['state'] == 'closed' and not ok:
+                failures = circuit['outcomes'].count(False)
+                if len(circuit['outcomes']) >= self.min_calls and failures >= self.failure_ratio * len(circuit['outcomes']):
+                    self._open(key, circuit)
+
+    # Must be called with the lock held
+    def _open(self, key, circuit):
+        if circuit['state'] != 'open':
+            app.logger.warning("Circuit for %s opened: %s", key, circuit['last_error'])
+        circuit['state'] = 'open'
+        circuit['opened_at'] = time.monotonic()
+        circuit_open.set(1, key)
+        # The probe lets circuits recover without waiting for client requests
+        health_probe.start()
+
+    # Must be called with the lock held
+    def _close(self, key, circuit):
+        app.logger.warning("Circuit for %s closed", key)
+        circuit['state'] = 'closed'
+        circuit['outcomes'].clear()
+        circuit_open.set(0, key)
+
+    # Return the keys of circuits that aren't closed
+    def open_circuits(self):
+        with self._lock:
+            return [key for key, circuit in self._circuits.items() if circuit['state'] != 'closed']
+
+    # Return the state, recent failures and latency of every circuit
+    def snapshot(self):
+        with self._lock:
+            return {key: {
+                'state': circuit['state'],
+                'recent_calls': len(circuit['outcomes']),
+                'recent_failures': circuit['outcomes'].count(False),
+                'average_latency_ms': round(sum(circuit['latencies']) / len(circuit['latencies']) * 1000, 1)
+                                      if circuit['latencies'] else None,
+                'last_error': circuit['last_error'],
+            } for key, circuit in self._circuits.items()}
+
+circuit_breaker = CircuitBreaker(BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATIO, BREAKER_SLOW_CALL,
+                                 BREAKER_OPEN_SECONDS, PROXMOX_CONNECT_TIMEOUT + PROXMOX_READ_TIMEOUT)
+
+# Function to tell whether an error means Proxmox is unreachable, rather than that it refused the request
+def is_upstream_failure(e):
+    if isinstance(e, (CircuitOpenError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code >= 502
+
+# Function to build the error response of a route whose Proxmox call failed, 503 while its circuit is open
+def upstream_error(message, e):
+    if isinstance(e, CircuitOpenError):
+        response = jsonify({'error': f"{message}: {e}"})
+        response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+        return response, 503
+    return jsonify({'error': message}), 500
+
+# Client for the Proxmox API with a persistent keep-alive connection pool
+class ProxmoxClient:
+    def __init__(self, base_url, pool_size, timeout, ticket_ttl):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.credentials = ProxmoxCredentials(self.login, ticket_ttl)
+        self.session = self._new_session()
+
+    def _new_session(self):
+        session = requests.Session()
+        session.verify = VERIFY_SSL
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    # Give a forked worker process its own connections and login lock. Threads of the parent don't exist in
+    # the worker, so a lock one of them held at the fork, e.g. a pre-check still logging in, would never be released.
+    def reset_after_fork(self):
+        self.session = self._new_session()
+        self.credentials._lock = threading.Lock()
+
+    # Function to get a new Proxmox ticket and CSRF token
+    def login(self):
+        data = {
+            'username': PROXMOX_USER,
+            'password': PROXMOX_PASS
+        }
+        response = self.request('POST', '/access/ticket', authenticate=False, data=data)
+        response.raise_for_status()
+        result = response.json()
+        return result['data']['ticket'], result['data']['CSRFPreventionToken']
+
+    # Send a request to Proxmox, logging in again once if the ticket was rejected
+    def request(self, method, path, authenticate=True, **kwargs):
+        circuit_breaker.check(circuit_key(path))
+        url = f"{self.base_url}{path}"
+        kwargs.setdefault('timeout', self.timeout)
+        if not authenticate:
+            return self._send(method, path, url, **kwargs)
+        for attempt in range(2):
+            ticket, csrf_token = self.credentials.get()
+            headers = {
+                'CSRFPreventionToken': csrf_token,
+                'Cookie': f'PVEAuthCookie={ticket}'
+            }
+            response = self._send(method, path, url, headers=headers, **kwargs)
+            if response.status_code != 401 or attempt:
+                return response
+            app.logger.info("Proxmox ticket was rejected, logging in again")
+            self.credentials.invalidate(ticket)
+
+    # Send one request and record its latency
+    def _send(self, method, path, url, **kwargs):
+        start = time.perf_counter()
+        status, error = 'error', None
         try:
-            # Replace with actual Proxmox connection check
-            response = requests.get(f"{PROXMOX_URL}/api2/json/version", verify=VERIFY_SSL)
-            if response.status_code == 200:
-                print("Connected to Proxmox")
-                break
-        except requests.RequestException as e:
-            print(f"Failed to connect to Proxmox: {e}")
-        time.sleep(RETRY_INTERVAL)
-
-# Start Proxmox connection check in a separate thread
-threading.Thread(target=check_proxmox_connection, daemon=True).start()
-
-# Function to continuously check if proxmox is running
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            upstream_request_duration.observe(elapsed, method, upstream_path_template(path), status)
+            circuit_breaker.record(circuit_key(path), status, elapsed, error)
+            app.logger.debug("Proxmox %s %s answered %s in %.1f ms", method, path, status, elapsed * 1000)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+proxmox = ProxmoxClient(PROXMOX_URL, PROXMOX_POOL_SIZE, (PROXMOX_CONNECT_TIMEOUT, PROXMOX_READ_TIMEOUT), PROXMOX_TICKET_TTL)
+
+# Bounded LRU cache with per-entry expiry, concurrent misses for the same key share a single load
+class TTLCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._loading = {}  # key -> Future of the load in progress
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, ttl, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() < entry[1]:
+                self._entries.move_to_end(key)
+                return entry[0]
+            future = self._loading.get(key)
+            if future is None:
+                future = self._loading[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return future.result()
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                if self._loading.get(key) is future:
+                    del self._loading[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            # Only store the value if the key wasn't invalidated while it was loading
+            if self._loading.get(key) is future:
+                del self._loading[key]
+                self._store(key, value, ttl)
+        future.set_result(value)
+        return value
+
+    # Must be called with the lock held
+    def _store(self, key, value, ttl):
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                self._loading.pop(key, None)
+
+    # Return (True, value) for an entry that expired less than max_age seconds ago, or (False, None).
+    # Expired entries stay until they are evicted, so they can stand in while Proxmox is unreachable.
+    def get_stale(self, key, max_age):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() < entry[1] + max_age:
+                return True, entry[0]
+            return False, None
+
+inventory_cache = TTLCache(CACHE_MAX_ENTRIES)
+# Caches of Proxmox inventory invalidated after writes, the ASGI app adds its own so writes made by jobs reach it too
+inventory_caches = [inventory_cache]
+
+# Function to fetch the data of a Proxmox GET endpoint through the inventory cache. While Proxmox
+# is unreachable, data that expired less than CACHE_STALE_MAX_AGE seconds ago is returned instead.
+# Entries are stored with a hash of the Proxmox response as their version, see cache_versioned.
+def cached_get(key, ttl, path):
+    def load():
+        response = proxmox.get(path)
+        response.raise_for_status()
+        return response.json()['data'], hashlib.sha1(response.content).hexdigest()
+    try:
+        data, version = inventory_cache.get_or_load(key, ttl, load)
+    except requests.exceptions.RequestException as e:
+        found, value = inventory_cache.get_stale(key, CACHE_STALE_MAX_AGE) if is_upstream_failure(e) else (False, None)
+        if not found:
+            note_cache_version(key, None)
+            raise
+        if has_request_context():
+            g.served_stale = True
+        data, version = value
+    note_cache_version(key, version)
+    return data
+
+# Function to note the version of cached data the current request's response is built from, None if the
+# data couldn't be loaded. Also called from fan-out threads, which share the request's g.
+def note_cache_version(key, version):
+    versions = g.get('cache_versions') if has_request_context() else None
+    if versions is not None:
+        versions.append(None if version is None else f"{key}={version}")
+
+# Function to drop cached inventory of a node, and optionally one of its VMs, after a write
+def invalidate_vm_cache(node, vmid=None):
+    keys = [('vms', node), ('cluster_resources', 'vm')]
+    if vmid is not None:
+        keys.append(('vm_status', node, str(vmid)))
+    for cache in inventory_caches:
+        cache.invalidate(*keys)
+
+# Function to check if proxmox is running, the outcome also feeds the circuit breaker
 def check_proxmox_status():
-    while True:
+    try:
+        response = proxmox.get('/version', authenticate=False)
+        return response.status_code == 200
+    except requests.exceptions.RequestException:
+        return False
+
+# Background health probe: checks the Proxmox API every HEALTH_PROBE_INTERVAL seconds, and nodes whose
+# circuit is open, so circuits recover without waiting for client requests to act as trial calls
+class HealthProbe:
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_result = None  # (ok, checked_at)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # Start the probe thread, safe to call repeatedly
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._probe, name='health-probe', daemon=True)
+                self._thread.start()
+
+    def _probe(self):
+        while True:
+            self.last_result = (check_proxmox_status(), time.time())
+            for key in circuit_breaker.open_circuits():
+                if key == CLUSTER_CIRCUIT:
+                    continue
+                try:
+                    proxmox.get(f"/nodes/{key}/status")
+                except requests.exceptions.RequestException:
+                    pass
+            time.sleep(self.interval)
+
+health_probe = HealthProbe(HEALTH_PROBE_INTERVAL)
+
+SHARED_STATE_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tokens REAL, updated_at REAL)',
+    'CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, expires_at REAL)',
+    'CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT, updated_at REAL)',
+    'CREATE TABLE IF NOT EXISTS reservations (id TEXT PRIMARY KEY, node TEXT, cpu REAL, memory_gb REAL, disk_gb REAL, '
+    'name TEXT, vmid INTEGER, expires_at REAL)',
+    'CREATE TABLE IF NOT EXISTS metrics (process TEXT, name TEXT, data TEXT, updated_at REAL, PRIMARY KEY (process, name))',
+]
+_shared_state = threading.local()
+
+# Function to get this thread's connection to the shared state database
+def shared_state_connection():
+    # Connections must not be reused across a fork, so they are tracked per process
+    if getattr(_shared_state, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(SHARED_STATE_DB, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # With WAL, commits only need an fsync at checkpoints, a crash can lose the last few updates but not corrupt the file
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in SHARED_STATE_SCHEMA:
+            conn.execute(statement)
+        _shared_state.conn, _shared_state.pid = conn, os.getpid()
+    return _shared_state.conn
+
+# Token bucket refill shared by the rate limiter backends, returns (tokens, seconds until one is available)
+def refill_token_bucket(tokens, elapsed, per_minute):
+    tokens = min(per_minute, tokens + elapsed * per_minute / 60)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) * 60 / per_minute
+
+# Per-key token buckets kept in this process, least recently used keys are dropped first
+class MemoryRateLimiter:
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    # Take a token from the bucket, returns (allowed, retry_after)
+    def acquire(self, key, per_minute):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (per_minute, now))
+            tokens, retry_after = refill_token_bucket(tokens, now - updated_at, per_minute)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after == 0, retry_after
+
+# Per-key token buckets stored in the shared state database, so all worker processes see the same limits
+class SQLiteRateLimiter:
+    # Take a token from the bucket, returns (allowed, retry_after). Requests are let through if the
+    # database stays locked, rather than failing because of the rate limiter.
+    def acquire(self, key, per_minute):
         try:
-            response = requests.get(f"{PROXMOX_URL}/api2/json/version", verify=VERIFY_SSL)
-            if response.status_code == 200:
-                return True
-            else:
+            return self._acquire(key, per_minute)
+        except sqlite3.OperationalError as e:
+            app.logger.warning("Rate limit for %s not checked: %s", key, e)
+            return True, 0
+
+    def _acquire(self, key, per_minute):
+        conn = shared_state_connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated_at FROM rate_limits WHERE key = ?', (key,)).fetchone()
+            tokens, updated_at = row if row else (per_minute, now)
+            tokens, retry_after = refill_token_bucket(tokens, max(0, now - updated_at), per_minute)
+            conn.execute('INSERT OR REPLACE INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?)', (key, tokens, now))
+            # Occasionally drop buckets that have been idle long enough to be full again
+            if random.random() < 0.001:
+                conn.execute('DELETE FROM rate_limits WHERE updated_at < ?', (now - 3600,))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        return retry_after == 0, retry_after
+
+rate_limiter = SQLiteRateLimiter() if SHARED_STATE_DB else MemoryRateLimiter(RATE_LIMIT_MAX_KEYS)
+
+# Short-lived exclusive leases on named keys, kept in this process
+class MemoryLeases:
+    def __init__(self):
+        self._leases = {}  # key -> expires_at
+        self._lock = threading.Lock()
+
+    def acquire(self, key, ttl):
+        now = time.time()
+        with self._lock:
+            if self._leases.get(key, 0) > now:
                 return False
-        except requests.exceptions.RequestException:
-            return False
-        finally:
-            time.sleep(10)
-
-# Function to check rate limiting
-def is_rate_limited():
-    with lock:
-        current_time = time.time()
-        # Remove timestamps older than a minute
-        while request_timestamps and request_timestamps[0] < current_time - 60:
-            request_timestamps.pop(0)
-        if len(request_timestamps) >= REQUESTS_PER_MINUTE:
+            self._leases[key] = now + ttl
+            # Drop expired leases now and then so the dict doesn't grow forever
+            if random.random() < 0.01:
+                self._leases = {k: expires_at for k, expires_at in self._leases.items() if expires_at > now}
             return True
-        request_timestamps.append(current_time)
-        return False
-    
-# Decorator for rate limiting
-def rate_limited(f):
+
+    def release(self, key):
+        with self._lock:
+            self._leases.pop(key, None)
+
+# Short-lived exclusive leases stored in the shared state database, exclusive across worker processes
+class SQLiteLeases:
+    def acquire(self, key, ttl):
+        conn = shared_state_connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM leases WHERE key = ? AND expires_at <= ?', (key, now))
+            cursor = conn.execute('INSERT OR IGNORE INTO leases (key, expires_at) VALUES (?, ?)', (key, now + ttl))
+            if random.random() < 0.01:
+                conn.execute('DELETE FROM leases WHERE expires_at <= ?', (now,))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        return cursor.rowcount == 1
+
+    def release(self, key):
+        shared_state_connection().execute('DELETE FROM leases WHERE key = ?', (key,))
+
+leases = SQLiteLeases() if SHARED_STATE_DB else MemoryLeases()
+
+# Job records kept in this process
+class MemoryJobStore:
+    def __init__(self, retention):
+        self.retention = retention
+        self._jobs = OrderedDict()  # id -> job, oldest update first
+        self._lock = threading.Lock()
+
+    def save(self, job):
+        with self._lock:
+            self._jobs[job['id']] = dict(job)
+            self._jobs.move_to_end(job['id'])
+            while self._jobs and next(iter(self._jobs.values()))['updated_at'] < time.time() - self.retention:
+                self._jobs.popitem(last=False)
+
+    def load(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+# Job records stored in the shared state database, so any worker process can report on a job
+class SQLiteJobStore:
+    def __init__(self, retention):
+        self.retention = retention
+
+    def save(self, job):
+        conn = shared_state_connection()
+        conn.execute('INSERT OR REPLACE INTO jobs (id, data, updated_at) VALUES (?, ?, ?)', (job['id'], json.dumps(job), job['updated_at']))
+        if random.random() < 0.01:
+            conn.execute('DELETE FROM jobs WHERE updated_at < ?', (time.time() - self.retention,))
+
+    def load(self, job_id):
+        row = shared_state_connection().execute('SELECT data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+# Node resources reserved for VMs being created, kept in this process
+class MemoryReservations:
+    def __init__(self):
+        self._reservations = {}  # id -> node, resources, name, vmid once created and expiry
+        self._lock = threading.RLock()
+
+    # Checking the reserved totals and reserving from them happen within one transaction
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            yield
+
+    def add(self, node, resources, name, ttl):
+        reservation_id = uuid.uuid4().hex
+        with self._lock:
+            self._reservations[reservation_id] = {'node': node, 'resources': tuple(resources), 'name': name,
+                                                  'vmid': None, 'expires_at': time.time() + ttl}
+        return reservation_id
+
+    # Return the reservations that haven't expired
+    def active(self):
+        now = time.time()
+        with self._lock:
+            self._reservations = {reservation_id: reservation for reservation_id, reservation in self._reservations.items()
+                                  if reservation['expires_at'] > now}
+            return [dict(reservation) for reservation in self._reservations.values()]
+
+    def commit(self, reservation_id, vmid):
+        with self._lock:
+            if reservation_id in self._reservations:
+                self._reservations[reservation_id]['vmid'] = int(vmid)
+
+    def release(self, reservation_id):
+        with self._lock:
+            self._reservations.pop(reservation_id, None)
+
+    # Drop the reservations of the VMs on a node that Proxmox now reports
+    def release_created(self, node, vmids):
+        with self._lock:
+            for reservation_id, reservation in list(self._reservations.items()):
+                if reservation['node'] == node and reservation['vmid'] in vmids:
+                    del self._reservations[reservation_id]
+
+# Node resources reserved for VMs being created, stored in the shared state database so worker
+# processes can't overcommit a node between them
+class SQLiteReservations:
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = shared_state_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def add(self, node, resources, name, ttl):
+        reservation_id = uuid.uuid4().hex
+        conn = shared_state_connection()
+        conn.execute('INSERT INTO reservations (id, node, cpu, memory_gb, disk_gb, name, vmid, expires_at) VALUES (?, ?, ?, ?, ?, ?, NULL, ?)',
+                     (reservation_id, node, *resources, name, time.time() + ttl))
+        if random.random() < 0.01:
+            conn.execute('DELETE FROM reservations WHERE expires_at <= ?', (time.time(),))
+        return reservation_id
+
+    def active(self):
+        rows = shared_state_connection().execute('SELECT node, cpu, memory_gb, disk_gb, name, vmid FROM reservations WHERE expires_at > ?',
+                                                 (time.time(),)).fetchall()
+        return [{'node': node, 'resources': (cpu, memory_gb, disk_gb), 'name': name, 'vmid': vmid}
+                for node, cpu, memory_gb, disk_gb, name, vmid in rows]
+
+    def commit(self, reservation_id, vmid):
+        shared_state_connection().execute('UPDATE reservations SET vmid = ? WHERE id = ?', (int(vmid), reservation_id))
+
+    def release(self, reservation_id):
+        shared_state_connection().execute('DELETE FROM reservations WHERE id = ?', (reservation_id,))
+
+    def release_created(self, node, vmids):
+        conn = shared_state_connection()
+        rows = conn.execute('SELECT id, vmid FROM reservations WHERE node = ? AND vmid IS NOT NULL', (node,)).fetchall()
+        for reservation_id, vmid in rows:
+            if vmid in vmids:
+                conn.execute('DELETE FROM reservations WHERE id = ?', (reservation_id,))
+
+# Function to identify the client a request is counted against
+def rate_limit_identity(auth_header, remote_addr):
+    if RATE_LIMIT_KEY == 'token':
+        return hashlib.sha256((auth_header or '').encode()).hexdigest()[:16]
+    return remote_addr
+
+# Decorator for rate limiting, optionally with a separate, stricter limit for a group of routes
+def rate_limited(f=None, per_minute=None, scope='default'):
+    if f is None:
+        return lambda f: rate_limited(f, per_minute, scope)
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if is_rate_limited():
-            return jsonify({"error": "Too many requests, please try again later."}), 429
+        allowed, retry_after = rate_limiter.acquire(f"{scope}:{rate_limit_identity(request.headers.get('Authorization'), request.remote_addr)}", per_minute or REQUESTS_PER_MINUTE)
+        if not allowed:
+            rate_limit_rejections.inc(scope)
+            response = jsonify({"error": "Too many requests, please try again later."})
+            response.headers['Retry-After'] = str(int(retry_after) + 1)
+            return response, 429
         return f(*args, **kwargs)
     return decorated_function
 
+# The shared state database stayed locked for longer than its busy timeout, the client may retry shortly
+@app.errorhandler(sqlite3.OperationalError)
+def shared_state_unavailable(e):
+    app.logger.error("Shared state database unavailable: %s", e)
+    response = jsonify({'error': 'Service is busy, please try again later.'})
+    response.headers['Retry-After'] = str(RETRY_INTERVAL)
+    return response, 503
+
+# Request ID, taken from the X-Request-ID header if the client sent one
+@app.before_request
+def assign_request_id():
+    request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex
+    g.request_id = request_id
+    g.request_id_token = request_id_var.set(request_id)
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers['X-Request-ID'] = g.request_id
+    if g.get('served_stale'):
+        response.headers['Warning'] = '110 - "Response is Stale"'
+    return response
+
+@app.teardown_request
+def reset_request_id(exc):
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        request_id_var.reset(token)
+
+# Request metrics, registered before authentication so rejected requests are counted too
+@app.before_request
+def start_request_metrics():
+    metrics_store.start()
+    g.request_started = time.perf_counter()
+    http_requests_in_flight.inc()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = (route, request.method, response.status_code)
+        http_requests.inc(*labels)
+        http_request_duration.observe(time.perf_counter() - started, *labels)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    http_requests_in_flight.dec()
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 # Middleware to authenticate API requests and log request info
 @app.before_request
 def authenticate_and_log():
     if request.path.startswith('/api') and request.path != '/api/status':
         auth_header = request.headers.get('Authorization')
         if not auth_header or auth_header != f'Bearer {PASSWORD}':
-            app.logger.warning(f"Unauthorized access attempt. Expected: Bearer {PASSWORD}, Got: {auth_header}")
+            app.logger.warning("Unauthorized access attempt on %s from %s", request.path, request.remote_addr)
             return jsonify({'error': 'Unauthorized'}), 401
-    app.logger.info(f"Request: {request.method} {request.path}")
+    app.logger.info("Request: %s %s", request.method, request.path)
+
+# Filters accepted by the list routes, matched exactly against the fields of each item
+NODE_FILTERS = ('node', 'status')
+VM_FILTERS = ('vmid', 'name', 'status', 'template', 'lock')
+CLUSTER_VM_FILTERS = VM_FILTERS + ('node',)
+
+# Function to sort numbers before strings and missing values last, so mixed fields can be sorted
+def sort_value(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, value, '')
+    return (1, 0, str(value)) if value is not None else (2, 0, '')
+
+# Filter values matching items without the field, as Proxmox leaves out flags that aren't set, e.g. template
+MISSING_FIELD_VALUES = frozenset(('', '0', 'false'))
+
+# Function to filter, sort, page and project the items of a list route by the query parameters
+# fields, limit, offset, sort and the route's filters. A comma-separated filter value matches any of
+# its values. Returns (items, total) with the number of matches before paging, raises ValueError on
+# invalid parameters. Paged results are sorted by default_sort unless the client asks otherwise.
+def select_items(items, args, filters=(), default_sort=None):
+    for name in filters:
+        if name in args:
+            wanted = set(args[name].split(','))
+            match_missing = not wanted.isdisjoint(MISSING_FIELD_VALUES)
+            items = [item for item in items if (str(item[name]) in wanted if name in item else match_missing)]
+    total = len(items)
+    try:
+        offset = int(args.get('offset', 0))
+        limit = int(args.get('limit', total))
+    except ValueError:
+        raise ValueError('limit and offset must be integers')
+    if limit < 0 or offset < 0:
+        raise ValueError('limit and offset must not be negative')
+    sort = args.get('sort') or (default_sort if 'limit' in args or 'offset' in args else None)
+    if sort:
+        field = sort.lstrip('-')
+        items = sorted(items, key=lambda item: sort_value(item.get(field)), reverse=sort.startswith('-'))
+    items = items[offset:offset + limit]
+    if args.get('fields'):
+        fields = args['fields'].split(',')
+        items = [{field: item[field] for field in fields if field in item} for item in items]
+    return items, total
+
+# Function to build the JSON response of a list route, with the number of matching items in X-Total-Count
+def list_response(body, total):
+    response = jsonify(body)
+    response.headers['X-Total-Count'] = total
+    return response
+
+# Function to tag a response body with a strong ETag, and gzip it if the client accepts it and it is
+# large enough. Returns (body, headers), body is None if the client's If-None-Match already matches.
+# The ETag is a hash of the body unless the route already chose one, it is taken before compressing,
+# so a 304 costs no compression, and differs per encoding.
+def encode_body(data, accept_encoding, if_none_match, etag=None):
+    compress = len(data) >= GZIP_MIN_SIZE and parse_accept_header(accept_encoding)['gzip'] > 0
+    etag = (etag or hashlib.sha1(data).hexdigest()) + ('-gzip' if compress else '')
+    headers = {'ETag': quote_etag(etag)}
+    if parse_etags(if_none_match).contains_weak(etag):
+        return None, headers
+    if compress:
+        data = gzip.compress(data, GZIP_LEVEL, mtime=0)
+        headers['Content-Encoding'] = 'gzip'
+    return data, headers
+
+# Function to derive an ETag from the request's path and query string and the versions of the cached data
+# its response is built from. Returns None if there are none, or some data couldn't be loaded.
+def versioned_etag(full_path, versions):
+    if not versions or None in versions:
+        return None
+    return hashlib.sha1('\n'.join([full_path] + sorted(versions)).encode()).hexdigest()
+
+# Function to find a versioned ETag in If-None-Match, with or without the gzip suffix. Returns the form
+# the client sent, or None if it isn't there.
+def matching_etag(etag, if_none_match):
+    etags = parse_etags(if_none_match)
+    return next((tag for tag in (etag, etag + '-gzip') if etags.contains_weak(tag)), None)
+
+# Decorator for GET routes whose response only depends on cached Proxmox data and the request's path and
+# query string. Their ETag is derived from the versions of that data instead of hashing the body.
+def cache_versioned(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.cache_versions = []
+        response = make_response(f(*args, **kwargs))
+        etag = versioned_etag(request.full_path, g.cache_versions)
+        if etag and response.status_code == 200:
+            response.set_etag(etag)
+        return response
+    return decorated_function
+
+# Function to answer 304 Not Modified if the client already holds the version of the cached data read so far.
+# Routes call it before building their body, so a 304 costs no serialization. Returns None otherwise.
+def not_modified():
+    etag = versioned_etag(request.full_path, g.get('cache_versions'))
+    etag = etag and matching_etag(etag, request.headers.get('If-None-Match'))
+    if etag is None:
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    del response.headers['Content-Type']
+    return response
+
+# Conditional requests and compression for successful GET responses, streams are sent as they are
+@app.after_request
+def encode_get_response(response):
+    if request.method != 'GET' or response.status_code != 200 or response.is_streamed or response.direct_passthrough:
+        return response
+    etag = unquote_etag(response.headers['ETag'])[0] if 'ETag' in response.headers else None
+    body, headers = encode_body(response.get_data(), request.headers.get('Accept-Encoding'),
+                                request.headers.get('If-None-Match'), etag)
+    response.headers.update(headers)
+    response.vary.add('Accept-Encoding')
+    if body is None:
+        response.status_code = 304
+        body = b''
+        del response.headers['Content-Type']
+    response.set_data(body)
+    return response
+
+# Content types listed in the ISO catalog, and the filters its route accepts
+ISO_CONTENT_TYPES = ('iso', 'vztmpl')
+ISO_FILTERS = ('storage', 'content', 'format')
+
+# Catalog of the ISO images and container templates on every storage of every node, kept in memory
+# and refreshed in the background every CACHE_TTL_ISO seconds. Shared storages are listed from a
+# single node, and only storages whose content changed are re-indexed. A storage that can't be listed
+# keeps its previous content. Names are indexed in a sorted list for prefix search and by trigrams for
+# substring search.
+class IsoCatalog:
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.refreshed_at = None
+        self._storages = {}  # (storage, node or None if shared) -> nodes and {volid: item}
+        self._entries = {}  # volid -> entry
+        self._names = []  # sorted (lowercase name, volid)
+        self._trigrams = {}  # trigram -> volids
+        self._thread = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    # Start the background refresh, safe to call repeatedly
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._poll, name='iso-catalog', daemon=True)
+                self._thread.start()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                app.logger.error("Error refreshing ISO catalog: %s", e)
+
+    # Make sure the catalog was filled at least once, raises if Proxmox can't be reached for the first fill
+    def load(self):
+        self.start()
+        if self.refreshed_at is None:
+            with self._refresh_lock:
+                if self.refreshed_at is None:
+                    self._refresh()
+
+    def refresh(self):
+        with self._refresh_lock:
+            self._refresh()
+
+    # Function to list the active storages of a node that hold ISO images or templates
+    @staticmethod
+    def _node_storages(node):
+        response = proxmox.get(f"/nodes/{node}/storage")
+        response.raise_for_status()
+        return [storage for storage in response.json()['data']
+                if storage.get('active', 1) and set(storage.get('content', '').split(',')) & set(ISO_CONTENT_TYPES)]
+
+    # Function to list the ISO images and templates of a storage as {volid: item}
+    @staticmethod
+    def _storage_content(node, storage):
+        response = proxmox.get(f"/nodes/{node}/storage/{storage}/content")
+        response.raise_for_status()
+        return {item['volid']: item for item in response.json()['data'] if item.get('content') in ISO_CONTENT_TYPES}
 
-# New function to fetch ISO list
+    def _refresh(self):
+        node_storages, errors = fan_out_nodes(self._node_storages)
+        storages = {}  # key -> nodes
+        for node, node_storage_list in node_storages.items():
+            for storage in node_storage_list:
+                key = (storage['storage'], None if storage.get('shared') else node)
+                storages.setdefault(key, set()).add(node)
+        futures = {key: submit_in_context(cluster_executor, self._storage_content, min(nodes), key[0]) for key, nodes in storages.items()}
+        changed = {}
+        for key, future in futures.items():
+            try:
+                items = future.result()
+            except requests.exceptions.RequestException as e:
+                app.logger.error("Error listing content of storage %s: %s", key[0], e)
+                continue
+            current = self._storages.get(key)
+            if current is None or current['items'] != items or current['nodes'] != storages[key]:
+                changed[key] = {'nodes': storages[key], 'items': items}
+        # Storages of nodes that answered but no longer list them are dropped, others keep their content
+        removed = [key for key in self._storages
+                   if key not in storages and (key[1] in node_storages or key[1] is None and not errors)]
+        if changed or removed:
+            with self._lock:
+                self._apply(changed, removed)
+        self.refreshed_at = time.time()
+
+    # Must be called with the lock held
+    def _apply(self, changed, removed):
+        dirty = set()
+        for key in removed:
+            dirty.update(self._storages.pop(key)['items'])
+        for key, storage in changed.items():
+            dirty.update(self._storages.get(key, {}).get('items', ()))
+            dirty.update(storage['items'])
+            self._storages[key] = storage
+        for volid in dirty:
+            sources = [key for key, storage in self._storages.items() if volid in storage['items']]
+            if sources:
+                self._index(volid, sources)
+            else:
+                self._unindex(volid)
+
+    @staticmethod
+    def _trigrams_of(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    # Must be called with the lock held
+    def _index(self, volid, sources):
+        item = self._storages[sources[0]]['items'][volid]
+        name = volid.split('/', 1)[-1] if '/' in volid else volid.split(':', 1)[-1]
+        entry = {
+            'volid': volid,
+            'name': name,
+            'storage': sources[0][0],
+            'content': item.get('content'),
+            'format': item.get('format'),
+            'size': item.get('size'),
+            'ctime': item.get('ctime'),
+            'shared': any(key[1] is None for key in sources),
+            'nodes': sorted(set().union(*(self._storages[key]['nodes'] for key in sources))),
+        }
+        if volid not in self._entries:
+            bisect.insort(self._names, (name.lower(), volid))
+            for trigram in self._trigrams_of(name.lower()):
+                self._trigrams.setdefault(trigram, set()).add(volid)
+        self._entries[volid] = entry
+
+    # Must be called with the lock held
+    def _unindex(self, volid):
+        entry = self._entries.pop(volid, None)
+        if entry is None:
+            return
+        name = entry['name'].lower()
+        index = bisect.bisect_left(self._names, (name, volid))
+        if index < len(self._names) and self._names[index] == (name, volid):
+            del self._names[index]
+        for trigram in self._trigrams_of(name):
+            volids = self._trigrams.get(trigram)
+            if volids is not None:
+                volids.discard(volid)
+                if not volids:
+                    del self._trigrams[trigram]
+
+    # Function to search the catalog by name prefix and/or substring, node and size, in name order
+    def search(self, prefix=None, query=None, node=None, min_size=None, max_size=None):
+        with self._lock:
+            if prefix:
+                prefix = prefix.lower()
+                start = bisect.bisect_left(self._names, (prefix,))
+                names = []
+                for name, volid in self._names[start:]:
+                    if not name.startswith(prefix):
+                        break
+                    names.append((name, volid))
+            else:
+                names = self._names
+            if query:
+                query = query.lower()
+                if len(query) >= 3:
+                    volids = set.intersection(*(self._trigrams.get(trigram, set()) for trigram in self._trigrams_of(query)))
+                    names = [(name, volid) for name, volid in names if volid in volids and query in name]
+                else:
+                    names = [(name, volid) for name, volid in names if query in name]
+            entries = [self._entries[volid] for _, volid in names]
+        if node:
+            entries = [entry for entry in entries if node in entry['nodes']]
+        if min_size is not None:
+            entries = [entry for entry in entries if (entry['size'] or 0) >= min_size]
+        if max_size is not None:
+            entries = [entry for entry in entries if (entry['size'] or 0) <= max_size]
+        return entries
+
+    # Function to find the ISO images a create request refers to, by volid or by file name
+    def find(self, iso):
+        self.load()
+        with self._lock:
+            if ':' in iso:
+                entries = [self._entries[iso]] if iso in self._entries else []
+            else:
+                name = iso.lower()
+                start = bisect.bisect_left(self._names, (name,))
+                entries = []
+                for indexed_name, volid in self._names[start:]:
+                    if indexed_name != name:
+                        break
+                    if self._entries[volid]['name'] == iso:
+                        entries.append(self._entries[volid])
+        return [entry for entry in entries if entry['content'] == 'iso']
+
+iso_catalog = IsoCatalog(CACHE_TTL_ISO)
+
+# Function to answer an ISO list request from the catalog, returns (body, total). Only ISO images are
+# listed unless content is given, and only their volids unless fields are. Raises ValueError on invalid parameters.
+def iso_list(args):
+    args = {'content': 'iso', **args}
+    try:
+        min_size = int(args['min_size']) if 'min_size' in args else None
+        max_size = int(args['max_size']) if 'max_size' in args else None
+    except ValueError:
+        raise ValueError('min_size and max_size must be integers')
+    iso_catalog.load()
+    entries = iso_catalog.search(args.get('prefix'), args.get('q'), args.get('node'), min_size, max_size)
+    if 'fields' in args:
+        return select_items(entries, args, ISO_FILTERS)
+    entries, total = select_items(entries, args, ISO_FILTERS)
+    return [entry['volid'] for entry in entries], total
+
+# Route listing the ISO images of all storages and nodes, answered from the ISO catalog
 @app.route('/api/iso', methods=['GET'])
 @rate_limited
 def get_iso_list():
     try:
-        url = f"{PROXMOX_URL}/nodes/{NODE_NAME}/storage/local/content"
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        response = requests.get(url, headers=headers, verify=VERIFY_SSL)
-#        response = requests.get(url, verify=VERIFY_SSL)
-        response.raise_for_status()
-        iso_list = [iso['volid'] for iso in response.json()['data'] if iso['content'] == 'iso']
-        app.logger.debug(f"Fetched ISO list: {iso_list}")
-        return jsonify(iso_list)
+        return list_response(*iso_list(request.args.to_dict()))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error fetching ISO list: {e}")
-        return jsonify({'error': 'Failed to fetch ISO list'}), 500
+        app.logger.error("Error fetching ISO list: %s", e)
+        return upstream_error('Failed to fetch ISO list', e)
 
+# Route reporting the health of the API and of its connection to Proxmox. Answers 503 while the
+# Proxmox API itself is unreachable, individual unreachable nodes only make it 'degraded'.
 @app.route('/api/status', methods=['GET'])
 @rate_limited
 def status():
     app.logger.info("Status check")
-    return jsonify({'status': 'API is running'})
+    body, status_code = api_status()
+    return jsonify(body), status_code
+
+# Function to report the health of the connection to Proxmox, returns (body, status_code)
+def api_status():
+    health_probe.start()
+    circuits = circuit_breaker.snapshot()
+    reachable, checked_at = health_probe.last_result or (None, None)
+    if circuits.get(CLUSTER_CIRCUIT, {}).get('state') == 'open' or reachable is False:
+        proxmox_status, status_code = 'unavailable', 503
+    elif any(circuit['state'] != 'closed' for circuit in circuits.values()):
+        proxmox_status, status_code = 'degraded', 200
+    else:
+        proxmox_status, status_code = 'ok', 200
+    return {
+        'status': 'API is running',
+        'proxmox': {'status': proxmox_status, 'last_check': checked_at, 'circuits': circuits},
+    }, status_code
 
 @app.route('/api/create-vm', methods=['POST'])
-@rate_limited
+@rate_limited(per_minute=CREATE_VM_REQUESTS_PER_MINUTE, scope='create-vm')
 def handle_create_vm():
-    vm_data = request.json
-    app.logger.info(f"Create VM request with data: {vm_data}")
-    return create_vm(vm_data['name'], vm_data['iso'], 'basic')
+    vm_data = request.get_json(silent=True)
+    app.logger.info("Create VM request with data: %s", LogPayload(vm_data))
+    if not isinstance(vm_data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    return create_vm(vm_data.get('name'), vm_data.get('iso'), vm_data.get('tier', 'basic'),
+                     vm_data.get('node'), vm_data.get('placement'), vm_data.get('anti_affinity'))
 
-def can_create_vm(vm_memory_gb, vm_cpu_threads):
-    try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        url = f"{PROXMOX_URL}/nodes/{NODE_NAME}/qemu"
-        response = requests.get(url, headers=headers, verify=VERIFY_SSL)
+# Route for the progress of a background job
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@rate_limited
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': f'Job {job_id} not found'}), 404
+    return jsonify(job)
+
+# Define configurations for different tiers
+TIER_CONFIGURATIONS = {
+    'basic': {'cores': 1, 'memory': 1024, 'storage': 20, 'template': TIER_TEMPLATES.get('basic')},
+    'standard': {'cores': 2, 'memory': 4096, 'storage': 50, 'template': TIER_TEMPLATES.get('standard')},
+    'performance': {'cores': 3, 'memory': 6144, 'storage': 100, 'template': TIER_TEMPLATES.get('performance')}
+}
+
+# Per-node capacity and committed CPU, memory and disk, kept current by a background poller and by
+# our own writes, so admission checks are an in-memory lookup instead of an upstream call. Resources
+# reserved for VMs being created are kept in the reservation store, shared between worker processes
+# when they use the shared state database.
+class ResourceLedger:
+    def __init__(self, poll_interval, reservation_ttl, reservations):
+        self.poll_interval = poll_interval
+        self.reservation_ttl = reservation_ttl
+        self.reservations = reservations
+        self._nodes = {}  # node -> capacity, used totals and per-VM usage
+        self._dirty = set()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # Start the background poller, safe to call repeatedly
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._poll, name='resource-ledger', daemon=True)
+                self._thread.start()
+
+    def _poll(self):
+        next_refresh = time.monotonic() + self.poll_interval
+        while True:
+            self._wakeup.wait(max(0, next_refresh - time.monotonic()))
+            self._wakeup.clear()
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+            try:
+                # Nodes asked for in between don't postpone the full refresh, placement needs every node current
+                if time.monotonic() >= next_refresh:
+                    next_refresh = time.monotonic() + self.poll_interval
+                    self.refresh()
+                else:
+                    for node in dirty:
+                        self.refresh_node(node)
+            except Exception as e:
+                app.logger.error("Error refreshing resource ledger: %s", e)
+
+    # Function to fetch capacity and VM usage of a node from Proxmox
+    def _fetch_node(self, node):
+        response = proxmox.get(f"/nodes/{node}/status")
+        response.raise_for_status()
+        status = response.json()['data']
+        response = proxmox.get(f"/nodes/{node}/qemu")
         response.raise_for_status()
-        vms = response.json()['data']
+        vms = {int(vm['vmid']): (vm.get('cpus', vm.get('maxcpu', 0)), vm.get('maxmem', 0) / (1024**3),
+                                 vm.get('maxdisk', 0) / (1024**3), vm.get('name'))
+               for vm in response.json()['data']}
+        # Disk is only tracked if the node has the storage new VMs are placed on
+        response = proxmox.get(f"/nodes/{node}/storage/{VM_STORAGE}/status")
+        storage = response.json()['data'] if response.ok else {}
+        capacity = {
+            'cpu': status.get('cpuinfo', {}).get('cpus', TOTAL_CPU_THREADS),
+            'memory_gb': status.get('memory', {}).get('total', TOTAL_MEMORY_GB * 1024**3) / (1024**3),
+            'disk_gb': storage['total'] / (1024**3) if 'total' in storage else None,
+        }
+        return capacity, vms, storage.get('used', 0) / (1024**3)
+
+    # Committed CPU, memory and disk of a node's VMs. Disk counts the full size of the VM disks, thin-provisioned
+    # storage only reports the blocks written so far as used, or the storage's usage if that is higher.
+    @staticmethod
+    def _used(vms, storage_used_gb):
+        return [sum(usage[0] for usage in vms.values()), sum(usage[1] for usage in vms.values()),
+                max(storage_used_gb, sum(usage[2] for usage in vms.values()))]
+
+    def _apply(self, node, capacity, vms, storage_used_gb):
+        with self._lock:
+            entry = self._nodes.setdefault(node, {})
+            entry.update(capacity)
+            entry['vms'] = vms
+            entry['storage_used_gb'] = storage_used_gb
+            entry['used'] = self._used(vms, storage_used_gb)
+            entry['updated_at'] = time.monotonic()
+        # Reservations of VMs Proxmox now reports are counted as used
+        self.reservations.release_created(node, set(vms))
+
+    def refresh_node(self, node):
+        self._apply(node, *self._fetch_node(node))
+
+    def refresh(self):
+        results, errors = fan_out_nodes(self._fetch_node)
+        for node, snapshot in results.items():
+            self._apply(node, *snapshot)
+
+    # Ask the poller to refresh a node soon, e.g. after its VM configuration changed
+    def refresh_soon(self, node):
+        with self._lock:
+            self._dirty.add(node)
+        self._wakeup.set()
+
+    # Function to sum the active reservations per node, returns ({node: [cpu, memory_gb, disk_gb]}, {node: names})
+    def _reserved(self):
+        totals, names = {}, {}
+        for reservation in self.reservations.active():
+            node = reservation['node']
+            totals[node] = [reserved + amount for reserved, amount in zip(totals.get(node, (0, 0, 0)), reservation['resources'])]
+            names.setdefault(node, set()).add(reservation['name'])
+        return totals, names
+
+    # Must be called with the lock held
+    def _available(self, entry, reserved):
+        reserved = reserved or (0, 0, 0)
+        cpu = entry['cpu'] - PROXMOX_CPU_OVERHEAD_THREADS - entry['used'][0] - reserved[0]
+        memory_gb = entry['memory_gb'] - PROXMOX_MEMORY_OVERHEAD_GB - entry['used'][1] - reserved[1]
+        disk_gb = entry['disk_gb'] - entry['used'][2] - reserved[2] if entry['disk_gb'] is not None else None
+        return {'cpu': cpu, 'memory_gb': memory_gb, 'disk_gb': disk_gb}
+
+    # Returns why the resources don't fit into available, or None if they fit
+    @staticmethod
+    def _shortfall(available, cpu, memory_gb, disk_gb):
+        if memory_gb > available['memory_gb']:
+            return "Not enough available memory"
+        if cpu > available['cpu']:
+            return "Not enough available CPU"
+        if available['disk_gb'] is not None and disk_gb > available['disk_gb']:
+            return "Not enough available storage"
+        return None
 
-        # Get the total used resources
-        total_used_memory = 0
-        total_used_cpu = 0
+    # Reserve resources for a new VM on a given node, returns (ok, message, reservation_id)
+    def reserve(self, node, cpu, memory_gb, disk_gb, name=None):
+        self.start()
+        if node not in self._nodes:
+            self.refresh_node(node)
+        with self.reservations.transaction():
+            totals, _ = self._reserved()
+            with self._lock:
+                shortfall = self._shortfall(self._available(self._nodes[node], totals.get(node)), cpu, memory_gb, disk_gb)
+            if shortfall:
+                app.logger.info("%s on node %s", shortfall, node)
+                return False, shortfall, None
+            return True, "Sufficient resources available", self.reservations.add(node, (cpu, memory_gb, disk_gb), name, self.reservation_ttl)
 
-        for vm in vms:
-            total_used_memory += vm['maxmem'] / (1024**3)  # Convert from bytes to GB
-            total_used_cpu += vm['maxcpu']
+    # Must be called with the lock held. Lower scores are better: 'best-fit' packs VMs onto the node they
+    # leave the least free, 'spread' picks the node whose scarcest resource stays the most free.
+    def _placement_score(self, entry, available, cpu, memory_gb, disk_gb, policy):
+        free = [(available['cpu'] - cpu) / (entry['cpu'] or 1),
+                (available['memory_gb'] - memory_gb) / (entry['memory_gb'] or 1)]
+        if available['disk_gb'] is not None and entry['disk_gb']:
+            free.append((available['disk_gb'] - disk_gb) / entry['disk_gb'])
+        return sum(free) if policy == 'best-fit' else -min(free)
 
-        available_memory = TOTAL_MEMORY_GB - total_used_memory - PROXMOX_MEMORY_OVERHEAD_GB
-        available_cpu = TOTAL_CPU_THREADS - total_used_cpu - PROXMOX_CPU_OVERHEAD_THREADS
+    # Must be called with the lock held, counts the VMs on a node, created or reserved, named in anti_affinity
+    @staticmethod
+    def _affinity_conflicts(entry, reserved_names, anti_affinity):
+        names = {usage[3] for usage in entry['vms'].values()} | reserved_names
+        return sum(1 for hint in anti_affinity if hint in names or (str(hint).isdigit() and int(hint) in entry['vms']))
+
+    # Number of the VMs named in anti_affinity that run on a node
+    def affinity_conflicts(self, node, anti_affinity):
+        _, names = self._reserved()
+        with self._lock:
+            entry = self._nodes.get(node)
+            return self._affinity_conflicts(entry, names.get(node, set()), anti_affinity) if entry else 0
+
+    # Choose a node for a new VM and reserve its resources there, returns (ok, message, node, reservation_id).
+    # Nodes running any VM named in anti_affinity (names or IDs) are only used if no other node fits. Nodes
+    # whose circuit is open, or that the poller hasn't reached for a few intervals, are skipped. If nodes
+    # is given, only those nodes are considered.
+    def place(self, cpu, memory_gb, disk_gb, policy=PLACEMENT_POLICY, anti_affinity=(), name=None, nodes=None):
+        self.start()
+        if not self._nodes:
+            self.refresh()
+        unreachable = set(circuit_breaker.open_circuits())
+        with self.reservations.transaction():
+            totals, names = self._reserved()
+            with self._lock:
+                stale_before = time.monotonic() - 3 * self.poll_interval
+                candidates = []
+                for node, entry in self._nodes.items():
+                    if entry['updated_at'] < stale_before or node in unreachable or nodes is not None and node not in nodes:
+                        continue
+                    available = self._available(entry, totals.get(node))
+                    if self._shortfall(available, cpu, memory_gb, disk_gb):
+                        continue
+                    conflicts = self._affinity_conflicts(entry, names.get(node, set()), anti_affinity) if anti_affinity else 0
+                    score = self._placement_score(entry, available, cpu, memory_gb, disk_gb, policy)
+                    candidates.append((conflicts, score, node))
+            if not candidates:
+                app.logger.info("No node has enough available resources")
+                return False, "No node has enough available resources", None, None
+            _, _, node = min(candidates)
+            return True, f"Placed on node {node}", node, self.reservations.add(node, (cpu, memory_gb, disk_gb), name, self.reservation_ttl)
+
+    # Keep a reservation until the poller sees the VM it was made for
+    def commit(self, reservation_id, vmid):
+        self.reservations.commit(reservation_id, vmid)
+
+    # Give back a reservation whose VM was never created
+    def release(self, reservation_id):
+        if reservation_id is not None:
+            self.reservations.release(reservation_id)
+
+    # Stop counting the resources of a deleted VM without waiting for the next poll
+    def remove_vm(self, node, vmid):
+        with self._lock:
+            entry = self._nodes.get(node)
+            if entry and entry['vms'].pop(int(vmid), None):
+                entry['used'] = self._used(entry['vms'], entry['storage_used_gb'])
+
+reservations = SQLiteReservations() if SHARED_STATE_DB else MemoryReservations()
+resource_ledger = ResourceLedger(LEDGER_POLL_INTERVAL, LEDGER_RESERVATION_TTL, reservations)
+
+# Hands out VMIDs for new VMs. Proxmox's /cluster/nextid only knows VMs that already exist, so IDs
+# handed out but not yet created are leased locally to keep parallel creates from colliding.
+class VmidAllocator:
+    def __init__(self, leases, ttl):
+        self.leases = leases
+        self.ttl = ttl
+
+    def _is_free(self, vmid):
+        response = proxmox.get('/cluster/nextid', params={'vmid': vmid})
+        if response.status_code == 400:
+            return False
+        response.raise_for_status()
+        return True
+
+    # Returns a VMID that no other thread or worker holds, or None if none was found
+    def allocate(self):
+        response = proxmox.get('/cluster/nextid')
+        response.raise_for_status()
+        first = int(response.json()['data'])
+        for vmid in range(first, first + VMID_ALLOCATION_ATTEMPTS):
+            if self.leases.acquire(f"vmid:{vmid}", self.ttl):
+                # IDs after the one Proxmox suggested may be in use, ask Proxmox about them
+                if vmid == first or self._is_free(vmid):
+                    return vmid
+                self.leases.release(f"vmid:{vmid}")
+        return None
 
-        if vm_memory_gb > available_memory:
-            app.logger.info("Not enough available memory.")
-            return False, "Not enough available memory"
+    def release(self, vmid):
+        self.leases.release(f"vmid:{vmid}")
 
-        if vm_cpu_threads > available_cpu:
-            app.logger.info("Not enough available CPU.")
-            return False, "Not enough available CPU"
+vmid_allocator = VmidAllocator(leases, VMID_RESERVATION_TTL)
 
-        return True, "Sufficient resources available"
+# Function to allocate a VMID for a new VM, returns None if none could be allocated
+def allocate_vmid():
+    try:
+        return vmid_allocator.allocate()
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error checking resources for VM creation: {e}")
-        return False, str(e)
-
-def create_vm(name, iso, tier):
-    # Define configurations for different tiers
-    tier_configurations = {
-        'basic': {'cores': 1, 'memory': 1024, 'storage': 20},
-        'standard': {'cores': 2, 'memory': 4096, 'storage': 50},
-        'performance': {'cores': 3, 'memory': 6144, 'storage': 100}
-    }
+        app.logger.error("Error allocating VMID: %s", e)
+        return None
 
+# Function to reserve the resources of a tier, on the given node or on the node the placement policy
+# chooses, returns (ok, message, node, reservation_id)
+def can_create_vm(node, tier_config, policy=PLACEMENT_POLICY, anti_affinity=(), name=None, nodes=None):
+    resources = (tier_config['cores'], tier_config['memory'] / 1024, tier_config['storage'])
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        node = NODE_NAME
-        url = f"{PROXMOX_URL}/nodes/{node}/qemu"
-
-        # Generate VM ID dynamically by finding the highest existing ID and incrementing it
-        existing_vms = get_existing_vms(node)
-        highest_id = max(existing_vms) if existing_vms else 101  # Start with 101 if no existing VMs
-        vmid = highest_id + 1
-
-        # Get configuration for the specified tier
-        tier_config = tier_configurations.get(tier.lower())
-        if not tier_config:
-            return jsonify({'error': 'Invalid tier'})
-
-        # Check if there are enough resources to create the VM
-        can_create, message = can_create_vm(tier_config['memory'] / 1024, tier_config['cores'])
-        if not can_create:
-            return jsonify({'error': message}), 400
-
-        params = {
-            'vmid': vmid,
-            'name': name,
-            'ide2': f'local:iso/{iso},media=cdrom',
-            'sockets': 1,
-            'cores': tier_config['cores'],
-            'memory': tier_config['memory'],
-            'net0': 'e1000,bridge=vmbr1'
-        }
+        if node:
+            ok, message, reservation = resource_ledger.reserve(node, *resources, name=name)
+            return ok, message, node, reservation
+        return resource_ledger.place(*resources, policy=policy, anti_affinity=anti_affinity, name=name, nodes=nodes)
+    except CircuitOpenError:
+        raise
+    except requests.exceptions.RequestException as e:
+        app.logger.error("Error checking resources for VM creation: %s", e)
+        return False, str(e), None, None
+
+# Bounded queue of background jobs run by a small pool of worker threads, so slow Proxmox tasks
+# don't tie up request threads. Submitting fails instead of blocking once the queue is full.
+class JobQueue:
+    def __init__(self, store, workers, max_queued):
+        self.store = store
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    # Start the worker threads, safe to call repeatedly
+    def start(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f'job-worker-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    # Queue func(job_id, *args), returns the job or None if the queue is full
+    def submit(self, job_type, func, *args):
+        self.start()
+        now = time.time()
+        job = {'id': uuid.uuid4().hex, 'type': job_type, 'status': 'queued', 'progress': 'Queued',
+               'result': None, 'error': None, 'created_at': now, 'updated_at': now}
+        self.store.save(job)
+        try:
+            self._queue.put_nowait((job['id'], func, args, request_id_var.get()))
+        except queue.Full:
+            self.update(job['id'], status='rejected', error='Job queue is full')
+            return None
+        return job
+
+    # Save a job that already succeeded, for work done in the request, returns the job
+    def record(self, job_type, result):
+        now = time.time()
+        job = {'id': uuid.uuid4().hex, 'type': job_type, 'status': 'succeeded', 'progress': 'Done',
+               'result': result, 'error': None, 'created_at': now, 'updated_at': now}
+        self.store.save(job)
+        return job
+
+    def update(self, job_id, **fields):
+        job = self.store.load(job_id)
+        if job:
+            job.update(fields, updated_at=time.time())
+            self.store.save(job)
+
+    def get(self, job_id):
+        return self.store.load(job_id)
+
+    def _work(self):
+        while True:
+            job_id, func, args, request_id = self._queue.get()
+            # Log under the ID of the request that queued the job
+            token = request_id_var.set(request_id)
+            self.update(job_id, status='running', progress='Started')
+            try:
+                self.update(job_id, status='succeeded', progress='Done', result=func(job_id, *args))
+            except Exception as e:
+                app.logger.error("Job %s failed: %s", job_id, e)
+                self.update(job_id, status='failed', error=str(e))
+            finally:
+                request_id_var.reset(token)
+                self._queue.task_done()
+
+job_store = SQLiteJobStore(JOB_RETENTION) if SHARED_STATE_DB else MemoryJobStore(JOB_RETENTION)
+
+# Metric values of this process only
+class MemoryMetrics:
+    def start(self):
+        pass
+
+    def reset(self):
+        pass
+
+    # Return metric name -> [snapshot]
+    def collect(self):
+        return {metric.name: [metric.snapshot()] for metric in METRICS}
+
+# Metric values of every worker process, stored in the shared state database so whichever worker a scrape
+# lands on answers with the totals. Each process publishes its values every interval seconds and when it
+# answers a scrape. Counters of processes that stopped are kept so totals don't go backwards, their gauges
+# are dropped once they are stale.
+class SQLiteMetrics:
+    def __init__(self, interval):
+        self.interval = interval
+        self._process = None  # (pid, ID of this process in the metrics table)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # Start publishing this process's values, cheap enough to call on every request
+    def start(self):
+        if not METRICS_ENABLED or self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._publish_loop, name='metrics-publisher', daemon=True)
+                self._thread.start()
+
+    def _publish_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.publish()
+            except sqlite3.Error as e:
+                app.logger.error("Error publishing metrics: %s", e)
+
+    # The ID changes after a fork, a process reusing the PID of a stopped one must not overwrite its counters
+    def _process_id(self):
+        if self._process is None or self._process[0] != os.getpid():
+            self._process = (os.getpid(), uuid.uuid4().hex)
+        return self._process[1]
+
+    def publish(self):
+        process, now = self._process_id(), time.time()
+        rows = [(process, metric.name, json.dumps(list(metric.snapshot().items())), now) for metric in METRICS]
+        conn = shared_state_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT OR REPLACE INTO metrics (process, name, data, updated_at) VALUES (?, ?, ?, ?)', rows)
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+
+    # Drop the values of processes from an earlier run, called before the workers start
+    def reset(self):
+        shared_state_connection().execute('DELETE FROM metrics')
 
-        app.logger.debug(f"Sending request to Proxmox: {url} with params: {params}")
-        response = requests.post(url, headers=headers, json=params, verify=VERIFY_SSL)
+    def collect(self):
+        self.publish()
+        gauges = {metric.name for metric in METRICS if isinstance(metric, Gauge)}
+        stale_before = time.time() - 3 * self.interval
+        snapshots = {}
+        for name, data, updated_at in shared_state_connection().execute('SELECT name, data, updated_at FROM metrics'):
+            if name in gauges and updated_at < stale_before:
+                continue
+            snapshots.setdefault(name, []).append({tuple(label_values): value for label_values, value in json.loads(data)})
+        return snapshots
+
+metrics_store = SQLiteMetrics(METRICS_PUBLISH_INTERVAL) if SHARED_STATE_DB else MemoryMetrics()
+job_queue = JobQueue(job_store, JOB_WORKERS, JOB_QUEUE_SIZE)
+
+# Function to wait for a Proxmox task to finish, returns its final status
+def wait_for_task(node, upid):
+    deadline = time.monotonic() + TASK_TIMEOUT
+    while True:
+        response = proxmox.get(f"/nodes/{node}/tasks/{upid}/status")
         response.raise_for_status()
+        task = response.json()['data']
+        if task.get('status') == 'stopped':
+            return task
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Task {upid} did not finish within {TASK_TIMEOUT:.0f} seconds")
+        time.sleep(TASK_POLL_INTERVAL)
 
-        # Set VM to start on boot
-        vm_settings(node, vmid)
+# Function to wait for the Proxmox task creating a VM. If it fails or times out, the VM's reservation and VMID
+# lease are given back right away instead of blocking capacity and the VMID until they expire. A VM whose task
+# is still running is counted by the ledger once Proxmox lists it.
+def wait_for_create_task(node, upid, vmid, reservation):
+    try:
+        task = wait_for_task(node, upid)
+        if task.get('exitstatus') != 'OK':
+            raise RuntimeError(f"Proxmox task {upid} failed: {task.get('exitstatus')}")
+    except Exception:
+        resource_ledger.release(reservation)
+        vmid_allocator.release(vmid)
+        resource_ledger.refresh_soon(node)
+        raise
 
-        app.logger.debug(f"Proxmox response: {response.status_code}, {response.text}")
-        return jsonify(response.json())
+# Function to validate a create request and queue it, returns (response body, status code)
+def submit_create_vm(name, iso, tier, node=None, policy=None, anti_affinity=None):
+    if not isinstance(name, str) or not name:
+        return {'error': 'name must be a non-empty string'}, 400
+    if not isinstance(tier, str):
+        return {'error': 'tier must be a string'}, 400
+    # Get configuration for the specified tier
+    tier_config = TIER_CONFIGURATIONS.get(tier.lower())
+    if not tier_config:
+        return {'error': 'Invalid tier'}, 400
+
+    policy = policy or PLACEMENT_POLICY
+    if policy not in PLACEMENT_POLICIES:
+        return {'error': f"Invalid placement, use one of {', '.join(PLACEMENT_POLICIES)}"}, 400
+    anti_affinity = anti_affinity or []
+    if not isinstance(anti_affinity, list):
+        return {'error': 'anti_affinity must be a list of VM names or IDs'}, 400
+    if not iso:
+        return submit_clone_vm(name, tier, tier_config, node, policy, anti_affinity)
+
+    # The ISO is looked up in the catalog, by volid or file name, and limits placement to the nodes that can reach it
+    try:
+        isos = iso_catalog.find(iso)
+    except CircuitOpenError as e:
+        return {'error': str(e)}, 503
+    except requests.exceptions.RequestException as e:
+        app.logger.error("Error loading ISO catalog: %s", e)
+        return {'error': 'Failed to fetch ISO list'}, 500
+    if not isos:
+        return {'error': f'ISO {iso} not found'}, 400
+    iso_nodes = set().union(*(entry['nodes'] for entry in isos))
+    if node and node not in iso_nodes:
+        return {'error': f'ISO {iso} is not available on node {node}'}, 400
+
+    # Check if there are enough resources to create the VM, choosing a node unless one was given
+    try:
+        can_create, message, node, reservation = can_create_vm(node, tier_config, policy, anti_affinity, name, iso_nodes)
+    except CircuitOpenError as e:
+        return {'error': str(e)}, 503
+    if not can_create:
+        return {'error': message}, 400
+    iso_volid = next(entry['volid'] for entry in isos if node in entry['nodes'])
+
+    job = job_queue.submit('create-vm', provision_vm, node, name, iso_volid, tier_config, reservation)
+    if job is None:
+        resource_ledger.release(reservation)
+        return {'error': 'Too many VMs are being created, please try again later.'}, 503
+    return create_job_accepted(name, job, node, 'iso')
+
+# Function to create a VM from its tier's template, taking a clone from the clone pool if one is free and
+# queueing a new linked clone otherwise. Returns (response body, status code).
+def submit_clone_vm(name, tier, tier_config, node, policy, anti_affinity):
+    template = tier_config.get('template')
+    if not template:
+        return {'error': f'Tier {tier} has no template, an iso is required'}, 400
+    try:
+        pooled = clone_pool.take(tier, tier_config, name, node, anti_affinity)
+    except CircuitOpenError as e:
+        return {'error': str(e)}, 503
+    except requests.exceptions.RequestException as e:
+        app.logger.error("Error taking a clone from the pool of tier %s: %s", tier, e)
+        return {'error': 'Failed to configure pooled VM'}, 500
+    if pooled:
+        # The clone is handed out in this request, the job only records the result for status_url
+        job = job_queue.record('create-vm', dict(pooled, source='pool'))
+        body, _ = create_job_accepted(name, job, pooled['node'], 'pool')
+        return dict(body, vmid=pooled['vmid']), 201
+
+    try:
+        # Linked clones are created on a node holding the template
+        templates = find_templates(template)
+        if not templates:
+            return {'error': f'Template {template} not found'}, 400
+        if node and node not in templates:
+            return {'error': f'Template {template} is not available on node {node}'}, 400
+        can_create, message, node, reservation = can_create_vm(node, tier_config, policy, anti_affinity, name, set(templates))
+    except CircuitOpenError as e:
+        return {'error': str(e)}, 503
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error creating VM: {e}")
-        return jsonify({'error': str(e)}), 500
+        app.logger.error("Error preparing clone of template %s: %s", template, e)
+        return {'error': 'Failed to fetch VM inventory'}, 500
+    if not can_create:
+        return {'error': message}, 400
+
+    job = job_queue.submit('create-vm', provision_clone, node, templates[node], name, tier_config, reservation)
+    if job is None:
+        resource_ledger.release(reservation)
+        return {'error': 'Too many VMs are being created, please try again later.'}, 503
+    return create_job_accepted(name, job, node, 'clone')
+
+# Function to build the response to a queued create request, source is 'iso', 'clone' or 'pool'
+def create_job_accepted(name, job, node, source):
+    app.logger.info("Creation of VM %s from %s is job %s", name, source, job['id'])
+    return {'job_id': job['id'], 'status': job['status'], 'node': node, 'source': source,
+            'status_url': f"/api/jobs/{job['id']}"}, 202
+
+def create_vm(name, iso, tier, node=None, policy=None, anti_affinity=None):
+    body, status_code = submit_create_vm(name, iso, tier, node, policy, anti_affinity)
+    response = jsonify(body)
+    if status_code == 503:
+        response.headers['Retry-After'] = str(RETRY_INTERVAL)
+    return response, status_code
+
+# Function run by a job worker to create a VM, returns the job result
+def provision_vm(job_id, node, name, iso_volid, tier_config, reservation):
+    vmid = allocate_vmid()
+    if vmid is None:
+        resource_ledger.release(reservation)
+        raise RuntimeError('Failed to allocate a VMID')
+
+    path = f"/nodes/{node}/qemu"
+    params = {
+        'vmid': vmid,
+        'name': name,
+        'ide2': f'{iso_volid},media=cdrom',
+        'sockets': 1,
+        'cores': tier_config['cores'],
+        'memory': tier_config['memory'],
+        'net0': 'e1000,bridge=vmbr1'
+    }
+
+    job_queue.update(job_id, progress='Creating VM', result={'node': node, 'vmid': vmid})
+    app.logger.debug("Sending request to Proxmox: %s with params: %s", path, LogPayload(params))
+    try:
+        response = proxmox.post(path, json=params)
+        invalidate_vm_cache(node)
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        resource_ledger.release(reservation)
+        vmid_allocator.release(vmid)
+        raise
+    resource_ledger.commit(reservation, vmid)
+    upid = response.json()['data']
+
+    job_queue.update(job_id, progress='Waiting for Proxmox task', result={'node': node, 'vmid': vmid, 'upid': upid})
+    wait_for_create_task(node, upid, vmid, reservation)
+
+    # Set VM to start on boot
+    job_queue.update(job_id, progress='Configuring VM')
+    vm_settings(node, vmid)
+    return {'node': node, 'vmid': vmid, 'upid': upid}
 
 # Function to set VM to start on boot
 def vm_settings(node, vmid):
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        url = f"{PROXMOX_URL}/nodes/{node}/qemu/{vmid}/config"
+        path = f"/nodes/{node}/qemu/{vmid}/config"
         params = {'onboot': 1,
                   'autostart': 1,
                   
                  }
-        response = requests.put(url, headers=headers, json=params, verify=VERIFY_SSL)
+        response = proxmox.put(path, json=params)
+        invalidate_vm_cache(node, vmid)
         response.raise_for_status()
-        app.logger.info(f"Set VM {vmid} to start on boot.")
+        app.logger.info("Set VM %s to start on boot.", vmid)
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error setting start on boot for VM {vmid} on node {node}: {e}")
+        app.logger.error("Error setting start on boot for VM %s on node %s: %s", vmid, node, e)
+
+# Function to list the VMs of every online node, returns ({node: [vm, ...]}, errors)
+def cluster_vm_inventory():
+    return fan_out_nodes(lambda node: cached_get(('vms', node), CACHE_TTL_VMS, f"/nodes/{node}/qemu"))
+
+# Function to find the copies of a template, by VM name or ID, returns {node: vmid}
+def find_templates(template):
+    inventory, _ = cluster_vm_inventory()
+    return {node: int(vm['vmid']) for node, vms in inventory.items() for vm in vms
+            if vm.get('template') and str(template) in (str(vm['vmid']), vm.get('name'))}
+
+# Disk options of a VM configuration, in the order their buses are preferred as boot disk
+DISK_BUSES = ('scsi', 'virtio', 'sata', 'ide')
+DISK_KEY = re.compile(r'(scsi|virtio|sata|ide)(\d+)')
+DISK_SIZE = re.compile(r'(?:^|,)size=(\d+(?:\.\d+)?)([KMGT]?)')
+DISK_UNITS_GB = {'K': 1 / 1024**2, 'M': 1 / 1024, 'G': 1, 'T': 1024, '': 1 / 1024**3}
+
+# Function to get the boot disk of a VM configuration and its size in GB, returns (None, None) if it has none
+def boot_disk(config):
+    disks = []
+    for key, value in config.items():
+        key_match, size_match = DISK_KEY.fullmatch(key), DISK_SIZE.search(str(value))
+        if key_match and size_match and 'media=cdrom' not in str(value):
+            size_gb = float(size_match.group(1)) * DISK_UNITS_GB[size_match.group(2)]
+            disks.append((DISK_BUSES.index(key_match.group(1)), int(key_match.group(2)), key, size_gb))
+    if not disks:
+        return None, None
+    _, _, key, size_gb = min(disks)
+    return key, size_gb
 
-# Function to get existing VMs on the node
-def get_existing_vms(node):
+# Function to apply a tier's cores, memory and disk size to a VM. onboot is only set for VMs handed to users:
+# pooled clones started by a node reboot would leave the pool and never be handed out. Disks are only grown,
+# Proxmox can't shrink them.
+def configure_vm(node, vmid, tier_config, name=None, onboot=True):
+    path = f"/nodes/{node}/qemu/{vmid}"
+    params = {'cores': tier_config['cores'], 'memory': tier_config['memory'], 'onboot': 1 if onboot else 0}
+    if name:
+        params['name'] = name
+    response = proxmox.put(f"{path}/config", json=params)
+    invalidate_vm_cache(node, vmid)
+    response.raise_for_status()
+    response = proxmox.get(f"{path}/config")
+    response.raise_for_status()
+    disk, size_gb = boot_disk(response.json()['data'])
+    if disk and size_gb < tier_config['storage']:
+        response = proxmox.put(f"{path}/resize", json={'disk': disk, 'size': f"{tier_config['storage']}G"})
+        response.raise_for_status()
+    resource_ledger.refresh_soon(node)
+
+# Function to create a VM as a linked clone of a template on the node holding it, and size it for its tier.
+# report(progress, result) is called as the clone advances. Returns {'node', 'vmid', 'upid'}.
+def clone_vm(node, template_vmid, name, tier_config, reservation, report=lambda progress, result: None, onboot=True):
+    vmid = allocate_vmid()
+    if vmid is None:
+        resource_ledger.release(reservation)
+        raise RuntimeError('Failed to allocate a VMID')
+
+    report('Cloning template', {'node': node, 'vmid': vmid})
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        url = f"{PROXMOX_URL}/nodes/{node}/qemu"
-        response = requests.get(url, headers=headers, verify=VERIFY_SSL)
+        response = proxmox.post(f"/nodes/{node}/qemu/{template_vmid}/clone", json={'newid': vmid, 'name': name, 'full': 0})
+        invalidate_vm_cache(node)
         response.raise_for_status()
-        vms = response.json()['data']
-        existing_ids = [int(vm['vmid']) for vm in vms]
-        return existing_ids
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error fetching VMs on node {node}: {e}")
-        return []
+    except requests.exceptions.RequestException:
+        resource_ledger.release(reservation)
+        vmid_allocator.release(vmid)
+        raise
+    resource_ledger.commit(reservation, vmid)
+    upid = response.json()['data']
+
+    report('Waiting for Proxmox task', {'node': node, 'vmid': vmid, 'upid': upid})
+    wait_for_create_task(node, upid, vmid, reservation)
+
+    report('Configuring VM', {'node': node, 'vmid': vmid, 'upid': upid})
+    configure_vm(node, vmid, tier_config, onboot=onboot)
+    return {'node': node, 'vmid': vmid, 'upid': upid}
+
+# Job provisioning a VM from its tier's template
+def provision_clone(job_id, node, template_vmid, name, tier_config, reservation):
+    report = lambda progress, result: job_queue.update(job_id, progress=progress, result=result)
+    return dict(clone_vm(node, template_vmid, name, tier_config, reservation, report), source='clone')
+
+# Pool of stopped linked clones per tier, named CLONE_POOL_NAME_PREFIX + tier, that create requests take
+# instead of cloning. Membership is read from the Proxmox inventory, so all worker processes share the
+# pool, and a short lease on the VMID keeps two requests from taking the same clone while it is renamed.
+# A background thread tops the pool up every CLONE_POOL_INTERVAL seconds, and soon after a clone is taken.
+# Leases must be shared between processes when several serve requests, see use_shared_state.
+class ClonePool:
+    def __init__(self, sizes, interval, leases, take_ttl, refill_ttl):
+        self.sizes = sizes  # tier -> number of clones to keep
+        self.interval = interval
+        self.leases = leases
+        self.take_ttl = take_ttl  # in seconds, how long a clone may take to check and configure
+        self.refill_ttl = refill_ttl  # in seconds, how long one clone may take to create
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # Start the background refill if any tier has a pool, safe to call repeatedly
+    def start(self):
+        if not any(self.sizes.values()):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._poll, name='clone-pool', daemon=True)
+                self._thread.start()
+
+    def _poll(self):
+        while True:
+            try:
+                self.refill()
+            except Exception as e:
+                app.logger.error("Error refilling clone pool: %s", e)
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def refill_soon(self):
+        self._wakeup.set()
+
+    # Function to list the pooled clones of a tier as [(node, vmid)]. Clones still being created are locked.
+    def members(self, tier):
+        inventory, _ = cluster_vm_inventory()
+        return [(node, int(vm['vmid'])) for node, vm in self._clones(inventory, tier) if not vm.get('lock')]
+
+    # Function to count the clones of a tier, those being created included, from inventory read from Proxmox now
+    # rather than from the cache, so clones another worker process just added are seen. Returns None if a node
+    # couldn't be listed, as its clones can't be counted.
+    def count(self, tier):
+        for node in cached_get(('nodes',), CACHE_TTL_NODES, "/nodes"):
+            invalidate_vm_cache(node['node'])
+        inventory, errors = cluster_vm_inventory()
+        if errors:
+            return None
+        return len(self._clones(inventory, tier))
+
+    @staticmethod
+    def _clones(inventory, tier):
+        name = f"{CLONE_POOL_NAME_PREFIX}{tier}"
+        return [(node, vm) for node, vms in inventory.items() for vm in vms
+                if vm.get('name') == name and vm.get('status') == 'stopped' and not vm.get('template')]
+
+    # Take a pooled clone of a tier, on the given node if any and away from the VMs in anti_affinity, and
+    # give it the name and configuration of the new VM. Returns {'node', 'vmid'}, or None if the pool has
+    # no suitable clone.
+    def take(self, tier, tier_config, name, node=None, anti_affinity=()):
+        if not self.sizes.get(tier):
+            return None
+        self.start()
+        unreachable = set(circuit_breaker.open_circuits())
+        for vm_node, vmid in self.members(tier):
+            if node and vm_node != node or vm_node in unreachable:
+                continue
+            if anti_affinity and resource_ledger.affinity_conflicts(vm_node, anti_affinity):
+                continue
+            # Held while the clone is checked and renamed, once renamed it has left the pool
+            if not self.leases.acquire(f"pool-vm:{vmid}", self.take_ttl):
+                continue
+            try:
+                if not self._is_pooled(vm_node, vmid, tier):
+                    continue
+                configure_vm(vm_node, vmid, tier_config, name)
+            finally:
+                self.release(vmid)
+            self.refill_soon()
+            app.logger.info("Took VM %s on node %s from the clone pool of tier %s", vmid, vm_node, tier)
+            return {'node': vm_node, 'vmid': vmid}
+        return None
+
+    # Function to check that a clone is still in the pool of a tier. The inventory members() reads may be
+    # cached from before another worker process handed the clone out and released its lease.
+    @staticmethod
+    def _is_pooled(node, vmid, tier):
+        response = proxmox.get(f"/nodes/{node}/qemu/{vmid}/status/current")
+        if response.status_code != 200:
+            return False
+        vm = response.json()['data']
+        return vm.get('name') == f"{CLONE_POOL_NAME_PREFIX}{tier}" and vm.get('status') == 'stopped' and not vm.get('lock')
+
+    def release(self, vmid):
+        self.leases.release(f"pool-vm:{vmid}")
+
+    # Clone templates until every pool is full. Clones are added one at a time under a lease, after counting
+    # the pool again, so only one worker process refills at a time and none adds a clone another already added.
+    def refill(self):
+        for tier, size in self.sizes.items():
+            tier_config = TIER_CONFIGURATIONS.get(tier)
+            if not tier_config or not tier_config.get('template'):
+                continue
+            while self._add_clone(tier, size, tier_config):
+                pass
+
+    # Add one clone to the pool of a tier if it is short of size, returns whether a clone was added
+    def _add_clone(self, tier, size, tier_config):
+        if not self.leases.acquire('clone-pool:refill', self.refill_ttl):
+            return False
+        try:
+            count = self.count(tier)
+            if count is None:
+                app.logger.warning("Not refilling clone pool of tier %s: not every node could be listed", tier)
+                return False
+            if count >= size:
+                return False
+            templates = find_templates(tier_config['template'])
+            if not templates:
+                app.logger.warning("Not refilling clone pool of tier %s: template %s not found", tier, tier_config['template'])
+                return False
+            ok, message, node, reservation = can_create_vm(None, tier_config, nodes=set(templates))
+            if not ok:
+                app.logger.warning("Not refilling clone pool of tier %s: %s", tier, message)
+                return False
+            result = clone_vm(node, templates[node], f"{CLONE_POOL_NAME_PREFIX}{tier}", tier_config, reservation, onboot=False)
+            app.logger.info("Added VM %s on node %s to the clone pool of tier %s", result['vmid'], node, tier)
+            return True
+        finally:
+            self.leases.release('clone-pool:refill')
+
+# Taking a clone makes four Proxmox calls. Adding a clone waits on one clone task and makes about ten other calls.
+clone_pool = ClonePool(CLONE_POOL_SIZES, CLONE_POOL_INTERVAL, leases,
+                       4 * (PROXMOX_CONNECT_TIMEOUT + PROXMOX_READ_TIMEOUT),
+                       TASK_TIMEOUT + 10 * (PROXMOX_CONNECT_TIMEOUT + PROXMOX_READ_TIMEOUT))
 
 # Route for listing nodes
 @app.route('/api/nodes', methods=['GET'])
 @rate_limited
+@cache_versioned
 def get_nodes():
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        url = f"{PROXMOX_URL}/nodes"
-        response = requests.get(url, headers=headers, verify=VERIFY_SSL)
-        response.raise_for_status()
-        nodes = response.json()['data']
-        app.logger.debug(f"Fetched nodes: {nodes}")
-        return jsonify(nodes)
+        path = "/nodes"
+        nodes = cached_get(('nodes',), CACHE_TTL_NODES, path)
+        app.logger.debug("Fetched nodes: %s", LogPayload(nodes))
+        return not_modified() or list_response(*select_items(nodes, request.args, NODE_FILTERS, 'node'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error fetching nodes: {e}")
-        return jsonify({'error': 'Failed to fetch nodes'}), 500
+        app.logger.error("Error fetching nodes: %s", e)
+        return upstream_error('Failed to fetch nodes', e)
 
 # Route for listing VMs on a node
 @app.route('/api/nodes/<node>/qemu', methods=['GET'])
 @rate_limited
+@cache_versioned
 def get_vms(node):
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        url = f"{PROXMOX_URL}/nodes/{node}/qemu"
-        response = requests.get(url, headers=headers, verify=VERIFY_SSL)
-        response.raise_for_status()
-        vms = response.json()['data']
-        app.logger.debug(f"Fetched VMs for node {node}: {vms}")
-        return jsonify(vms)
+        path = f"/nodes/{node}/qemu"
+        vms = cached_get(('vms', node), CACHE_TTL_VMS, path)
+        app.logger.debug("Fetched VMs for node %s: %s", node, LogPayload(vms))
+        return not_modified() or list_response(*select_items(vms, request.args, VM_FILTERS, 'vmid'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error fetching VMs on node {node}: {e}")
-        return jsonify({'error': f'Failed to fetch VMs on node {node}'}), 500
+        app.logger.error("Error fetching VMs on node %s: %s", node, e)
+        return upstream_error(f'Failed to fetch VMs on node {node}', e)
 
 @app.route('/api/nodes/<node>/qemu/<vmid>/status', methods=['GET'])
 @rate_limited
+@cache_versioned
 def get_vm_status(node, vmid):
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        url = f"{PROXMOX_URL}/nodes/{node}/qemu/{vmid}/status/current"
-        response = requests.get(url, headers=headers, verify=VERIFY_SSL)
-        response.raise_for_status()
-        status = response.json()['data']
-        app.logger.debug(f"Fetched status for VM {vmid} on node {node}: {status}")
-        return jsonify(status)
+        path = f"/nodes/{node}/qemu/{vmid}/status/current"
+        status = cached_get(('vm_status', node, vmid), CACHE_TTL_VM_STATUS, path)
+        app.logger.debug("Fetched status for VM %s on node %s: %s", vmid, node, LogPayload(status))
+        return not_modified() or jsonify(status)
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error fetching status for VM {vmid} on node {node}: {e}")
-        return jsonify({'error': f'Failed to fetch status for VM {vmid} on node {node}'}), 500
+        app.logger.error("Error fetching status for VM %s on node %s: %s", vmid, node, e)
+        return upstream_error(f'Failed to fetch status for VM {vmid} on node {node}', e)
 
 @app.route('/api/nodes/<node>/qemu/<vmid>/config', methods=['POST'])
 @rate_limited
 def update_vm_config(node, vmid):
     config_data = request.json
-    app.logger.info(f"Update config for VM {vmid} on node {node} with data: {config_data}")
+    app.logger.info("Update config for VM %s on node %s with data: %s", vmid, node, LogPayload(config_data))
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        url = f"{PROXMOX_URL}/nodes/{node}/qemu/{vmid}/config"
-        response = requests.put(url, headers=headers, json=config_data, verify=VERIFY_SSL)
+        path = f"/nodes/{node}/qemu/{vmid}/config"
+        response = proxmox.put(path, json=config_data)
+        invalidate_vm_cache(node, vmid)
+        resource_ledger.refresh_soon(node)
         response.raise_for_status()
-        app.logger.debug(f"Updated config for VM {vmid} on node {node}: {response.json()}")
+        app.logger.debug("Updated config for VM %s on node %s: %s", vmid, node, LogPayload(response.json()))
         return jsonify(response.json())
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error updating config for VM {vmid} on node {node}: {e}")
-        return jsonify({'error': f'Failed to update config for VM {vmid} on node {node}'}), 500
+        app.logger.error("Error updating config for VM %s on node %s: %s", vmid, node, e)
+        return upstream_error(f'Failed to update config for VM {vmid} on node {node}', e)
 
 # Route for starting a VM
 @app.route('/api/nodes/<node>/qemu/<vmid>/status/start', methods=['POST'])
 @rate_limited
 def start_vm(node, vmid):
-    app.logger.info(f"Start VM {vmid} on node {node}")
+    app.logger.info("Start VM %s on node %s", vmid, node)
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        url = f"{PROXMOX_URL}/nodes/{node}/qemu/{vmid}/status/start"
-        response = requests.post(url, headers=headers, verify=VERIFY_SSL)
+        path = f"/nodes/{node}/qemu/{vmid}/status/start"
+        response = proxmox.post(path)
+        invalidate_vm_cache(node, vmid)
         response.raise_for_status()
-        app.logger.debug(f"Started VM {vmid} on node {node}")
+        app.logger.debug("Started VM %s on node %s", vmid, node)
         return jsonify(response.json())
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error starting VM {vmid} on node {node}: {e}")
-        return jsonify({'error': f'Failed to start VM {vmid} on node {node}'}), 500
+        app.logger.error("Error starting VM %s on node %s: %s", vmid, node, e)
+        return upstream_error(f'Failed to start VM {vmid} on node {node}', e)
 
 # Route for stopping a VM
 @app.route('/api/nodes/<node>/qemu/<vmid>/status/stop', methods=['POST'])
 @rate_limited
 def stop_vm(node, vmid):
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        url = f"{PROXMOX_URL}/nodes/{node}/qemu/{vmid}/status/stop"
-        response = requests.post(url, headers=headers, verify=VERIFY_SSL)
+        path = f"/nodes/{node}/qemu/{vmid}/status/stop"
+        response = proxmox.post(path)
+        invalidate_vm_cache(node, vmid)
         response.raise_for_status()
-        app.logger.info(f"Stopped VM {vmid} on node {node}")
+        app.logger.info("Stopped VM %s on node %s", vmid, node)
         return jsonify(response.json())
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error stopping VM {vmid} on node {node}: {e}")
-        return jsonify({'error': f'Failed to stop VM {vmid} on node {node}'}), 500
+        app.logger.error("Error stopping VM %s on node %s: %s", vmid, node, e)
+        return upstream_error(f'Failed to stop VM {vmid} on node {node}', e)
 
 # Route for deleting a VM
 @app.route('/api/nodes/<node>/qemu/<vmid>', methods=['DELETE'])
 @rate_limited
 def delete_vm(node, vmid):
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        url = f"{PROXMOX_URL}/nodes/{node}/qemu/{vmid}"
-        response = requests.delete(url, headers=headers, verify=VERIFY_SSL)
+        path = f"/nodes/{node}/qemu/{vmid}"
+        response = proxmox.delete(path)
+        invalidate_vm_cache(node, vmid)
         response.raise_for_status()
-        app.logger.info(f"Deleted VM {vmid} on node {node}")
+        resource_ledger.remove_vm(node, vmid)
+        app.logger.info("Deleted VM %s on node %s", vmid, node)
         return jsonify(response.json())
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error deleting VM {vmid} on node {node}: {e}")
-        return jsonify({'error': f'Failed to delete VM {vmid} on node {node}'}), 500
+        app.logger.error("Error deleting VM %s on node %s: %s", vmid, node, e)
+        return upstream_error(f'Failed to delete VM {vmid} on node {node}', e)
+
+# Thread pool for concurrent per-node requests, threads are only started once work is submitted
+cluster_executor = ThreadPoolExecutor(max_workers=CLUSTER_FANOUT_WORKERS, thread_name_prefix='cluster-fanout')
+
+# Function to submit fn(*args) to an executor in a copy of the caller's context, so log lines written on
+# the pool thread keep the ID of the request they are part of
+def submit_in_context(executor, fn, *args):
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+# Function to run fetch(node) for every online node concurrently, returns (results, errors) keyed by node
+def fan_out_nodes(fetch):
+    nodes = cached_get(('nodes',), CACHE_TTL_NODES, "/nodes")
+    results, errors, futures = {}, {}, {}
+    for node in nodes:
+        if node.get('status', 'online') != 'online':
+            errors[node['node']] = f"Node is {node['status']}"
+        else:
+            futures[node['node']] = submit_in_context(cluster_executor, fetch, node['node'])
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error fetching data from node %s: %s", name, e)
+            errors[name] = str(e)
+    return results, errors
+
+# Function to select the VMs of the cluster VM list, returns (body, total)
+def cluster_vms_body(vms, errors):
+    vms, total = select_items(vms, request.args, CLUSTER_VM_FILTERS, 'vmid')
+    return {'vms': vms, 'errors': errors}, total
+
+# Route for listing the VMs of all nodes, returns partial results if some nodes fail
+@app.route('/api/cluster/vms', methods=['GET'])
+@rate_limited
+@cache_versioned
+def get_cluster_vms():
+    try:
+        # A single /cluster/resources call replaces the per-node requests when the cluster provides it
+        if request.args.get('source', CLUSTER_INVENTORY_SOURCE) == 'resources':
+            resources = cached_get(('cluster_resources', 'vm'), CACHE_TTL_VMS, "/cluster/resources?type=vm")
+            vms, errors = [vm for vm in resources if vm.get('type') == 'qemu'], {}
+        else:
+            results, errors = fan_out_nodes(lambda node: cached_get(('vms', node), CACHE_TTL_VMS, f"/nodes/{node}/qemu"))
+            vms = [dict(vm, node=node) for node, node_vms in results.items() for vm in node_vms]
+        return not_modified() or list_response(*cluster_vms_body(vms, errors))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except requests.exceptions.RequestException as e:
+        app.logger.error("Error fetching cluster VMs: %s", e)
+        return upstream_error('Failed to fetch cluster VMs', e)
+
+# Route for the status of all nodes, returns partial results if some nodes fail
+@app.route('/api/cluster/status', methods=['GET'])
+@rate_limited
+@cache_versioned
+def get_cluster_status():
+    try:
+        cluster = submit_in_context(cluster_executor, cached_get, ('cluster_status',), CACHE_TTL_NODES, "/cluster/status")
+        results, errors = fan_out_nodes(lambda node: cached_get(('node_status', node), CACHE_TTL_NODES, f"/nodes/{node}/status"))
+        try:
+            cluster_status = cluster.result()
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error fetching cluster status: %s", e)
+            cluster_status = None
+            errors['cluster'] = str(e)
+        return not_modified() or jsonify({'cluster': cluster_status, 'nodes': results, 'errors': errors})
+    except requests.exceptions.RequestException as e:
+        app.logger.error("Error fetching cluster status: %s", e)
+        return upstream_error('Failed to fetch cluster status', e)
+
+# Proxmox RRD timeframes with the seconds between their data points, and their consolidation functions
+RRD_TIMEFRAMES = {'hour': 60, 'day': 1800, 'week': 10800, 'month': 43200, 'year': 604800}
+RRD_CONSOLIDATIONS = ('AVERAGE', 'MAX')
+RRD_DEFAULT_BUCKETS = 60
+RRD_DEFAULT_STATS = 'min,avg,max'
+RRD_PERCENTILE = re.compile(r'p(100|\d{1,2}(\.\d+)?)')
+
+# Function to parse the query parameters of a performance history request, returns
+# (timeframe, cf, buckets, stats, metrics) and raises ValueError on invalid parameters
+def parse_rrd_params(args):
+    timeframe = args.get('timeframe', 'hour')
+    if timeframe not in RRD_TIMEFRAMES:
+        raise ValueError(f"timeframe must be one of {', '.join(RRD_TIMEFRAMES)}")
+    cf = args.get('cf', 'AVERAGE').upper()
+    if cf not in RRD_CONSOLIDATIONS:
+        raise ValueError(f"cf must be one of {', '.join(RRD_CONSOLIDATIONS)}")
+    try:
+        buckets = int(args.get('buckets', RRD_DEFAULT_BUCKETS))
+    except ValueError:
+        raise ValueError('buckets must be an integer')
+    if buckets < 1:
+        raise ValueError('buckets must be at least 1')
+    stats = args.get('stats', RRD_DEFAULT_STATS).split(',')
+    for stat in stats:
+        if stat not in ('min', 'avg', 'max') and not RRD_PERCENTILE.fullmatch(stat):
+            raise ValueError(f'Unknown statistic {stat}, use min, avg, max or a percentile such as p95')
+    metrics = [metric for metric in args.get('metrics', '').split(',') if metric] or None
+    return timeframe, cf, buckets, stats, metrics
+
+# Function to fetch the RRD data of a node or VM through the inventory cache. Entries are kept until the
+# next data point of their timeframe is due, but no longer than CACHE_TTL_RRD.
+def cached_rrd(base_path, key, timeframe, cf):
+    ttl = min(RRD_TIMEFRAMES[timeframe], CACHE_TTL_RRD)
+    return cached_get(('rrd',) + key + (timeframe, cf), ttl, f"{base_path}/rrddata?timeframe={timeframe}&cf={cf}")
+
+# Function to convert a column of floats for JSON, with gaps in the data as None
+def rrd_column(values):
+    return np.where(np.isnan(values), None, values).tolist()
+
+# Function to compute percentiles along axis 1 ignoring NaN, with the linear interpolation of np.nanpercentile.
+# Vectorized by sorting once, np.nanpercentile itself loops over every bucket and metric in Python.
+def nan_percentiles(grouped, percentiles):
+    ordered = np.sort(grouped, axis=1)  # NaN sorts last
+    counts = np.sum(~np.isnan(grouped), axis=1)
+    results = []
+    for percentile in percentiles:
+        position = np.maximum(counts - 1, 0) * percentile / 100
+        low = np.floor(position).astype(int)
+        high = np.ceil(position).astype(int)
+        low_values = np.take_along_axis(ordered, low[:, None, :], axis=1)[:, 0, :]
+        high_values = np.take_along_axis(ordered, high[:, None, :], axis=1)[:, 0, :]
+        results.append(np.where(counts > 0, low_values + (high_values - low_values) * (position - low), np.nan))
+    return results
+
+# Function to downsample RRD rows into at most `buckets` buckets of consecutive points and compute the
+# requested statistics per bucket, vectorized over all points and metrics. Returns the columns
+# {'time': [bucket start, ...], 'metrics': {metric: {stat: [value, ...]}}}.
+def downsample_rrd(rows, buckets, stats, metrics=None):
+    rows = sorted(rows, key=lambda row: row.get('time', 0))
+    if metrics is None:
+        metrics = sorted({key for row in rows for key in row} - {'time'})
+    if not rows:
+        return {'time': [], 'metrics': {metric: {stat: [] for stat in stats} for metric in metrics}}
+    values = np.array([[row.get(metric) for metric in metrics] for row in rows], dtype=float)
+    # Points of each bucket side by side, shorter buckets padded with NaN, so every statistic is one call
+    buckets = min(buckets, len(rows))
+    starts = np.linspace(0, len(rows), buckets + 1).astype(int)
+    sizes = np.diff(starts)
+    bucket_of_point = np.repeat(np.arange(buckets), sizes)
+    grouped = np.full((buckets, sizes.max(), len(metrics)), np.nan)
+    grouped[bucket_of_point, np.arange(len(rows)) - starts[bucket_of_point]] = values
+    with warnings.catch_warnings():
+        # Buckets without any data give NaN, reported as None
+        warnings.simplefilter('ignore', RuntimeWarning)
+        computed = {'min': np.nanmin, 'avg': np.nanmean, 'max': np.nanmax}
+        results = {stat: computed[stat](grouped, axis=1) for stat in stats if stat in computed}
+        percentiles = [stat for stat in stats if stat not in computed]
+        if percentiles:
+            results.update(zip(percentiles, nan_percentiles(grouped, [float(stat[1:]) for stat in percentiles])))
+    times = [rows[start].get('time') for start in starts[:-1]]
+    return {'time': times,
+            'metrics': {metric: {stat: rrd_column(results[stat][:, index]) for stat in stats}
+                        for index, metric in enumerate(metrics)}}
+
+# Route for the performance history of a VM, downsampled to columns of per-bucket statistics
+@app.route('/api/nodes/<node>/qemu/<vmid>/rrd', methods=['GET'])
+@rate_limited
+@cache_versioned
+def get_vm_rrd(node, vmid):
+    try:
+        timeframe, cf, buckets, stats, metrics = parse_rrd_params(request.args)
+        if not vmid.isdigit():
+            raise ValueError('vmid must be an integer')
+        rows = cached_rrd(f"/nodes/{node}/qemu/{vmid}", (node, vmid), timeframe, cf)
+        return not_modified() or jsonify(dict(node=node, vmid=int(vmid), timeframe=timeframe, cf=cf,
+                                              **downsample_rrd(rows, buckets, stats, metrics)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except requests.exceptions.RequestException as e:
+        app.logger.error("Error fetching performance history of VM %s on node %s: %s", vmid, node, e)
+        return upstream_error(f'Failed to fetch performance history of VM {vmid} on node {node}', e)
+
+# Route for the performance history of every node, or of the VMs given in vmid wherever they run.
+# The RRD data is fetched concurrently, nodes and VMs that fail are reported in errors.
+@app.route('/api/cluster/rrd', methods=['GET'])
+@rate_limited
+@cache_versioned
+def get_cluster_rrd():
+    try:
+        timeframe, cf, buckets, stats, metrics = parse_rrd_params(request.args)
+        vmids = [vmid for vmid in request.args.get('vmid', '').split(',') if vmid]
+        # Series are fetched as (labels, rows), and only downsampled if the client doesn't have them already
+        if not vmids:
+            results, errors = fan_out_nodes(lambda node: cached_rrd(f"/nodes/{node}", (node,), timeframe, cf))
+            fetched = [({'node': node}, rows) for node, rows in sorted(results.items())]
+        else:
+            inventory, errors = fan_out_nodes(lambda node: cached_get(('vms', node), CACHE_TTL_VMS, f"/nodes/{node}/qemu"))
+            located = {str(vm['vmid']): node for node, vms in inventory.items() for vm in vms}
+            futures = {}
+            for vmid in vmids:
+                if vmid in located:
+                    futures[vmid] = submit_in_context(cluster_executor, cached_rrd, f"/nodes/{located[vmid]}/qemu/{vmid}",
+                                                      (located[vmid], vmid), timeframe, cf)
+                else:
+                    errors[vmid] = 'VM not found'
+            fetched = []
+            for vmid, future in futures.items():
+                try:
+                    fetched.append(({'node': located[vmid], 'vmid': int(vmid)}, future.result()))
+                except requests.exceptions.RequestException as e:
+                    app.logger.error("Error fetching performance history of VM %s: %s", vmid, e)
+                    errors[vmid] = str(e)
+        return not_modified() or jsonify({'timeframe': timeframe, 'cf': cf, 'errors': errors, 'series': [
+            dict(labels, **downsample_rrd(rows, buckets, stats, metrics)) for labels, rows in fetched]})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except requests.exceptions.RequestException as e:
+        app.logger.error("Error fetching cluster performance history: %s", e)
+        return upstream_error('Failed to fetch cluster performance history', e)
+
+# Proxmox calls for each bulk action, relative to /nodes/<node>/qemu/<vmid>
+BULK_ACTIONS = {
+    'start': ('POST', '/status/start'),
+    'stop': ('POST', '/status/stop'),
+    'shutdown': ('POST', '/status/shutdown'),
+    'delete': ('DELETE', ''),
+}
+
+# Per-node semaphores shared by all bulk requests, so concurrent bulk calls can't overload one node
+node_semaphores = {}
+node_semaphores_lock = threading.Lock()
+
+def node_semaphore(node):
+    with node_semaphores_lock:
+        if node not in node_semaphores:
+            node_semaphores[node] = threading.BoundedSemaphore(BULK_NODE_CONCURRENCY)
+        return node_semaphores[node]
+
+# Function to parse the VMs of a bulk request, accepting {"node": ..., "vmid": ...} objects or [node, vmid] pairs
+def parse_bulk_vms(items):
+    if not isinstance(items, list) or not items:
+        return None
+    vms = []
+    for item in items:
+        if isinstance(item, dict):
+            node, vmid = item.get('node'), item.get('vmid')
+        elif isinstance(item, list) and len(item) == 2:
+            node, vmid = item
+        else:
+            return None
+        if not node or not str(vmid).isdigit():
+            return None
+        vms.append((str(node), str(vmid)))
+    return vms
+
+# Function to run one bulk action against one VM, returns its result entry
+def run_bulk_action(action, node, vmid):
+    method, suffix = BULK_ACTIONS[action]
+    result = {'node': node, 'vmid': int(vmid)}
+    with node_semaphore(node):
+        try:
+            response = proxmox.request(method, f"/nodes/{node}/qemu/{vmid}{suffix}")
+            invalidate_vm_cache(node, vmid)
+            response.raise_for_status()
+            if action == 'delete':
+                resource_ledger.remove_vm(node, vmid)
+            result.update(ok=True, upid=response.json().get('data'))
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error running %s on VM %s on node %s: %s", action, vmid, node, e)
+            result.update(ok=False, error=str(e))
+    return result
+
+# Route for running start, stop, shutdown or delete on many VMs in one request
+@app.route('/api/bulk/qemu/<action>', methods=['POST'])
+@rate_limited
+def bulk_vm_action(action):
+    if action not in BULK_ACTIONS:
+        return jsonify({'error': f'Unknown action {action}'}), 400
+    data = request.get_json(silent=True) or {}
+    vms = parse_bulk_vms(data.get('vms') if isinstance(data, dict) else None)
+    if vms is None:
+        return jsonify({'error': 'Expected a non-empty list of {"node", "vmid"} objects in "vms"'}), 400
+    if len(vms) > BULK_MAX_VMS:
+        return jsonify({'error': f'At most {BULK_MAX_VMS} VMs per request'}), 400
+    try:
+        concurrency = max(1, min(int(data.get('concurrency', BULK_CONCURRENCY)), BULK_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'concurrency must be an integer'}), 400
+    app.logger.info("Bulk %s of %s VMs with concurrency %s", action, len(vms), concurrency)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bulk') as executor:
+        futures = [submit_in_context(executor, run_bulk_action, action, *vm) for vm in vms]
+        results = [future.result() for future in futures]
+    succeeded = sum(1 for result in results if result['ok'])
+    return jsonify({'action': action, 'succeeded': succeeded, 'failed': len(results) - succeeded, 'results': results})
+
+# VM fields whose changes are pushed to status stream subscribers
+STREAM_FIELDS = ('name', 'status', 'qmpstatus', 'lock', 'template', 'tags', 'maxcpu', 'maxmem', 'maxdisk')
+
+# Runs one poller thread per node while anyone watches it. Each poll diffs the node's /qemu list
+# against the previous one and hands only the changes to the subscribers, so upstream load doesn't
+# grow with the number of viewers. Subscribers are callables that must not block.
+class StatusStreamer:
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self._subscribers = {}  # node -> {subscription id: deliver}
+        self._snapshots = {}  # node -> {vmid: VM fields}
+        self._next_subscription = 0
+        self._lock = threading.Lock()
+
+    # Returns (subscription id, current snapshot of the node, empty until its first poll)
+    def subscribe(self, node, deliver):
+        with self._lock:
+            self._next_subscription += 1
+            subscription = self._next_subscription
+            if node not in self._subscribers:
+                self._subscribers[node] = {}
+                threading.Thread(target=self._poll, args=(node,), name=f'status-stream-{node}', daemon=True).start()
+            self._subscribers[node][subscription] = deliver
+            return subscription, list(self._snapshots.get(node, {}).values())
+
+    def unsubscribe(self, node, subscription):
+        with self._lock:
+            self._subscribers.get(node, {}).pop(subscription, None)
+
+    def _publish(self, node, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(node, {}).values())
+        for deliver in subscribers:
+            deliver(event, data)
+
+    def _poll(self, node):
+        while True:
+            with self._lock:
+                # The last subscriber left, stop polling and forget the node
+                if not self._subscribers.get(node):
+                    self._subscribers.pop(node, None)
+                    self._snapshots.pop(node, None)
+                    return
+                previous = self._snapshots.get(node, {})
+            try:
+                response = proxmox.get(f"/nodes/{node}/qemu")
+                response.raise_for_status()
+                current = {}
+                for vm in response.json()['data']:
+                    fields = {field: vm[field] for field in STREAM_FIELDS if field in vm}
+                    fields.update(node=node, vmid=int(vm['vmid']))
+                    current[fields['vmid']] = fields
+                with self._lock:
+                    self._snapshots[node] = current
+                for vmid, fields in current.items():
+                    if previous.get(vmid) != fields:
+                        self._publish(node, 'status', fields)
+                for vmid in previous.keys() - current.keys():
+                    self._publish(node, 'removed', {'node': node, 'vmid': vmid})
+            except requests.exceptions.RequestException as e:
+                app.logger.error("Error polling VM status on node %s: %s", node, e)
+                self._publish(node, 'error', {'node': node, 'error': str(e)})
+            time.sleep(self.poll_interval)
+
+status_streamer = StatusStreamer(STREAM_POLL_INTERVAL)
+# Request threads open status streams may hold, further streams are refused so other requests still get a thread
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CLIENTS)
+
+# Function to format one Server-Sent Event
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Function to parse the node and VM filters of a status stream request
+def parse_stream_filters(args):
+    nodes = [node for node in args.get('node', NODE_NAME or '').split(',') if node]
+    vmids = {int(vmid) for vmid in args.get('vmid', '').split(',') if vmid.isdigit()}
+    return nodes, vmids
+
+# Route streaming VM status changes as Server-Sent Events
+@app.route('/api/stream/status', methods=['GET'])
+@rate_limited
+def stream_status():
+    nodes, vmids = parse_stream_filters(request.args)
+    if not nodes:
+        return jsonify({'error': 'No node given'}), 400
+    slots = stream_slots
+    if not slots.acquire(blocking=False):
+        app.logger.warning("Refused status stream, all stream slots are taken")
+        response = jsonify({'error': 'Too many status streams are open, please try again later.'})
+        response.headers['Retry-After'] = str(RETRY_INTERVAL)
+        return response, 503
+    events = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    def deliver(event, data):
+        if vmids and data.get('vmid') not in vmids and event != 'error':
+            return
+        try:
+            events.put_nowait((event, data))
+        except queue.Full:
+            # The client can't keep up, end the stream so it reconnects and starts from a fresh snapshot
+            while True:
+                try:
+                    events.get_nowait()
+                except queue.Empty:
+                    break
+            events.put_nowait(None)
+
+    subscriptions = [(node, *status_streamer.subscribe(node, deliver)) for node in nodes]
+
+    def generate():
+        for node, subscription, snapshot in subscriptions:
+            for fields in snapshot:
+                if not vmids or fields['vmid'] in vmids:
+                    yield format_sse('status', fields)
+        while True:
+            try:
+                item = events.get(timeout=STREAM_KEEPALIVE)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if item is None:
+                return
+            yield format_sse(*item)
+
+    # Called by the server when the stream ends or the client goes away, also if the stream never started
+    def close():
+        for node, subscription, snapshot in subscriptions:
+            status_streamer.unsubscribe(node, subscription)
+        slots.release()
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(close)
+    return response
 
 ##########################################################################################################
 
@@ -438,70 +2853,82 @@ def delete_vm(node, vmid):
 ##########################################################################################################
 
 # Function to check Proxmox connection
-def check_proxmox_connection(ticket, csrf_token):
+def check_proxmox_connection(timeout=PRECHECK_TIMEOUT):
     app.logger.info("Checking Proxmox connection...")
     try:
-        url = f"{PROXMOX_URL}/nodes"
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        response = requests.get(url, headers=headers, verify=VERIFY_SSL)
+        path = "/nodes"
+        response = proxmox.get(path, timeout=timeout)
         response.raise_for_status()
-        app.logger.info(f"Proxmox connection response: {json.dumps(response.json(), indent=2)}")
+        app.logger.info("Proxmox connection response: %s", LogPayload(response.json()))
         return True
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error checking Proxmox connection: {e}")
+        app.logger.error("Error checking Proxmox connection: %s", e)
         return False
 
 # Function to check ISO fetch
-def check_iso_fetch(ticket, csrf_token):
+def check_iso_fetch(timeout=PRECHECK_TIMEOUT):
     app.logger.info("Checking ISO fetch...")
     try:
-        url = f"{PROXMOX_URL}/nodes/{NODE_NAME}/storage/local/content"
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        response = requests.get(url, headers=headers, verify=VERIFY_SSL)
+        path = f"/nodes/{NODE_NAME}/storage/local/content"
+        response = proxmox.get(path, timeout=timeout)
         response.raise_for_status()
-        app.logger.info(f"ISO fetch response: {json.dumps(response.json(), indent=2)}")
+        app.logger.info("ISO fetch response: %s", LogPayload(response.json()))
         return True
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error fetching ISOs: {e}")
+        app.logger.error("Error fetching ISOs: %s", e)
         return False
 
 # Function to check VM creation
-def check_vm_create(ticket, csrf_token):
+def check_vm_create(timeout=PRECHECK_TIMEOUT):
     app.logger.info("Checking VM creation...")
     try:
-        url = f"{PROXMOX_URL}/nodes/{NODE_NAME}/qemu"
-        headers = {
-            'CSRFPreventionToken': csrf_token,
-            'Cookie': f'PVEAuthCookie={ticket}'
-        }
-        response = requests.get(url, headers=headers, verify=VERIFY_SSL)
+        path = f"/nodes/{NODE_NAME}/qemu"
+        response = proxmox.get(path, timeout=timeout)
         response.raise_for_status()
-        app.logger.info(f"VM creation response: {json.dumps(response.json(), indent=2)}")
+        app.logger.info("VM creation response: %s", LogPayload(response.json()))
         return True
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error checking VM creation: {e}")
+        app.logger.error("Error checking VM creation: %s", e)
         return False
 
-# Function to perform pre-checks before starting Flask server
-def perform_pre_checks():
-    app.logger.info("Performing pre-checks...")
+# Function to run one pre-check and store its outcome in future
+def run_pre_check(check, timeout, future):
     try:
-        ticket, csrf_token = get_proxmox_ticket()
-        if not check_proxmox_connection(ticket, csrf_token) or not check_iso_fetch(ticket, csrf_token) or not check_vm_create(ticket, csrf_token):
-            response = input("Pre-checks failed. Do you want to continue loading the Flask server? (y/n): ")
-            if response.lower() != 'y':
-                app.logger.info("Exiting.")
-                return False
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Pre-checks could not be performed due to an error: {e}")
-        return False
-    return True
+        future.set_result(check(timeout))
+    except Exception as e:
+        future.set_exception(e)
+
+# Function to perform pre-checks before starting the server, the checks run concurrently within one timeout.
+# policy decides what happens when a check fails: 'exit', 'continue' or 'ask' (only asks on a terminal).
+def perform_pre_checks(policy=PRECHECK_POLICY, timeout=PRECHECK_TIMEOUT):
+    app.logger.info("Performing pre-checks...")
+    futures = {}
+    for check in [check_proxmox_connection, check_iso_fetch, check_vm_create]:
+        future = futures[check.__name__] = Future()
+        # Daemon threads, so a check that is still hanging when the timeout expires doesn't delay exiting
+        threading.Thread(target=run_pre_check, args=(check, timeout, future), name=check.__name__, daemon=True).start()
+    done, _ = wait(futures.values(), timeout=timeout)
+    failed = []
+    for name, future in futures.items():
+        if future not in done:
+            app.logger.error("Pre-check %s timed out after %s seconds", name, timeout)
+            failed.append(name)
+        elif future.exception():
+            app.logger.error("Pre-checks could not be performed due to an error: %s", future.exception())
+            failed.append(name)
+        elif not future.result():
+            failed.append(name)
+    if not failed:
+        return True
+    app.logger.error("Pre-checks failed: %s", ', '.join(sorted(failed)))
+    if policy == 'continue':
+        return True
+    if policy == 'ask' and sys.stdin.isatty():
+        response = input("Pre-checks failed. Do you want to continue loading the server? (y/n): ")
+        if response.lower() == 'y':
+            return True
+    app.logger.info("Exiting.")
+    return False
 
 # Function to dump all API endpoint responses
 def dump_all_endpoints():
@@ -520,12 +2947,90 @@ def dump_all_endpoints():
         json.dump(responses, f, indent=2)
     app.logger.info("API responses dumped successfully.")
 
-# Main function to start Flask server
-def main():
-    if not perform_pre_checks():
+# Function to keep rate limits, leases, reservations, job records and metrics in the shared state database at path
+# from now on. Must be called before any worker process is forked, state kept in this process until then
+# is not carried over.
+def use_shared_state(path):
+    global SHARED_STATE_DB, rate_limiter, leases, job_store, metrics_store
+    SHARED_STATE_DB = path
+    shared_state_connection()
+    rate_limiter = SQLiteRateLimiter()
+    leases = vmid_allocator.leases = clone_pool.leases = SQLiteLeases()
+    resource_ledger.reservations = SQLiteReservations()
+    job_store = job_queue.store = SQLiteJobStore(JOB_RETENTION)
+    metrics_store = SQLiteMetrics(METRICS_PUBLISH_INTERVAL)
+
+# Function run in each serve worker process right after it was forked
+def init_worker(log_writer_queue):
+    proxmox.reset_after_fork()
+    log_queue_handler.set_handlers([ForwardingHandler(log_writer_queue)] + console_handlers)
+    # Background threads don't survive the fork either
+    clone_pool.start()
+    metrics_store.start()
+
+# Function to serve the app from pre-forked gunicorn workers, each running WORKER_THREADS request threads
+def serve(bind=SERVER_BIND, workers=SERVER_WORKERS, threads=WORKER_THREADS):
+    # Imported here so importing this module stays fast and gunicorn is only needed to serve
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', bind)
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            # Status streams stay open, so workers only need to answer the arbiter's heartbeat
+            self.cfg.set('timeout', 60)
+            self.cfg.set('graceful_timeout', 30)
+            self.cfg.set('post_worker_init', lambda worker: init_worker(log_writer_queue))
+
+        def load(self):
+            return app
+
+    # Streams must leave at least one request thread of each worker to other requests
+    global stream_slots
+    stream_slots = threading.BoundedSemaphore(max(0, min(STREAM_MAX_CLIENTS, threads - 1)))
+    # Per-process state would let workers hand out the same VMID, and a job polled on another worker than
+    # the one that queued it would not be found, so workers always share state
+    if workers > 1 and not SHARED_STATE_DB:
+        app.logger.warning("SHARED_STATE_DB is not set, sharing state between workers in %s", os.path.abspath(SHARED_STATE_DEFAULT_DB))
+        use_shared_state(SHARED_STATE_DEFAULT_DB)
+    metrics_store.reset()
+    # Connections opened by the pre-checks must not be shared between the forked workers
+    proxmox.session.close()
+    # Workers send their log records to a single writer thread in this process, several processes
+    # rotating the same files would lose or garble records
+    log_writer_queue = multiprocessing.Queue(LOG_QUEUE_SIZE)
+    log_writer = QueueListener(log_writer_queue, info_handler, error_handler, respect_handler_level=True)
+    log_writer.start()
+    atexit.register(log_writer.stop)
+    app.logger.info("Starting %s workers with %s threads each on %s", workers, threads, bind)
+    Server().run()
+
+# Main function to start the server
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Proxmox backend API')
+    parser.add_argument('command', nargs='?', choices=['serve', 'dev'], default='dev',
+                        help="'serve' runs pre-forked production workers, 'dev' runs the Flask development server")
+    parser.add_argument('--bind', default=SERVER_BIND)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS)
+    parser.add_argument('--threads', type=int, default=WORKER_THREADS)
+    parser.add_argument('--precheck-policy', choices=['exit', 'continue', 'ask'], default=PRECHECK_POLICY,
+                        help='What to do when a pre-check fails')
+    parser.add_argument('--precheck-timeout', type=float, default=PRECHECK_TIMEOUT)
+    parser.add_argument('--skip-prechecks', action='store_true')
+    args = parser.parse_args(argv)
+
+    if not args.skip_prechecks and not perform_pre_checks(args.precheck_policy, args.precheck_timeout):
+        sys.exit(1)
+    if args.command == 'serve':
+        serve(args.bind, args.workers, args.threads)
         return
-    app.logger.info("Starting Flask server...")
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    host, _, port = args.bind.rpartition(':')
+    app.logger.info("Starting Flask development server...")
+    clone_pool.start()
+    # The reloader would run the pre-checks a second time in its child process
+    app.run(host=host, port=int(port), debug=True, use_reloader=False, threaded=True)
 
 if __name__ == "__main__":
     main()
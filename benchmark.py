@@ -0,0 +1,255 @@
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import argparse
+import threading
+import tempfile
+import requests
+import random
+import json
+import time
+import sys
+import os
+
+# Load benchmark for every API route. By default it starts mock_proxmox.py and the API against it, so it runs
+# offline and its results can be compared between changes:
+#
+#     python benchmark.py --requests 500 --concurrency 32 --output before.json
+#     python benchmark.py --requests 500 --concurrency 32 --compare before.json
+#
+# --target benchmarks an API that is already running instead. Routes that change VMs only run against the
+# bundled mock unless --allow-writes is given.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+API_PASSWORD = 'benchmark'
+TEST_ISO = 'local:iso/debian-12.5.0-amd64-netinst.iso'
+TEST_TEMPLATE = 'debian-12-cloud'
+STARTUP_TIMEOUT = 30  # in seconds
+
+_sessions = threading.local()
+
+# Function to get this thread's HTTP session, so connections to the API are reused
+def session():
+    if not hasattr(_sessions, 'session'):
+        _sessions.session = requests.Session()
+        _sessions.session.headers['Authorization'] = f'Bearer {API_PASSWORD}'
+    return _sessions.session
+
+# Function to start a process and wait until url answers
+def start_process(command, url, env=None, cwd=None):
+    process = subprocess.Popen(command, env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(command)} exited with code {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return process
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{' '.join(command)} didn't answer on {url} within {STARTUP_TIMEOUT} seconds")
+
+# Function to start the mock Proxmox API and the API server, returns the processes and both URLs
+def start_servers(args, workdir):
+    mock_url = f'http://127.0.0.1:{args.mock_port}'
+    mock = start_process([sys.executable, os.path.join(REPO_DIR, 'mock_proxmox.py'), '--port', str(args.mock_port),
+                          '--nodes', str(args.nodes), '--vms-per-node', str(args.vms_per_node),
+                          '--latency', str(args.latency), '--jitter', str(args.jitter),
+                          '--error-rate', str(args.error_rate)], f'{mock_url}/_mock/stats')
+    env = dict(os.environ,
+               PROXMOX_URL=f'{mock_url}/api2/json', PROXMOX_USER='root@pam', PROXMOX_PASS='benchmark',
+               API_PASSWORD=API_PASSWORD, NODE_NAME='pve1', PYTHONPATH=REPO_DIR,
+               REQUESTS_PER_MINUTE='1000000000', CREATE_VM_REQUESTS_PER_MINUTE='1000000000',
+               JOB_QUEUE_SIZE='100000', TIER_TEMPLATES=f'basic={TEST_TEMPLATE}', SHARED_STATE_DB=os.path.join(workdir, 'state.db'))
+    bind = f'127.0.0.1:{args.port}'
+    if args.server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(args.port),
+                   '--no-access-log']
+    else:
+        command = [sys.executable, os.path.join(REPO_DIR, 'backend.py'), args.server, '--bind', bind,
+                   '--workers', str(args.workers), '--skip-prechecks']
+    try:
+        api = start_process(command, f'http://{bind}/api/status', env=env, cwd=workdir)
+    except Exception:
+        mock.terminate()
+        raise
+    return [api, mock], f'http://{bind}', mock_url
+
+# Function to read the VMs the benchmark acts on from the API
+def discover_vms(target):
+    response = session().get(f'{target}/api/cluster/vms', timeout=60)
+    response.raise_for_status()
+    return [(vm['node'], vm['vmid']) for vm in response.json()['vms'] if not vm.get('template')]
+
+# Function to build the benchmarked requests, each one a function of the request number returning
+# the method, path and JSON body
+def build_routes(vms, job_ids):
+    node = vms[0][0]
+    nodes = sorted({vm_node for vm_node, _ in vms})
+    # Deleted VMs come from the end of the list so the other routes keep working on the rest
+    pick = lambda i: vms[i % (len(vms) // 2 or 1)]
+    to_delete = vms[len(vms) // 2:]
+    bulk_batch = lambda i: [{'node': vm_node, 'vmid': vmid} for vm_node, vmid in (pick(i * 10 + j) for j in range(10))]
+    return [
+        ('status', False, lambda i: ('GET', '/api/status', None)),
+        ('iso', False, lambda i: ('GET', '/api/iso', None)),
+        ('nodes', False, lambda i: ('GET', '/api/nodes', None)),
+        ('node_vms', False, lambda i: ('GET', f'/api/nodes/{nodes[i % len(nodes)]}/qemu', None)),
+        ('vm_status', False, lambda i: ('GET', '/api/nodes/{}/qemu/{}/status'.format(*pick(i)), None)),
+        ('cluster_vms', False, lambda i: ('GET', '/api/cluster/vms', None)),
+        ('cluster_vms_resources', False, lambda i: ('GET', '/api/cluster/vms?source=resources', None)),
+        ('cluster_status', False, lambda i: ('GET', '/api/cluster/status', None)),
+        ('vm_rrd', False, lambda i: ('GET', '/api/nodes/{}/qemu/{}/rrd'.format(*pick(i)), None)),
+        ('cluster_rrd', False, lambda i: ('GET', '/api/cluster/rrd', None)),
+        ('metrics', False, lambda i: ('GET', '/metrics', None)),
+        ('vm_config', True, lambda i: ('POST', '/api/nodes/{}/qemu/{}/config'.format(*pick(i)), {'description': f'benchmark {i}'})),
+        ('vm_start', True, lambda i: ('POST', '/api/nodes/{}/qemu/{}/status/start'.format(*pick(i)), None)),
+        ('vm_stop', True, lambda i: ('POST', '/api/nodes/{}/qemu/{}/status/stop'.format(*pick(i)), None)),
+        ('bulk_start', True, lambda i: ('POST', '/api/bulk/qemu/start', {'vms': bulk_batch(i)})),
+        ('create_vm', True, lambda i: ('POST', '/api/create-vm', {'name': f'benchmark-{i}', 'iso': TEST_ISO})),
+        ('create_vm_clone', True, lambda i: ('POST', '/api/create-vm', {'name': f'benchmark-clone-{i}', 'tier': 'basic'})),
+        ('job', True, lambda i: ('GET', f'/api/jobs/{job_ids[i % len(job_ids)] if job_ids else "missing"}', None)),
+        ('vm_delete', True, lambda i: ('DELETE', '/api/nodes/{}/qemu/{}'.format(*to_delete[i % len(to_delete)]), None)),
+        # Last, as closed streams hold a server thread until the next keep-alive
+        ('stream_status', False, lambda i: ('STREAM', f'/api/stream/status?node={node}', None)),
+    ]
+
+# Function to send one request, returns its status code and latency in seconds
+def send(target, method, path, body):
+    start = time.perf_counter()
+    try:
+        if method == 'STREAM':
+            # Time until the stream delivers its first event
+            with session().get(f'{target}{path}', stream=True, timeout=30) as response:
+                for line in response.iter_lines():
+                    if line.startswith(b'event:'):
+                        break
+                return response.status_code, time.perf_counter() - start, None
+        response = session().request(method, f'{target}{path}', json=body, timeout=60)
+        return response.status_code, time.perf_counter() - start, response
+    except requests.exceptions.RequestException:
+        return 'error', time.perf_counter() - start, None
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+# Function to read the number of calls the mock Proxmox API received
+def upstream_calls(mock_url):
+    return requests.get(f'{mock_url}/_mock/stats', timeout=10).json()['total']
+
+# Function to run one route with the given concurrency, returns its statistics
+def run_route(target, mock_url, make_request, count, concurrency, on_response=None):
+    calls_before = upstream_calls(mock_url) if mock_url else None
+
+    def run_one(i):
+        method, path, body = make_request(i)
+        status, latency, response = send(target, method, path, body)
+        if on_response and response is not None and status in (200, 202):
+            on_response(response)
+        return status, latency
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(run_one, range(count)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for _, latency in results)
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    stats = {
+        'requests': count,
+        'errors': sum(n for status, n in statuses.items() if not status.startswith('2')),
+        'statuses': statuses,
+        'requests_per_second': count / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+    if mock_url:
+        stats['upstream_per_request'] = (upstream_calls(mock_url) - calls_before) / count
+    return stats
+
+# Function to print the results as a table, with the change against earlier results if given
+def print_report(results, previous=None):
+    header = f"{'route':<24}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'upstream':>10}"
+    if previous:
+        header += f"{'req/s Δ':>10}{'p95 Δ':>10}"
+    print(header)
+    for name, stats in results.items():
+        upstream = stats.get('upstream_per_request')
+        line = (f"{name:<24}{stats['requests_per_second']:>10.1f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+                f"{stats['p99_ms']:>10.2f}{stats['errors']:>8}{'-' if upstream is None else f'{upstream:.2f}':>10}")
+        before = (previous or {}).get(name)
+        if before:
+            rate_change = (stats['requests_per_second'] / before['requests_per_second'] - 1) * 100
+            p95_change = (stats['p95_ms'] / before['p95_ms'] - 1) * 100 if before['p95_ms'] else 0
+            line += f"{rate_change:>+9.1f}%{p95_change:>+9.1f}%"
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the API routes against a mock Proxmox API')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per route')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent clients')
+    parser.add_argument('--routes', help='Comma-separated routes to run, all by default')
+    parser.add_argument('--server', choices=['serve', 'dev', 'asgi'], default='serve', help='How to run the API')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes for --server serve')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--mock-port', type=int, default=18006)
+    parser.add_argument('--nodes', type=int, default=3, help='Nodes of the mock cluster')
+    parser.add_argument('--vms-per-node', type=int, default=1000, help='VMs on each mock node')
+    parser.add_argument('--latency', type=float, default=0.01, help='Mock Proxmox response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.005, help='Variation of the mock response time in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of mock Proxmox calls failing')
+    parser.add_argument('--target', help='URL of an already running API instead of starting one')
+    parser.add_argument('--mock-url', help='URL of the mock Proxmox API used by --target, to count upstream calls')
+    parser.add_argument('--allow-writes', action='store_true', help='Run routes changing VMs against --target')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Show the change against results written earlier with --output')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    global API_PASSWORD
+    processes = []
+    workdir = tempfile.TemporaryDirectory(prefix='benchmark-')
+    try:
+        if args.target:
+            target, mock_url = args.target.rstrip('/'), args.mock_url
+            API_PASSWORD = os.getenv('API_PASSWORD', API_PASSWORD)
+            allow_writes = args.allow_writes
+        else:
+            processes, target, mock_url = start_servers(args, workdir.name)
+            allow_writes = True
+
+        job_ids = []
+        vms = discover_vms(target)
+        selected = set(args.routes.split(',')) if args.routes else None
+        results = {}
+        for name, writes, make_request in build_routes(vms, job_ids):
+            if (selected and name not in selected) or (writes and not allow_writes):
+                continue
+            on_response = (lambda response: job_ids.append(response.json()['job_id'])) if name == 'create_vm' else None
+            # Each stream occupies a server thread, so only as many are opened as there are clients
+            count = min(args.requests, args.concurrency) if name == 'stream_status' else args.requests
+            results[name] = run_route(target, mock_url, make_request, count, args.concurrency, on_response)
+            print(f"{name}: {results[name]['requests_per_second']:.1f} req/s", file=sys.stderr)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        workdir.cleanup()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['routes']
+    print_report(results, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'routes': results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+from flask import Flask, request, jsonify
+from collections import Counter
+import argparse
+import itertools
+import threading
+import random
+import time
+import uuid
+import re
+
+# Stand-in for the Proxmox API, used to develop and benchmark backend.py without a cluster. Start it with:
+#
+#     python mock_proxmox.py --nodes 3 --vms-per-node 2000 --latency 0.02
+#
+# and point PROXMOX_URL at http://127.0.0.1:8006/api2/json. Any user and password are accepted.
+# GET /_mock/stats returns the number of calls per path, POST /_mock/reset clears them.
+
+API_PREFIX = '/api2/json'
+MIN_NODE_CORES = 64
+MIN_NODE_MEMORY = 512 * 1024**3
+MIN_STORAGE_SIZE = 4 * 1024**4
+ISO_IMAGES = ['debian-12.5.0-amd64-netinst.iso', 'ubuntu-24.04-live-server-amd64.iso', 'alpine-virt-3.19.1-x86_64.iso']
+# Shared storage with more images and container templates, mounted on every node
+SHARED_ISO_STORAGE = 'iso-nfs'
+SHARED_ISO_IMAGES = [f'{distro}-{version}.iso' for distro in ('debian', 'ubuntu', 'fedora', 'rocky', 'windows-server')
+                     for version in range(2015, 2025)]
+# Template VM on every node, with a smaller disk than the tiers so clones get resized
+TEMPLATE_NAME = 'debian-12-cloud'
+TEMPLATE_VMID_BASE = 9000
+SHARED_TEMPLATES = ['debian-12-standard_12.2-1_amd64.tar.zst', 'ubuntu-24.04-standard_24.04-2_amd64.tar.zst']
+
+app = Flask(__name__)
+
+# Settings, changed by the command line arguments
+settings = {
+    'latency': 0.0,  # in seconds
+    'jitter': 0.0,  # in seconds
+    'error_rate': 0.0,
+    'task_duration': 0.0,  # in seconds
+}
+
+state_lock = threading.Lock()
+vms = {}  # node -> {vmid: vm}
+node_sizes = {}  # node -> (cores, memory, storage), twice what the generated VMs use so VMs can still be created
+tasks = {}  # upid -> finish time
+tickets = set()
+calls = Counter()
+upid_counter = itertools.count(1)
+
+# Patterns replacing node names, VM IDs and task IDs so call counts group by endpoint
+PATH_PATTERNS = [
+    (re.compile(r'^/nodes/[^/]+'), '/nodes/{node}'),
+    (re.compile(r'/qemu/\d+'), '/qemu/{vmid}'),
+    (re.compile(r'/tasks/[^/]+'), '/tasks/{upid}'),
+    (re.compile(r'/storage/[^/]+'), '/storage/{storage}'),
+]
+
+# Function to fill the inventory with generated VMs
+def build_inventory(node_count, vms_per_node):
+    vms.clear()
+    vmid = 100
+    for index in range(1, node_count + 1):
+        node = f'pve{index}'
+        vms[node] = {}
+        for _ in range(vms_per_node):
+            cores = random.choice([1, 2, 4])
+            vms[node][vmid] = {
+                'vmid': vmid,
+                'name': f'vm-{vmid}',
+                'status': random.choice(['running', 'running', 'stopped']),
+                'cpus': cores,
+                'maxmem': cores * 2 * 1024**3,
+                'maxdisk': 32 * 1024**3,
+                'mem': 1024**3,
+                'cpu': round(random.random() / 10, 4),
+                'uptime': random.randint(0, 10**6),
+                'onboot': 0,
+            }
+            vmid += 1
+        template_vmid = TEMPLATE_VMID_BASE + index
+        vms[node][template_vmid] = {
+            'vmid': template_vmid, 'name': TEMPLATE_NAME, 'status': 'stopped', 'template': 1, 'cpus': 1,
+            'maxmem': 1024**3, 'maxdisk': 8 * 1024**3, 'mem': 0, 'cpu': 0, 'uptime': 0, 'onboot': 0,
+        }
+        node_vms = vms[node].values()
+        node_sizes[node] = (max(MIN_NODE_CORES, 2 * sum(vm['cpus'] for vm in node_vms)),
+                            max(MIN_NODE_MEMORY, 2 * sum(vm['maxmem'] for vm in node_vms)),
+                            max(MIN_STORAGE_SIZE, 2 * sum(vm['maxdisk'] for vm in node_vms)))
+
+# Function to start a task finishing after the configured duration, returns its UPID
+def new_task(node, task_type, vmid):
+    upid = f"UPID:{node}:{next(upid_counter):08X}:{int(time.time()):08X}:{task_type}:{vmid}:root@pam:"
+    tasks[upid] = time.monotonic() + settings['task_duration']
+    return upid
+
+# Function to find a VM, returns None if it doesn't exist
+def find_vm(node, vmid):
+    return vms.get(node, {}).get(vmid)
+
+def error(status_code, message):
+    return jsonify({'data': None, 'errors': {'message': message}}), status_code
+
+@app.before_request
+def simulate_proxmox():
+    path = request.path[len(API_PREFIX):] if request.path.startswith(API_PREFIX) else request.path
+    if path.startswith('/_mock'):
+        return None
+    for pattern, replacement in PATH_PATTERNS:
+        path = pattern.sub(replacement, path)
+    with state_lock:
+        calls[f"{request.method} {path}"] += 1
+    delay = settings['latency'] + random.uniform(-settings['jitter'], settings['jitter'])
+    if delay > 0:
+        time.sleep(delay)
+    if path in ('/access/ticket', '/version'):
+        return None
+    cookie = request.cookies.get('PVEAuthCookie')
+    if cookie not in tickets:
+        return error(401, 'No ticket')
+    if settings['error_rate'] and random.random() < settings['error_rate']:
+        return error(500, 'Simulated failure')
+    return None
+
+@app.route(f'{API_PREFIX}/access/ticket', methods=['POST'])
+def create_ticket():
+    ticket = f"PVE:{request.form.get('username', 'root@pam')}:{uuid.uuid4().hex}"
+    with state_lock:
+        tickets.add(ticket)
+    return jsonify({'data': {'ticket': ticket, 'CSRFPreventionToken': uuid.uuid4().hex}})
+
+@app.route(f'{API_PREFIX}/version', methods=['GET'])
+def version():
+    return jsonify({'data': {'version': '8.2.2', 'release': '8.2', 'repoid': 'mock'}})
+
+@app.route(f'{API_PREFIX}/nodes', methods=['GET'])
+def get_nodes():
+    with state_lock:
+        data = [{'node': node, 'status': 'online', 'type': 'node', 'maxcpu': node_sizes[node][0],
+                 'maxmem': node_sizes[node][1], 'cpu': 0.1, 'mem': sum(vm['mem'] for vm in node_vms.values()), 'uptime': 10**6}
+                for node, node_vms in vms.items()]
+    return jsonify({'data': data})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/status', methods=['GET'])
+def get_node_status(node):
+    if node not in vms:
+        return error(404, 'No such node')
+    cores, memory, _ = node_sizes[node]
+    with state_lock:
+        used_memory = sum(vm['mem'] for vm in vms[node].values())
+    return jsonify({'data': {
+        'cpu': 0.1,
+        'cpuinfo': {'cpus': cores, 'cores': cores // 2, 'sockets': 2},
+        'memory': {'total': memory, 'used': used_memory, 'free': memory - used_memory},
+        'rootfs': {'total': 100 * 1024**3, 'used': 10 * 1024**3},
+        'uptime': 10**6,
+    }})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/qemu', methods=['GET', 'POST'])
+def node_vms(node):
+    if node not in vms:
+        return error(404, 'No such node')
+    if request.method == 'GET':
+        with state_lock:
+            return jsonify({'data': [dict(vm) for vm in vms[node].values()]})
+    params = request.get_json(silent=True) or request.form.to_dict()
+    vmid = int(params.get('vmid', 0))
+    with state_lock:
+        if any(vmid in node_vms for node_vms in vms.values()):
+            return error(500, f'VM {vmid} already exists')
+        cores = int(params.get('cores', 1))
+        vms[node][vmid] = {
+            'vmid': vmid, 'name': params.get('name', f'vm-{vmid}'), 'status': 'stopped', 'cpus': cores,
+            'maxmem': int(params.get('memory', 512)) * 1024**2, 'maxdisk': 32 * 1024**3, 'mem': 0, 'cpu': 0,
+            'uptime': 0, 'onboot': 0,
+        }
+        return jsonify({'data': new_task(node, 'qmcreate', vmid)})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/qemu/<int:vmid>', methods=['DELETE'])
+def delete_vm(node, vmid):
+    with state_lock:
+        if not vms.get(node, {}).pop(vmid, None):
+            return error(500, f'VM {vmid} does not exist')
+        return jsonify({'data': new_task(node, 'qmdestroy', vmid)})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/qemu/<int:vmid>/status/current', methods=['GET'])
+def get_vm_status(node, vmid):
+    with state_lock:
+        vm = find_vm(node, vmid)
+        if not vm:
+            return error(500, f'VM {vmid} does not exist')
+        return jsonify({'data': dict(vm, qmpstatus=vm['status'])})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/qemu/<int:vmid>/status/<action>', methods=['POST'])
+def vm_action(node, vmid, action):
+    if action not in ('start', 'stop', 'shutdown', 'reboot', 'reset'):
+        return error(501, f'Method {action} not implemented')
+    with state_lock:
+        vm = find_vm(node, vmid)
+        if not vm:
+            return error(500, f'VM {vmid} does not exist')
+        vm['status'] = 'stopped' if action in ('stop', 'shutdown') else 'running'
+        return jsonify({'data': new_task(node, f'qm{action}', vmid)})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/qemu/<int:vmid>/config', methods=['GET', 'POST', 'PUT'])
+def vm_config(node, vmid):
+    with state_lock:
+        vm = find_vm(node, vmid)
+        if not vm:
+            return error(500, f'VM {vmid} does not exist')
+        if request.method == 'GET':
+            return jsonify({'data': {'name': vm['name'], 'cores': vm['cpus'], 'memory': vm['maxmem'] // 1024**2,
+                                     'onboot': vm['onboot'], 'template': vm.get('template', 0),
+                                     'ide2': 'none,media=cdrom',
+                                     'scsi0': f"local-lvm:vm-{vmid}-disk-0,size={vm['maxdisk'] // 1024**3}G"}})
+        params = request.get_json(silent=True) or request.form.to_dict()
+        if 'name' in params:
+            vm['name'] = params['name']
+        if 'onboot' in params:
+            vm['onboot'] = int(params['onboot'])
+        if 'cores' in params:
+            vm['cpus'] = int(params['cores'])
+        if 'memory' in params:
+            vm['maxmem'] = int(params['memory']) * 1024**2
+    return jsonify({'data': None})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/qemu/<int:vmid>/clone', methods=['POST'])
+def clone_vm(node, vmid):
+    params = request.get_json(silent=True) or request.form.to_dict()
+    newid = int(params.get('newid', 0))
+    with state_lock:
+        template = find_vm(node, vmid)
+        if not template:
+            return error(500, f'VM {vmid} does not exist')
+        if not template.get('template') and not int(params.get('full', 0)):
+            return error(500, 'Linked clone feature is not supported for drive scsi0')
+        if any(newid in node_vms for node_vms in vms.values()):
+            return error(500, f'VM {newid} already exists')
+        vms[node][newid] = dict(template, vmid=newid, name=params.get('name', f'Copy-of-VM-{template["name"]}'),
+                                status='stopped', template=0)
+        return jsonify({'data': new_task(node, 'qmclone', vmid)})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/qemu/<int:vmid>/resize', methods=['PUT'])
+def resize_vm(node, vmid):
+    params = request.get_json(silent=True) or request.form.to_dict()
+    match = re.fullmatch(r'(\+?)(\d+)G', str(params.get('size', '')))
+    with state_lock:
+        vm = find_vm(node, vmid)
+        if not vm:
+            return error(500, f'VM {vmid} does not exist')
+        if not match:
+            return error(400, 'Invalid size')
+        size = int(match.group(2)) * 1024**3 + (vm['maxdisk'] if match.group(1) else 0)
+        if size < vm['maxdisk']:
+            return error(500, 'Shrinking disks is not supported')
+        vm['maxdisk'] = size
+    return jsonify({'data': None})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/storage', methods=['GET'])
+def get_storages(node):
+    return jsonify({'data': [
+        {'storage': 'local', 'content': 'iso,vztmpl,backup', 'type': 'dir', 'active': 1, 'enabled': 1},
+        {'storage': 'local-lvm', 'content': 'images,rootdir', 'type': 'lvmthin', 'active': 1, 'enabled': 1},
+        {'storage': SHARED_ISO_STORAGE, 'content': 'iso,vztmpl', 'type': 'nfs', 'shared': 1, 'active': 1, 'enabled': 1},
+    ]})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/storage/<storage>/content', methods=['GET'])
+def get_storage_content(node, storage):
+    if storage == SHARED_ISO_STORAGE:
+        return jsonify({'data': [{'volid': f'{storage}:iso/{name}', 'content': 'iso', 'format': 'iso', 'size': 4 * 10**9}
+                                 for name in SHARED_ISO_IMAGES] +
+                                [{'volid': f'{storage}:vztmpl/{name}', 'content': 'vztmpl', 'format': 'tzst', 'size': 10**8}
+                                 for name in SHARED_TEMPLATES]})
+    if storage != 'local':
+        return jsonify({'data': []})
+    return jsonify({'data': [{'volid': f'local:iso/{name}', 'content': 'iso', 'format': 'iso', 'size': 10**9}
+                             for name in ISO_IMAGES]})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/storage/<storage>/status', methods=['GET'])
+def get_storage_status(node, storage):
+    if node not in vms:
+        return error(404, 'No such node')
+    total = node_sizes[node][2]
+    with state_lock:
+        used = sum(vm['maxdisk'] for vm in vms[node].values()) if storage == 'local-lvm' else 10**11
+    return jsonify({'data': {'total': total, 'used': min(used, total), 'avail': max(total - used, 0),
+                             'active': 1, 'enabled': 1}})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/tasks/<upid>/status', methods=['GET'])
+def get_task_status(node, upid):
+    with state_lock:
+        finishes_at = tasks.get(upid)
+    if finishes_at is None:
+        return error(500, 'No such task')
+    if time.monotonic() < finishes_at:
+        return jsonify({'data': {'upid': upid, 'node': node, 'status': 'running'}})
+    return jsonify({'data': {'upid': upid, 'node': node, 'status': 'stopped', 'exitstatus': 'OK'}})
+
+@app.route(f'{API_PREFIX}/cluster/nextid', methods=['GET'])
+def get_next_id():
+    with state_lock:
+        used = {vmid for node_vms in vms.values() for vmid in node_vms}
+    wanted = request.args.get('vmid')
+    if wanted:
+        if int(wanted) in used:
+            return jsonify({'data': None, 'errors': {'vmid': f'VM {wanted} already exists'}}), 400
+        return jsonify({'data': wanted})
+    vmid = 100
+    while vmid in used:
+        vmid += 1
+    return jsonify({'data': str(vmid)})
+
+@app.route(f'{API_PREFIX}/cluster/resources', methods=['GET'])
+def get_cluster_resources():
+    resource_type = request.args.get('type')
+    data = []
+    with state_lock:
+        if resource_type in (None, 'node'):
+            data += [{'id': f'node/{node}', 'type': 'node', 'node': node, 'status': 'online',
+                      'maxcpu': node_sizes[node][0], 'maxmem': node_sizes[node][1]} for node in vms]
+        if resource_type in (None, 'vm'):
+            data += [dict(vm, id=f"qemu/{vm['vmid']}", type='qemu', node=node, maxcpu=vm['cpus'])
+                     for node, node_vms in vms.items() for vm in node_vms.values()]
+    return jsonify({'data': data})
+
+@app.route(f'{API_PREFIX}/cluster/status', methods=['GET'])
+def get_cluster_status():
+    data = [{'type': 'cluster', 'name': 'mock', 'quorate': 1, 'nodes': len(vms)}]
+    data += [{'type': 'node', 'name': node, 'online': 1} for node in vms]
+    return jsonify({'data': data})
+
+# Seconds between the data points of each RRD timeframe, Proxmox returns about 70 points per timeframe
+RRD_STEPS = {'hour': 60, 'day': 1800, 'week': 10800, 'month': 43200, 'year': 604800}
+RRD_POINTS = 70
+
+# Function to generate RRD rows ending now, the newest point has no values yet like in Proxmox
+def rrd_rows(timeframe, fields):
+    step = RRD_STEPS.get(timeframe, 60)
+    end = int(time.time()) // step * step
+    rows = [dict({name: scale * random.random() for name, scale in fields.items()}, time=end - step * index)
+            for index in range(RRD_POINTS - 1, 0, -1)]
+    return rows + [{'time': end}]
+
+@app.route(f'{API_PREFIX}/nodes/<node>/rrddata', methods=['GET'])
+def get_node_rrd(node):
+    if node not in vms:
+        return error(404, 'No such node')
+    cores, memory, _ = node_sizes[node]
+    return jsonify({'data': rrd_rows(request.args.get('timeframe'), {
+        'cpu': 1.0, 'loadavg': cores, 'memused': memory, 'netin': 10**8, 'netout': 10**8, 'iowait': 0.1})})
+
+@app.route(f'{API_PREFIX}/nodes/<node>/qemu/<int:vmid>/rrddata', methods=['GET'])
+def get_vm_rrd(node, vmid):
+    with state_lock:
+        vm = vms.get(node, {}).get(vmid)
+    if vm is None:
+        return error(500, f'VM {vmid} not found')
+    return jsonify({'data': rrd_rows(request.args.get('timeframe'), {
+        'cpu': 1.0, 'mem': vm['maxmem'], 'netin': 10**7, 'netout': 10**7, 'diskread': 10**7, 'diskwrite': 10**7})})
+
+@app.route('/_mock/stats', methods=['GET'])
+def get_stats():
+    with state_lock:
+        return jsonify({'total': sum(calls.values()), 'calls': dict(calls)})
+
+@app.route('/_mock/reset', methods=['POST'])
+def reset_stats():
+    with state_lock:
+        calls.clear()
+    return jsonify({'status': 'reset'})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Mock Proxmox API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8006)
+    parser.add_argument('--nodes', type=int, default=3, help='Number of nodes')
+    parser.add_argument('--vms-per-node', type=int, default=100, help='Number of VMs on each node')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random variation of the latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of authenticated calls answering 500')
+    parser.add_argument('--task-duration', type=float, default=0.0, help='Seconds until a task finishes')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the generated inventory')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    build_inventory(args.nodes, args.vms_per_node)
+    settings.update(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, task_duration=args.task_duration)
+    print(f"Mock Proxmox with {args.nodes} nodes and {args.nodes * args.vms_per_node} VMs on "
+          f"http://{args.host}:{args.port}{API_PREFIX}")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == "__main__":
+    main()
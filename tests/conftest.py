@@ -0,0 +1,58 @@
+import os
+import sys
+import random
+import threading
+import importlib
+import pytest
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mock_proxmox
+
+API_PASSWORD = 'test-password'
+
+# Mock Proxmox API with 2 nodes of 5 VMs each, served in a background thread
+@pytest.fixture(scope='session')
+def proxmox_url():
+    random.seed(0)
+    mock_proxmox.build_inventory(2, 5)
+    server = make_server('127.0.0.1', 0, mock_proxmox.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}{mock_proxmox.API_PREFIX}"
+    server.shutdown()
+
+# backend.py reads its configuration on import, so it is imported once the mock is running.
+# Its log files are written to a temporary directory.
+@pytest.fixture(scope='session')
+def backend(proxmox_url, tmp_path_factory):
+    os.environ.update({
+        'PROXMOX_URL': proxmox_url,
+        'PROXMOX_USER': 'root@pam',
+        'PROXMOX_PASS': 'secret',
+        'API_PASSWORD': API_PASSWORD,
+        'NODE_NAME': 'pve1',
+        'REQUESTS_PER_MINUTE': '100000',
+    })
+    os.environ.pop('SHARED_STATE_DB', None)
+    os.chdir(tmp_path_factory.mktemp('logs'))
+    return importlib.import_module('backend')
+
+# Fresh circuit breaker and inventory cache for each test, with the health probe kept from
+# making trial calls behind the test's back
+@pytest.fixture
+def breaker(backend, monkeypatch):
+    circuit_breaker = backend.CircuitBreaker(window=10, min_calls=4, failure_ratio=0.5, slow_call=1,
+                                             open_seconds=30, trial_timeout=5)
+    monkeypatch.setattr(backend, 'circuit_breaker', circuit_breaker)
+    monkeypatch.setattr(backend, 'inventory_cache', backend.TTLCache(100))
+    monkeypatch.setattr(backend, 'inventory_caches', [backend.inventory_cache])
+    monkeypatch.setattr(backend.health_probe, 'start', lambda: None)
+    return circuit_breaker
+
+@pytest.fixture
+def client(backend):
+    client = backend.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {API_PASSWORD}'
+    return client
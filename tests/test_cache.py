@@ -0,0 +1,103 @@
+import threading
+import time
+import pytest
+
+
+class Loader:
+    def __init__(self, value='value', delay=0):
+        self.value = value
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        return self.value
+
+
+def test_hit_within_ttl_doesnt_reload(backend):
+    cache = backend.TTLCache(10)
+    loader = Loader()
+    assert cache.get_or_load('key', 60, loader) == 'value'
+    assert cache.get_or_load('key', 60, loader) == 'value'
+    assert loader.calls == 1
+
+
+def test_expired_entry_is_reloaded(backend):
+    cache = backend.TTLCache(10)
+    loader = Loader()
+    cache.get_or_load('key', 0.01, loader)
+    time.sleep(0.02)
+    cache.get_or_load('key', 0.01, loader)
+    assert loader.calls == 2
+
+
+def test_concurrent_misses_share_one_load(backend):
+    cache = backend.TTLCache(10)
+    loader = Loader(delay=0.1)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('key', 60, loader))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['value'] * 8
+    assert loader.calls == 1
+
+
+def test_failed_load_is_not_cached(backend):
+    cache = backend.TTLCache(10)
+
+    def fail():
+        raise ValueError('down')
+    with pytest.raises(ValueError):
+        cache.get_or_load('key', 60, fail)
+    assert cache.get_or_load('key', 60, Loader()) == 'value'
+
+
+def test_least_recently_used_entry_is_evicted(backend):
+    cache = backend.TTLCache(2)
+    loader = Loader()
+    cache.get_or_load('a', 60, loader)
+    cache.get_or_load('b', 60, loader)
+    cache.get_or_load('a', 60, loader)
+    cache.get_or_load('c', 60, loader)
+    assert loader.calls == 3
+    cache.get_or_load('a', 60, loader)
+    assert loader.calls == 3
+    cache.get_or_load('b', 60, loader)
+    assert loader.calls == 4
+
+
+def test_invalidate_drops_entry(backend):
+    cache = backend.TTLCache(10)
+    loader = Loader()
+    cache.get_or_load('key', 60, loader)
+    cache.invalidate('key', 'missing')
+    cache.get_or_load('key', 60, loader)
+    assert loader.calls == 2
+
+
+def test_invalidate_during_load_doesnt_store_old_value(backend):
+    cache = backend.TTLCache(10)
+    started = threading.Event()
+
+    def slow_load():
+        started.set()
+        time.sleep(0.1)
+        return 'old'
+    thread = threading.Thread(target=cache.get_or_load, args=('key', 60, slow_load))
+    thread.start()
+    started.wait()
+    cache.invalidate('key')
+    thread.join()
+    assert cache.get_or_load('key', 60, Loader('new')) == 'new'
+
+
+def test_get_stale_returns_recently_expired_entry(backend):
+    cache = backend.TTLCache(10)
+    assert cache.get_stale('key', 60) == (False, None)
+    cache.get_or_load('key', 0.01, Loader())
+    time.sleep(0.02)
+    assert cache.get_stale('key', 60) == (True, 'value')
+    assert cache.get_stale('key', 0) == (False, None)
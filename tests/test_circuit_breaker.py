@@ -0,0 +1,149 @@
+import time
+import pytest
+
+
+def trip(breaker, key, calls=4):
+    for _ in range(calls):
+        breaker.record(key, 'error', 0.01, 'Connection refused')
+
+
+def test_closed_circuit_allows_calls(backend, breaker):
+    breaker.check('pve1')
+    breaker.record('pve1', 200, 0.01)
+    breaker.check('pve1')
+    assert breaker.open_circuits() == []
+
+
+def test_failures_open_circuit(backend, breaker):
+    trip(breaker, 'pve1')
+    with pytest.raises(backend.CircuitOpenError) as excinfo:
+        breaker.check('pve1')
+    assert excinfo.value.key == 'pve1'
+    assert 0 < excinfo.value.retry_after <= 30
+    assert breaker.snapshot()['pve1']['state'] == 'open'
+    assert breaker.snapshot()['pve1']['last_error'] == 'Connection refused'
+    # Other nodes are unaffected
+    breaker.check('pve2')
+
+
+def test_too_few_calls_keep_circuit_closed(backend, breaker):
+    trip(breaker, 'pve1', calls=3)
+    breaker.check('pve1')
+
+
+def test_failures_below_ratio_keep_circuit_closed(backend, breaker):
+    for _ in range(6):
+        breaker.record('pve1', 200, 0.01)
+    trip(breaker, 'pve1', calls=4)
+    breaker.check('pve1')
+
+
+def test_slow_calls_and_gateway_errors_count_as_failures(backend, breaker):
+    breaker.record('pve1', 200, 2)
+    breaker.record('pve1', 502, 0.01)
+    breaker.record('pve1', 596, 0.01)
+    breaker.record('pve1', 200, 1.5)
+    with pytest.raises(backend.CircuitOpenError):
+        breaker.check('pve1')
+
+
+def test_client_errors_dont_open_circuit(backend, breaker):
+    for status in (400, 401, 404, 500):
+        breaker.record('pve1', status, 0.01)
+    breaker.check('pve1')
+
+
+def test_open_cluster_circuit_refuses_node_calls(backend, breaker):
+    trip(breaker, backend.CLUSTER_CIRCUIT)
+    with pytest.raises(backend.CircuitOpenError) as excinfo:
+        breaker.check('pve1')
+    assert excinfo.value.retry_after > 0
+
+
+def test_half_open_trial_success_closes_circuit(backend, breaker):
+    breaker.open_seconds = 0.05
+    trip(breaker, 'pve1')
+    time.sleep(0.06)
+    # A single trial call is let through, the others are refused until it reports back
+    breaker.check('pve1')
+    assert breaker.snapshot()['pve1']['state'] == 'half-open'
+    with pytest.raises(backend.CircuitOpenError):
+        breaker.check('pve1')
+    breaker.record('pve1', 200, 0.01)
+    assert breaker.snapshot()['pve1']['state'] == 'closed'
+    breaker.check('pve1')
+    # The failures from before the circuit opened are forgotten
+    breaker.record('pve1', 'error', 0.01)
+    breaker.check('pve1')
+
+
+def test_half_open_trial_failure_reopens_circuit(backend, breaker):
+    breaker.open_seconds = 0.05
+    trip(breaker, 'pve1')
+    time.sleep(0.06)
+    breaker.check('pve1')
+    breaker.record('pve1', 'error', 0.01)
+    assert breaker.snapshot()['pve1']['state'] == 'open'
+    with pytest.raises(backend.CircuitOpenError):
+        breaker.check('pve1')
+
+
+def test_lost_trial_allows_another_trial(backend, breaker):
+    breaker.open_seconds = 0.05
+    breaker.trial_timeout = 0.05
+    trip(breaker, 'pve1')
+    time.sleep(0.06)
+    breaker.check('pve1')
+    time.sleep(0.06)
+    breaker.check('pve1')
+
+
+def test_open_circuit_fails_fast_with_503(backend, breaker, client):
+    trip(breaker, 'pve1')
+    response = client.get('/api/nodes/pve1/qemu')
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    assert 'pve1' in response.get_json()['error']
+    assert client.get('/api/nodes/pve2/qemu').status_code == 200
+
+
+def test_unreachable_proxmox_opens_circuit(backend, breaker, client, monkeypatch):
+    monkeypatch.setattr(backend.proxmox, 'base_url', 'http://127.0.0.1:9/api2/json')
+    monkeypatch.setattr(backend.proxmox, 'timeout', (0.5, 0.5))
+    for _ in range(4):
+        assert client.get('/api/nodes/pve1/qemu').status_code == 500
+    start = time.monotonic()
+    assert client.get('/api/nodes/pve1/qemu').status_code == 503
+    assert time.monotonic() - start < 0.5
+
+
+def test_stale_data_served_while_circuit_is_open(backend, breaker, client, monkeypatch):
+    monkeypatch.setattr(backend, 'CACHE_TTL_VMS', 0)
+    fresh = client.get('/api/nodes/pve1/qemu')
+    assert fresh.status_code == 200
+    assert 'Warning' not in fresh.headers
+    trip(breaker, 'pve1')
+    stale = client.get('/api/nodes/pve1/qemu')
+    assert stale.status_code == 200
+    assert stale.headers['Warning'] == '110 - "Response is Stale"'
+    assert stale.get_json() == fresh.get_json()
+
+
+def test_stale_data_too_old_is_not_served(backend, breaker, client, monkeypatch):
+    monkeypatch.setattr(backend, 'CACHE_TTL_VMS', 0)
+    monkeypatch.setattr(backend, 'CACHE_STALE_MAX_AGE', 0)
+    assert client.get('/api/nodes/pve1/qemu').status_code == 200
+    trip(breaker, 'pve1')
+    assert client.get('/api/nodes/pve1/qemu').status_code == 503
+
+
+def test_status_reports_open_circuits(backend, breaker, client, monkeypatch):
+    monkeypatch.setattr(backend.health_probe, 'last_result', (True, time.time()))
+    assert client.get('/api/status').get_json()['proxmox']['status'] == 'ok'
+    trip(breaker, 'pve2')
+    response = client.get('/api/status')
+    assert response.status_code == 200
+    assert response.get_json()['proxmox']['status'] == 'degraded'
+    assert response.get_json()['proxmox']['circuits']['pve2']['state'] == 'open'
+    trip(breaker, backend.CLUSTER_CIRCUIT)
+    assert client.get('/api/status').status_code == 503
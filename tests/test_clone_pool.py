@@ -0,0 +1,70 @@
+import copy
+import pytest
+
+import mock_proxmox
+
+
+# Pool of 2 basic clones of the mock's template, the VMs it creates are removed from the mock afterwards
+@pytest.fixture
+def pool(backend, monkeypatch):
+    saved = copy.deepcopy(mock_proxmox.vms)
+    monkeypatch.setitem(backend.TIER_CONFIGURATIONS, 'basic', dict(backend.TIER_CONFIGURATIONS['basic'],
+                                                                   template=mock_proxmox.TEMPLATE_NAME))
+    monkeypatch.setattr(backend, 'inventory_cache', backend.TTLCache(100))
+    monkeypatch.setattr(backend, 'inventory_caches', [backend.inventory_cache])
+    pool = backend.ClonePool({'basic': 2}, 60, backend.MemoryLeases(), take_ttl=60, refill_ttl=60)
+    monkeypatch.setattr(pool, 'start', lambda: None)
+    monkeypatch.setattr(backend, 'clone_pool', pool)
+    yield pool
+    with mock_proxmox.state_lock:
+        mock_proxmox.vms.clear()
+        mock_proxmox.vms.update(saved)
+
+
+def pooled_clones():
+    return {vmid: vm for node_vms in mock_proxmox.vms.values() for vmid, vm in node_vms.items() if vm['name'] == 'pool-basic'}
+
+
+def test_refill_fills_pool_without_onboot(backend, pool):
+    pool.refill()
+    clones = pooled_clones()
+    assert len(clones) == 2
+    assert all(vm['onboot'] == 0 for vm in clones.values())
+    # A full pool isn't refilled again
+    pool.refill()
+    assert pooled_clones().keys() == clones.keys()
+
+
+def test_take_renames_clone_and_releases_it(backend, pool):
+    pool.refill()
+    basic = backend.TIER_CONFIGURATIONS['basic']
+    taken = pool.take('basic', basic, 'web-1')
+    vm = mock_proxmox.vms[taken['node']][taken['vmid']]
+    assert (vm['name'], vm['onboot']) == ('web-1', 1)
+    assert pool.leases.acquire(f"pool-vm:{taken['vmid']}", 1)
+    assert pool.take('basic', basic, 'web-2')['vmid'] != taken['vmid']
+    assert pool.take('basic', basic, 'web-3') is None
+
+
+def test_create_from_pool_answers_without_queueing(backend, pool, client):
+    pool.refill()
+    response = client.post('/api/create-vm', json={'name': 'web-1', 'tier': 'basic'})
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body['source'] == 'pool'
+    assert mock_proxmox.vms[body['node']][body['vmid']]['name'] == 'web-1'
+    job = client.get(body['status_url']).get_json()
+    assert job['status'] == 'succeeded'
+
+
+def test_take_skips_clone_handed_out_after_inventory_was_cached(backend, pool):
+    pool.refill()
+    members = pool.members('basic')
+    # Another worker process renames a clone, this process still has the pool in its cache
+    node, vmid = members[0]
+    mock_proxmox.vms[node][vmid]['name'] = 'web-1'
+    assert pool.members('basic') == members
+    basic = backend.TIER_CONFIGURATIONS['basic']
+    taken = pool.take('basic', basic, 'web-2')
+    assert (taken['node'], taken['vmid']) == members[1]
+    assert pool.take('basic', basic, 'web-3') is None
@@ -0,0 +1,24 @@
+import logging
+
+
+def make_record(*args):
+    return logging.LogRecord('backend', logging.INFO, __file__, 1, 'Create VM request with data: %s', args, None)
+
+
+def test_unsampled_payload_keeps_record(backend, monkeypatch):
+    monkeypatch.setattr(backend, 'LOG_PAYLOAD_SAMPLE_RATE', 0)
+    record = make_record(backend.LogPayload({'name': 'web-1'}))
+    assert backend.RequestContextFilter().filter(record)
+    assert record.getMessage() == 'Create VM request with data: (payload not sampled)'
+
+
+def test_sampled_payload_is_written(backend, monkeypatch):
+    monkeypatch.setattr(backend, 'LOG_PAYLOAD_SAMPLE_RATE', 1)
+    record = make_record(backend.LogPayload({'name': 'web-1'}))
+    assert backend.RequestContextFilter().filter(record)
+    assert record.getMessage() == 'Create VM request with data: {"name": "web-1"}'
+
+
+def test_payload_is_truncated(backend, monkeypatch):
+    monkeypatch.setattr(backend, 'LOG_PAYLOAD_MAX_CHARS', 10)
+    assert str(backend.LogPayload('x' * 50)) == '"xxxxxxxxx... (52 chars)'
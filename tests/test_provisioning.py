@@ -0,0 +1,33 @@
+import copy
+import pytest
+
+import mock_proxmox
+
+
+@pytest.fixture
+def restore_inventory():
+    saved = copy.deepcopy(mock_proxmox.vms)
+    yield
+    with mock_proxmox.state_lock:
+        mock_proxmox.vms.clear()
+        mock_proxmox.vms.update(saved)
+
+
+def test_failed_create_task_releases_reservation_and_vmid(backend, restore_inventory, monkeypatch):
+    def timeout(node, upid):
+        raise TimeoutError(f"Task {upid} did not finish")
+    monkeypatch.setattr(backend, 'wait_for_task', timeout)
+    tier_config = backend.TIER_CONFIGURATIONS['basic']
+    ok, message, reservation = backend.resource_ledger.reserve('pve1', 1, 1, 20, 'web-1')
+    assert ok, message
+    with pytest.raises(TimeoutError):
+        backend.clone_vm('pve1', mock_proxmox.TEMPLATE_VMID_BASE + 1, 'web-1', tier_config, reservation)
+    assert all(entry['name'] != 'web-1' for entry in backend.reservations.active())
+    vmid = next(vmid for vmid, vm in mock_proxmox.vms['pve1'].items() if vm['name'] == 'web-1')
+    assert backend.vmid_allocator.leases.acquire(f"vmid:{vmid}", 1)
+
+
+@pytest.mark.parametrize('body', [[], {'tier': 'basic'}, {'name': 7}, {'name': 'web-1', 'tier': 3}])
+def test_create_rejects_malformed_body(client, body):
+    response = client.post('/api/create-vm', json=body)
+    assert response.status_code == 400
@@ -0,0 +1,73 @@
+import pytest
+
+
+@pytest.fixture
+def cache(backend, monkeypatch):
+    monkeypatch.setattr(backend, 'inventory_cache', backend.TTLCache(100))
+    monkeypatch.setattr(backend, 'inventory_caches', [backend.inventory_cache])
+
+
+def test_missing_flag_matches_false_filter(backend):
+    items = [{'vmid': 100}, {'vmid': 101, 'template': 1}, {'vmid': 102, 'template': 0}]
+    filters = backend.VM_FILTERS
+    assert backend.select_items(items, {'template': '0'}, filters)[0] == [{'vmid': 100}, {'vmid': 102, 'template': 0}]
+    assert backend.select_items(items, {'template': '1'}, filters)[0] == [{'vmid': 101, 'template': 1}]
+    assert backend.select_items(items, {'lock': 'backup'}, filters)[0] == []
+
+
+def test_template_filter_on_mock_inventory(backend, cache, client):
+    vms = client.get('/api/nodes/pve1/qemu?template=0&fields=vmid').get_json()
+    templates = client.get('/api/nodes/pve1/qemu?template=1&fields=vmid').get_json()
+    assert len(vms) == 5
+    assert templates == [{'vmid': 9001}]
+
+
+def test_etag_follows_cached_data_version(backend, cache, client, monkeypatch):
+    first = client.get('/api/nodes/pve1/qemu')
+    etag = first.headers['ETag']
+    assert client.get('/api/nodes/pve1/qemu').headers['ETag'] == etag
+    # Other query parameters give another ETag for the same data
+    assert client.get('/api/nodes/pve1/qemu?sort=name').headers['ETag'] != etag
+    backend.invalidate_vm_cache('pve1')
+    assert client.get('/api/nodes/pve1/qemu').headers['ETag'] == etag
+
+
+def test_not_modified_skips_serialization(backend, cache, client, monkeypatch):
+    etag = client.get('/api/cluster/vms').headers['ETag']
+
+    def fail(*args):
+        raise AssertionError('response was serialized')
+    monkeypatch.setattr(backend, 'list_response', fail)
+    response = client.get('/api/cluster/vms', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert 'Content-Type' not in response.headers
+    assert response.data == b''
+
+
+def test_gzip_etag_gets_not_modified(backend, cache, client):
+    response = client.get('/api/cluster/vms', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'].endswith('-gzip"')
+    assert client.get('/api/cluster/vms', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+def test_unversioned_route_not_modified_has_no_content_type(backend, client):
+    etag = client.get('/api/iso').headers['ETag']
+    response = client.get('/api/iso', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert 'Content-Type' not in response.headers
+
+
+def test_rrd_vmid_is_an_integer(backend, cache, client):
+    assert client.get('/api/nodes/pve1/qemu/100/rrd').get_json()['vmid'] == 100
+    assert client.get('/api/nodes/pve1/qemu/abc/rrd').status_code == 400
+    body = client.get('/api/cluster/rrd?vmid=100,999').get_json()
+    assert [series['vmid'] for series in body['series']] == [100]
+    assert body['errors'] == {'999': 'VM not found'}
+
+
+@pytest.mark.parametrize('body', [[{'node': 'pve1', 'vmid': 100}], 42, 'start'])
+def test_bulk_action_rejects_body_that_isnt_an_object(backend, client, body):
+    response = client.post('/api/bulk/qemu/start', json=body)
+    assert response.status_code == 400
@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+import pytest
+
+
+# Each test gets its own shared state database
+@pytest.fixture
+def shared_state_db(backend, monkeypatch, tmp_path):
+    monkeypatch.setattr(backend, 'SHARED_STATE_DB', str(tmp_path / 'shared_state.db'))
+    monkeypatch.setattr(backend, '_shared_state', threading.local())
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def rate_limiter(request, backend):
+    if request.param == 'memory':
+        return backend.MemoryRateLimiter(100)
+    request.getfixturevalue('shared_state_db')
+    return backend.SQLiteRateLimiter()
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def leases(request, backend):
+    if request.param == 'memory':
+        return backend.MemoryLeases()
+    request.getfixturevalue('shared_state_db')
+    return backend.SQLiteLeases()
+
+
+def test_refill_token_bucket(backend):
+    assert backend.refill_token_bucket(3, 0, 60) == (2, 0)
+    tokens, retry_after = backend.refill_token_bucket(0, 0.5, 60)
+    assert tokens == pytest.approx(0.5)
+    assert retry_after == pytest.approx(0.5)
+    # A bucket never holds more than a minute's worth of tokens
+    assert backend.refill_token_bucket(0, 3600, 60) == (59, 0)
+
+
+def test_rate_limiter_allows_burst_then_refuses(rate_limiter):
+    assert [rate_limiter.acquire('client', 3)[0] for _ in range(3)] == [True] * 3
+    allowed, retry_after = rate_limiter.acquire('client', 3)
+    assert not allowed
+    assert 0 < retry_after <= 20
+
+
+def test_rate_limiter_keys_are_independent(rate_limiter):
+    rate_limiter.acquire('a', 1)
+    assert not rate_limiter.acquire('a', 1)[0]
+    assert rate_limiter.acquire('b', 1)[0]
+
+
+def test_rate_limiter_refills(rate_limiter):
+    rate_limiter.acquire('client', 600)
+    for _ in range(599):
+        rate_limiter.acquire('client', 600)
+    assert not rate_limiter.acquire('client', 600)[0]
+    time.sleep(0.15)
+    assert rate_limiter.acquire('client', 600)[0]
+
+
+def test_memory_rate_limiter_drops_least_recently_used_keys(backend):
+    rate_limiter = backend.MemoryRateLimiter(2)
+    rate_limiter.acquire('a', 1)
+    rate_limiter.acquire('b', 1)
+    rate_limiter.acquire('c', 1)
+    assert rate_limiter.acquire('a', 1)[0]
+
+
+def test_sqlite_rate_limiter_is_shared_between_connections(backend, shared_state_db):
+    rate_limiter = backend.SQLiteRateLimiter()
+    rate_limiter.acquire('client', 1)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(rate_limiter.acquire('client', 1)[0]))
+    thread.start()
+    thread.join()
+    assert results == [False]
+
+
+def test_sqlite_rate_limiter_fails_open(backend, shared_state_db, monkeypatch):
+    rate_limiter = backend.SQLiteRateLimiter()
+
+    def locked(key, per_minute):
+        raise backend.sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(rate_limiter, '_acquire', locked)
+    assert rate_limiter.acquire('client', 1) == (True, 0)
+
+
+def test_lease_is_exclusive_until_released(leases):
+    assert leases.acquire('vmid:100', 60)
+    assert not leases.acquire('vmid:100', 60)
+    assert leases.acquire('vmid:101', 60)
+    leases.release('vmid:100')
+    assert leases.acquire('vmid:100', 60)
+
+
+def test_lease_expires(leases):
+    assert leases.acquire('vmid:100', 0.05)
+    time.sleep(0.06)
+    assert leases.acquire('vmid:100', 60)
+
+
+def test_concurrent_lease_has_one_winner(leases):
+    barrier = threading.Barrier(8)
+    results = []
+
+    def acquire():
+        barrier.wait()
+        results.append(leases.acquire('vmid:100', 60))
+    threads = [threading.Thread(target=acquire) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
+
+
+def test_sqlite_leases_are_shared_between_instances(backend, shared_state_db):
+    assert backend.SQLiteLeases().acquire('vmid:100', 60)
+    assert not backend.SQLiteLeases().acquire('vmid:100', 60)
+
+
+def test_metrics_are_totalled_over_processes(backend, shared_state_db, monkeypatch):
+    requests_total = backend.Counter('test_requests_total', 'Requests', ('status',))
+    in_flight = backend.Gauge('test_in_flight', 'Requests in flight')
+    monkeypatch.setattr(backend, 'METRICS', [requests_total, in_flight])
+    store = backend.SQLiteMetrics(5)
+    # Two worker processes publish their values
+    requests_total.inc(200, amount=3)
+    in_flight.inc()
+    store.publish()
+    store._process = (os.getpid(), 'other-worker')
+    requests_total.inc(200)
+    collected = store.collect()
+    assert requests_total.merge(collected['test_requests_total']) == {(200,): 7}
+    assert in_flight.merge(collected['test_in_flight']) == {(): 2}
+    # A stopped process keeps its counts, its gauges are dropped once stale
+    shared = backend.shared_state_connection()
+    shared.execute("UPDATE metrics SET updated_at = 0 WHERE process != 'other-worker'")
+    collected = store.collect()
+    assert requests_total.merge(collected['test_requests_total']) == {(200,): 7}
+    assert in_flight.merge(collected['test_in_flight']) == {(): 1}